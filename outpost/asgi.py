@@ -0,0 +1,427 @@
+# Copyright 2015 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under BSD-license. See license.txt
+#
+"""
+Asyncio proxy engine
+--------------------
+Optional ASGI entry point running the proxy on a non-blocking http client (`httpx`).
+Backend requests do not block a worker thread, so many slow backend requests can be
+processed in a single process.
+
+Proxied requests run the same `ProxyUrlHandler` and filter pipeline as the WSGI
+server. Pre and post hook filters are called in a thread pool (`asgi.threads`).
+File requests and all other routes are passed to the pyramid WSGI application in the
+thread pool.
+
+Run with any ASGI server e.g. ::
+
+    OUTPOST_INI=server.ini uvicorn --factory outpost.asgi:create
+
+Settings ::
+
+    asgi.threads = 20           thread pool size for filters and file requests
+    asgi.connections = 1000     max. number of backend connections
+
+Streamed responses (`proxy.stream`) are passed to the client without buffering if no
+post filter in `body` or `stream` mode matches.
+"""
+import asyncio
+import io
+import logging
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pyramid.interfaces import IRoutesMapper
+from pyramid.httpexceptions import HTTPException, HTTPBadGateway
+from pyramid.request import Request
+from pyramid.settings import asbool
+
+from outpost import compress
+from outpost import profiling
+from outpost import filtermanager
+from outpost.metrics import record
+from outpost.proxy import Proxy, ProxyUrlHandler
+from outpost.server import setup
+from outpost.upstream import FAILURE_STATUS
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+def create(inifile=None):
+    """
+    ASGI application factory. Loads the `[app:main]` settings from `inifile` or the
+    file set as `OUTPOST_INI` environment variable (default `server.ini`).
+    """
+    from pyramid.paster import get_appsettings, setup_logging
+    inifile = inifile or os.environ.get("OUTPOST_INI") or "server.ini"
+    setup_logging(inifile)
+    settings = get_appsettings(inifile)
+    return main({"__file__": inifile}, **settings)
+
+
+# Main server function
+def main(global_config, **settings):
+    if httpx is None:
+        raise filtermanager.ConfigurationError("The asgi server requires the httpx package.")
+    config = setup(global_config, **settings)
+    return ASGIApp(config)
+
+
+class ASGIApp(object):
+    """
+    ASGI application. Proxy route requests are processed by `AsyncProxy`, all other
+    requests by the pyramid WSGI application in the thread pool.
+    """
+
+    def __init__(self, config):
+        self.registry = config.registry
+        self.wsgi = config.make_wsgi_app()
+        settings = self.registry.settings
+        self.executor = ThreadPoolExecutor(int(settings.get("asgi.threads") or 20))
+        self.client = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            raise ValueError("Unsupported scope type %s" % scope["type"])
+        body = await self.readBody(receive)
+        request = Request(makeEnviron(scope, body))
+        request.registry = self.registry
+        response = await self.response(request)
+        if response.conditional_response and not hasattr(response.app_iter, "__aiter__"):
+            # range and conditional requests like the wsgi server. see `Response.conditional_response_app`
+            response = request.get_response(response)
+        await self.sendResponse(response, send)
+
+    async def response(self, request):
+        loop = asyncio.get_running_loop()
+        mapper = self.registry.queryUtility(IRoutesMapper)
+        info = mapper(request) if mapper is not None else {"route": None}
+        if info["route"] is None or info["route"].name != "proxy":
+            return await loop.run_in_executor(self.executor, request.get_response, self.wsgi)
+        request.matchdict = info["match"]
+        request.matched_route = info["route"]
+        settings = self.registry.settings
+        t = time.perf_counter()
+        try:
+            url = ProxyUrlHandler(request, settings)
+            proxy = AsyncProxy(url, request, settings.get("debug"), self.httpClient(), self.executor)
+            response = await proxy.response()
+        except HTTPException as e:
+            response = e
+        except Exception as e:
+            log = logging.getLogger("outpost.proxy")
+            log.exception("%s %s" % (str(e), request.path_info))
+            response = HTTPBadGateway()
+        metrics = settings.get("metrics.instance")
+        if metrics is not None:
+            record(metrics, "proxy", request, response, time.perf_counter()-t)
+        if settings.get("filter.timing"):
+            profiling.serverTiming(request, response, time.perf_counter()-t)
+        return response
+
+    def httpClient(self):
+        if self.client is None:
+            settings = self.registry.settings
+            connections = int(settings.get("asgi.connections") or 1000)
+            self.client = httpx.AsyncClient(follow_redirects=True,
+                                            limits=httpx.Limits(max_connections=connections,
+                                                                max_keepalive_connections=connections))
+        return self.client
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.httpClient()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.client is not None:
+                    await self.client.aclose()
+                    self.client = None
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def readBody(self, receive):
+        body = []
+        more = True
+        while more:
+            message = await receive()
+            body.append(message.get("body", b""))
+            more = message.get("more_body", False)
+        return b"".join(body)
+
+    async def sendResponse(self, response, send):
+        headers = [(k.lower().encode("latin1"), v.encode("latin1")) for k, v in response.headerlist]
+        await send({"type": "http.response.start", "status": response.status_int, "headers": headers})
+        app_iter = response.app_iter
+        try:
+            if hasattr(app_iter, "__aiter__"):
+                async for chunk in app_iter:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            elif isinstance(app_iter, (list, tuple)):
+                for chunk in app_iter:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            else:
+                # sync iterators may block e.g. file reads or stream filters
+                loop = asyncio.get_running_loop()
+                chunks = iter(app_iter)
+                while True:
+                    chunk = await loop.run_in_executor(self.executor, next, chunks, None)
+                    if chunk is None:
+                        break
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            if hasattr(app_iter, "aclose"):
+                await app_iter.aclose()
+            elif hasattr(app_iter, "close"):
+                app_iter.close()
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+class AsyncProxy(Proxy):
+    """
+    Proxy sending backend requests with the non-blocking `httpx.AsyncClient`. Filters
+    are called in the thread pool. Streamed responses are buffered if any post filter
+    except `headers` mode filters matches.
+    """
+    bufferModes = ("body", "stream")
+
+    def __init__(self, url, request, debug, client, executor):
+        Proxy.__init__(self, url, request, debug)
+        self.client = client
+        self.executor = executor
+
+    async def response(self):
+        request = self.request
+        request.environ["proxy"] = self
+        loop = asyncio.get_running_loop()
+
+        try:
+            response = await loop.run_in_executor(self.executor, filtermanager.runPreHook,
+                                                  filtermanager.EmptyProxyResponse(), request, self.url)
+        except filtermanager.ResponseFinished as e:
+            return e.response
+
+        sliced = False
+        if response is None:
+            stream = self.streamPath(self.url)
+            response, body = await self.proxy(self.url, request, stream=stream)
+            if response.status_code == 206 and self.bodyFilter(response, request, status=200) is not None:
+                # filters of the complete response require the body. the range is sliced from the filtered response.
+                await response.aclose()
+                response, body = await self.proxy(self.url, request, stream=stream, headers=self.fullRequest)
+                sliced = True
+            if body is None and not self.streamResponse(response, request):
+                body = await self.readBody(response, request)
+        else:
+            body = response.body
+
+        proxy_response = self.wrap(response, body)
+        proxy_response.conditional_response = sliced
+        return await loop.run_in_executor(self.executor, filtermanager.runPostHook,
+                                          proxy_response, request, self.url)
+
+    def streamIter(self, response):
+        if self.keepEncoding(response, self.request):
+            return AsyncRawStreamIter(response, self.chunksize)
+        return AsyncStreamIter(response, self.chunksize)
+
+    async def readBody(self, response, request):
+        if self.keepEncoding(response, request):
+            body = b"".join([chunk async for chunk in response.aiter_raw()])
+        else:
+            body = await response.aread()
+        await response.aclose()
+        return body
+
+    async def proxy(self, url, request, method=None, params=None, stream=False, headers=None):
+        """
+        Sends the request to the backend server. See `Proxy.proxy()`.
+        """
+        log = logging.getLogger("outpost.proxy")
+        method, parameter = self.prepare(url, request, method, params, stream, headers)
+        # read the undecoded body
+        raw = asbool(request.registry.settings.get("proxy.passthrough")) and not stream
+        # cookies are forwarded in the cookie header
+        options = {"headers": parameter["headers"], "timeout": parameter["timeout"]}
+        if "params" in parameter:
+            options["params"] = parameter["params"]
+        else:
+            options["content"] = parameter["data"]
+        try:
+            response, body = await self.callAsync(method, url, options, stream, raw)
+        except Exception as e:
+            log.error("%s %s" % (str(e), url.destUrl))
+            raise
+        if raw and body and not self.keepEncoding(response, request):
+            body = compress.decompress(body, response.headers.get("Content-Encoding"))
+        return response, body
+
+    async def callAsync(self, method, url, options, stream=False, raw=False):
+        """
+        Sends the request and retries or hedges failed requests. See `Proxy.call()`.
+        """
+        policy = getattr(url, "retry", None)
+        if policy is None or not policy.retryable(method):
+            return await self.sendAsync(method, url, options, stream, raw)
+        log = logging.getLogger("outpost.proxy")
+        hedge = policy.hedge and not stream
+        policy.budget.deposit()
+        attempt = 0
+        while True:
+            t = time.perf_counter()
+            try:
+                if hedge:
+                    response, body = await self.hedgedAsync(policy, method, url, options, raw)
+                else:
+                    response, body = await self.sendAsync(method, url, options, stream, raw)
+            except httpx.TransportError as e:
+                if not self.retryAllowed(policy, attempt):
+                    raise
+                log.info("Retry %s %s: %s" % (method, url.destUrl, str(e)))
+            else:
+                if not policy.failed(response):
+                    policy.latency.record(time.perf_counter() - t)
+                    return response, body
+                if not self.retryAllowed(policy, attempt):
+                    return response, body
+                log.info("Retry %s %s: %s" % (method, url.destUrl, response.status_code))
+                await response.aclose()
+            await asyncio.sleep(policy.backoffDelay(attempt))
+            attempt += 1
+            url = self.alternate(url)
+
+    async def hedgedAsync(self, policy, method, url, options, raw=False):
+        """
+        Sends a second request to the next upstream if no response is received within
+        the hedge delay. See `Proxy.hedged()`.
+        """
+        delay = policy.hedgeDelay()
+        primary = asyncio.ensure_future(self.sendAsync(method, url, options, False, raw))
+        if delay is None:
+            return await primary
+        done, pending = await asyncio.wait((primary,), timeout=delay)
+        if done or not policy.budget.withdraw():
+            return await primary
+        self.countRetry("hedge")
+        calls = {primary, asyncio.ensure_future(self.sendAsync(method, self.alternate(url), options, False, raw))}
+        result = None
+        while calls:
+            done, calls = await asyncio.wait(calls, return_when=asyncio.FIRST_COMPLETED)
+            for call in done:
+                if call.exception() is not None:
+                    if calls or result is not None:
+                        continue
+                    raise call.exception()
+                response, body = call.result()
+                if not policy.failed(response) or not calls:
+                    for other in calls:
+                        other.cancel()
+                    if result is not None:
+                        await result[0].aclose()
+                    return response, body
+                result = response, body
+        return result
+
+    async def sendAsync(self, method, url, options, stream=False, raw=False):
+        """
+        Sends the prepared request. See `Proxy.send()`.
+        """
+        log = logging.getLogger("outpost.proxy")
+        request = self.request
+        upstreams, upstream = self.upstream(url)
+        if upstream is not None:
+            upstreams.acquire(upstream)
+        ok = False
+        t = time.perf_counter()
+        try:
+            backend = self.client.build_request(method, url.destUrl, **options)
+            response = await self.client.send(backend, stream=stream or raw)
+            if raw:
+                body = b"".join([chunk async for chunk in response.aiter_raw()])
+                await response.aclose()
+            else:
+                body = None if stream else response.content
+            ok = response.status_code not in FAILURE_STATUS
+        finally:
+            if upstream is not None:
+                upstreams.release(upstream, ok)
+        metrics = request.registry.settings.get("metrics.instance")
+        if metrics is not None:
+            metrics.observe("outpost_backend_seconds", (str(response.status_code),), time.perf_counter()-t)
+        profiling.timing(request, "backend", time.perf_counter()-t)
+        log.debug("%s %s, in %d ms %s" % (method, response.status_code, (time.perf_counter()-t)*1000, url.destUrl))
+        return response, body
+
+
+class AsyncStreamIter(object):
+    """
+    Async app_iter passing the backend response to the client in chunks.
+    """
+
+    def __init__(self, response, chunksize):
+        self.response = response
+        self.chunksize = chunksize
+
+    def __aiter__(self):
+        return self.response.aiter_bytes(self.chunksize).__aiter__()
+
+    async def aclose(self):
+        await self.response.aclose()
+
+
+class AsyncRawStreamIter(AsyncStreamIter):
+    """
+    Async app_iter passing the undecoded backend response to the client in chunks.
+    """
+
+    def __aiter__(self):
+        return self.response.aiter_raw(self.chunksize).__aiter__()
+
+
+def makeEnviron(scope, body):
+    """
+    Converts the ASGI http scope to a WSGI environ.
+    """
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf8").decode("latin1"),
+        "PATH_INFO": scope["path"].encode("utf8").decode("latin1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin1"),
+        "SERVER_PROTOCOL": "HTTP/%s" % scope.get("http_version", "1.1"),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    server = scope.get("server") or ("localhost", 80)
+    environ["SERVER_NAME"] = server[0]
+    environ["SERVER_PORT"] = str(server[1])
+    client = scope.get("client")
+    if client:
+        environ["REMOTE_ADDR"] = client[0]
+    for name, value in scope.get("headers", ()):
+        name = name.decode("latin1")
+        if name == "content-length":
+            key = "CONTENT_LENGTH"
+        elif name == "content-type":
+            key = "CONTENT_TYPE"
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        value = value.decode("latin1")
+        if key in environ:
+            value = environ[key] + "," + value
+        environ[key] = value
+    return environ
@@ -0,0 +1,654 @@
+# Copyright 2015 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under BSD-license. See license.txt
+#
+"""
+Response cache
+--------------
+Bounded in memory response cache used by the `filterinc.cache_read` and
+`filterinc.cache_write` filters.
+
+Cache entries expire based on the responses `Cache-Control` (`s-maxage`, `max-age`)
+and `Expires` headers. Responses marked `no-store` or `private`, responses with
+`Vary: *` and responses setting cookies are not cached. Entries are stored per `Vary` request header values.
+If the cache exceeds its size the least recently used (`lru`) or one of the least
+frequently used entries (`lfu`) is removed.
+
+Expired entries with `ETag` or `Last-Modified` validators are kept and revalidated
+with a conditional backend request. A `304 Not Modified` backend response refreshes
+the entry without transferring the body again. Conditional client requests
+(`If-None-Match`, `If-Modified-Since`) matching a cached entry are answered with
+`304 Not Modified` from the cache.
+
+Set `cache.store = disk` to use the persistent `DiskCache`. The disk cache is shared by
+all worker processes using the same directory and survives restarts.
+
+Settings ::
+
+    cache.store = memory        `memory` or `disk`
+    cache.directory = ./cache   directory of the disk cache
+    cache.maxsize = 67108864    cache size in bytes (body and headers)
+    cache.policy = lru          eviction policy `lru` or `lfu`
+    cache.ttl = 300             time to live in seconds if the response has no expiry headers
+
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+from webob.headers import ResponseHeaders
+
+__lock__ = threading.Lock()
+
+
+def getCache(settings):
+    """
+    Returns the response cache stored as `cache.instance` in settings. The cache is
+    created on first use.
+    """
+    cache = settings.get("cache.instance")
+    if cache is None:
+        with __lock__:
+            cache = settings.get("cache.instance")
+            if cache is None:
+                cache = settings["cache.instance"] = ResponseCache.fromSettings(settings)
+    return cache
+
+
+def resourceUrl(url):
+    """
+    Returns the url of the requested resource used in cache keys. Proxy url handlers
+    return the url with the configured backend host instead of the selected upstream
+    host (`keyPath`), so balanced requests share cache entries.
+    """
+    return getattr(url, "keyPath", None) or url.fullPath
+
+
+def cacheKey(request, url, vary=()):
+    """
+    Returns the cache key for the request. `vary` is a list of request header names.
+    """
+    key = resourceUrl(url)
+    if vary:
+        key += "\n" + "\n".join(request.headers.get(h, "") for h in vary)
+    return key
+
+
+def _path(key):
+    # the url part of the cache key
+    return str(key).split("\n", 1)[0]
+
+
+def parseCacheControl(value):
+    """
+    Parses a `Cache-Control` header value and returns a dictionary. Directives without
+    value are set to True.
+    """
+    result = {}
+    if not value:
+        return result
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "=" in part:
+            name, v = part.split("=", 1)
+            result[name.strip().lower()] = v.strip().strip('"')
+        else:
+            result[part.lower()] = True
+    return result
+
+
+def cacheable(headers):
+    """
+    Returns False if the response must not be stored in a shared cache: `no-store`,
+    `private`, `Vary: *` or a `Set-Cookie` header.
+    """
+    cc = parseCacheControl(headers.get("Cache-Control"))
+    if cc.get("no-store") or cc.get("private"):
+        return False
+    if headers.get("Vary", "").strip() == "*":
+        return False
+    return not any(k.lower() == "set-cookie" for k in headers)
+
+
+def responseTTL(headers, default=None, now=None):
+    """
+    Calculates the time to live in seconds based on the responses headers.
+    Returns None if the response must not be stored and `default` if the headers do not
+    define the expiry.
+    """
+    if not cacheable(headers):
+        return None
+    cc = parseCacheControl(headers.get("Cache-Control"))
+    if cc.get("no-cache"):
+        return 0
+    for name in ("s-maxage", "max-age"):
+        if name in cc:
+            try:
+                return max(int(cc[name]), 0)
+            except ValueError:
+                return 0
+    expires = headers.get("Expires")
+    if expires:
+        try:
+            expires = parsedate_to_datetime(expires).timestamp()
+        except (TypeError, ValueError):
+            # invalid dates are treated as already expired
+            return 0
+        date = headers.get("Date")
+        try:
+            date = parsedate_to_datetime(date).timestamp() if date else (now or time.time())
+        except (TypeError, ValueError):
+            date = now or time.time()
+        return max(int(expires - date), 0)
+    return default
+
+
+def varyHeaders(headers):
+    """
+    Returns the sorted tuple of lower case request header names listed in `Vary`.
+    """
+    vary = headers.get("Vary")
+    if not vary:
+        return ()
+    return tuple(sorted(set(h.strip().lower() for h in vary.split(",") if h.strip())))
+
+
+class CacheEntry(object):
+    """
+    Cached response
+    """
+    __slots__ = ("body", "status", "headers", "rtype", "created", "expires", "size", "hits")
+
+    def __init__(self, body, status, headers, rtype, ttl, now=None):
+        self.body = body
+        self.status = status
+        self.headers = headers
+        self.rtype = rtype
+        self.created = now or time.time()
+        self.expires = self.created + ttl
+        self.size = len(body) + sum(len(k)+len(v) for k, v in headers) + 100
+        self.hits = 0
+
+    def fresh(self, now=None):
+        return (now or time.time()) < self.expires
+
+    def close(self):
+        """
+        Releases resources of the entry not used to serve the response.
+        """
+        pass
+
+    def header(self, name, default=None):
+        name = name.lower()
+        for k, v in self.headers:
+            if k.lower() == name:
+                return v
+        return default
+
+    def validators(self):
+        """
+        Returns the conditional request headers to revalidate the entry.
+        """
+        headers = {}
+        etag = self.header("ETag")
+        if etag:
+            headers["If-None-Match"] = etag
+        modified = self.header("Last-Modified")
+        if modified:
+            headers["If-Modified-Since"] = modified
+        return headers
+
+
+# headers updated by a 304 response
+UPDATE_HEADERS = ("cache-control", "content-location", "date", "etag", "expires", "last-modified", "vary")
+
+
+def etagMatch(header, etag):
+    """
+    Weak comparison of the `If-None-Match` header value and the entity tag.
+    """
+    if not header or not etag:
+        return False
+    if header.strip() == "*":
+        return True
+    etag = etag.strip()
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def notModified(request, entry):
+    """
+    Checks the requests `If-None-Match` and `If-Modified-Since` headers against the
+    cache entry. Returns True if the client copy is valid.
+    """
+    inm = request.headers.get("If-None-Match")
+    if inm:
+        return etagMatch(inm, entry.header("ETag"))
+    ims = request.headers.get("If-Modified-Since")
+    modified = entry.header("Last-Modified")
+    if not ims or not modified:
+        return False
+    try:
+        return parsedate_to_datetime(modified) <= parsedate_to_datetime(ims)
+    except (TypeError, ValueError):
+        return False
+
+
+class ResponseCache(object):
+    """
+    Thread safe, size bounded response cache.
+    """
+
+    def __init__(self, maxsize=64*1024*1024, policy="lru", ttl=300):
+        if policy not in ("lru", "lfu"):
+            raise ValueError("Invalid cache policy %s" % str(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.vary = {}
+        # number of entries per path. vary headers are removed with the last entry.
+        self.paths = {}
+        self.size = 0
+        self.hits = self.misses = self.evictions = self.expired = self.revalidated = 0
+
+    @staticmethod
+    def fromSettings(settings):
+        options = dict(maxsize=int(settings.get("cache.maxsize") or 64*1024*1024),
+                       policy=settings.get("cache.policy") or "lru",
+                       ttl=int(settings.get("cache.ttl") or 300))
+        if settings.get("cache.store") == "disk":
+            return DiskCache(settings.get("cache.directory") or "cache", **options)
+        return ResponseCache(**options)
+
+    def lookup(self, request, url, stale=False):
+        """
+        Returns the cache entry for the request or None. If `stale` is true expired
+        entries with validators are returned too.
+        """
+        vary = self.getVary(resourceUrl(url))
+        return self.get(cacheKey(request, url, vary), stale=stale)
+
+    def store(self, request, url, body, status, headers, rtype, ttl=None):
+        """
+        Stores the response in the cache. `headers` is a list of header tuples. If `ttl` is
+        None it is calculated from the response headers, otherwise it replaces the
+        calculated time to live.
+
+        Returns the entry or None if the response is not cacheable.
+        """
+        # header names of asgi backend responses are lower case
+        hdict = ResponseHeaders(headers)
+        if not cacheable(hdict):
+            return None
+        if ttl is None:
+            ttl = responseTTL(hdict, self.ttl)
+        vary = varyHeaders(hdict)
+        self.setVary(resourceUrl(url), vary)
+        entry = CacheEntry(body, status, headers, rtype, ttl)
+        self.set(cacheKey(request, url, vary), entry)
+        return entry
+
+    def refresh(self, entry, headers, ttl=None):
+        """
+        Updates the entry with the headers of a `304 Not Modified` response and resets the
+        time to live.
+        """
+        update = dict((k.lower(), (k, v)) for k, v in headers.items() if k.lower() in UPDATE_HEADERS)
+        merged = [(k, v) for k, v in entry.headers if k.lower() not in update]
+        merged.extend(update.values())
+        if ttl is None:
+            ttl = responseTTL(ResponseHeaders(merged), self.ttl)
+        self.update(entry, merged, time.time() + (ttl or 0))
+        return entry
+
+    def update(self, entry, headers, expires):
+        """
+        Updates headers and expiry of a revalidated entry.
+        """
+        with self.lock:
+            entry.headers = headers
+            entry.expires = expires
+            entry.hits += 1
+            self.hits += 1
+            self.revalidated += 1
+
+    def getVary(self, path):
+        return self.vary.get(path, ())
+
+    def setVary(self, path, vary):
+        with self.lock:
+            if vary:
+                self.vary[path] = vary
+            else:
+                self.vary.pop(path, None)
+
+    def get(self, key, stale=False):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if not entry.fresh():
+                self.expired += 1
+                if not entry.validators():
+                    # cannot be revalidated
+                    self._drop(key)
+                    self.misses += 1
+                    return None
+                if not stale:
+                    self.misses += 1
+                    return None
+                # counted as hit on successful revalidation
+                self.entries.move_to_end(key)
+                return entry
+            self.entries.move_to_end(key)
+            entry.hits += 1
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry):
+        if entry.size > self.maxsize:
+            with self.lock:
+                path = _path(key)
+                if path not in self.paths:
+                    self.vary.pop(path, None)
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            else:
+                path = _path(key)
+                self.paths[path] = self.paths.get(path, 0) + 1
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.maxsize:
+                self._evict()
+
+    def remove(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.vary.clear()
+            self.paths.clear()
+            self.size = 0
+
+    def statistics(self):
+        with self.lock:
+            return dict(entries=len(self.entries), size=self.size, maxsize=self.maxsize,
+                        hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        expired=self.expired, revalidated=self.revalidated)
+
+    def _evict(self):
+        # removes one entry. expects the lock to be held.
+        if self.policy == "lfu":
+            # sample the least recently used entries and remove the least frequently used
+            sample = []
+            for key in self.entries:
+                sample.append(key)
+                if len(sample) == 16:
+                    break
+            key = min(sample, key=lambda k: self.entries[k].hits)
+        else:
+            key = next(iter(self.entries))
+        self._drop(key)
+        self.evictions += 1
+
+    def _drop(self, key):
+        # removes the entry and the vary headers of its path with the last entry.
+        # expects the lock to be held.
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+        path = _path(key)
+        count = self.paths.get(path, 1) - 1
+        if count > 0:
+            self.paths[path] = count
+        else:
+            self.paths.pop(path, None)
+            self.vary.pop(path, None)
+        return entry
+
+
+class DiskEntry(CacheEntry):
+    """
+    Cache entry of the disk cache. The body is stored in the file `path`. `file` is the
+    body file opened on lookup, so the body stays readable if the file is removed by
+    eviction in the meantime.
+    """
+    __slots__ = ("key", "path", "file")
+
+    def __init__(self, key, path, status, headers, rtype, created, expires, size, hits, file=None):
+        self.key = key
+        self.path = path
+        self.file = file
+        self.status = status
+        self.headers = headers
+        self.rtype = rtype
+        self.created = created
+        self.expires = expires
+        self.size = size
+        self.hits = hits
+
+    @property
+    def body(self):
+        with self.open() as f:
+            return f.read()
+
+    def open(self):
+        """
+        Returns the opened body file. The file opened on lookup is returned once.
+        """
+        f, self.file = self.file, None
+        if f is None:
+            f = open(self.path, "rb")
+        return f
+
+    def close(self):
+        f, self.file = self.file, None
+        if f is not None:
+            f.close()
+
+
+class DiskCache(ResponseCache):
+    """
+    Persistent response cache shared between processes.
+
+    The index is stored in a sqlite database, bodies are stored in content addressed
+    files (sha256). Bodies are written to a temporary file and renamed after writing,
+    index updates are transactions; a crash never leaves a partial entry.
+    Cached responses are served from the body file by `wsgi.file_wrapper`.
+
+    Hit and miss counters are per process, size and number of entries are shared.
+    """
+
+    def __init__(self, directory, maxsize=64*1024*1024, policy="lru", ttl=300):
+        ResponseCache.__init__(self, maxsize=maxsize, policy=policy, ttl=ttl)
+        self.directory = os.path.abspath(directory)
+        self.bodies = os.path.join(self.directory, "bodies")
+        os.makedirs(self.bodies, exist_ok=True)
+        self.local = threading.local()
+        db = self.db()
+        with db:
+            db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, digest TEXT, status INTEGER, "
+                       "headers TEXT, rtype TEXT, created REAL, expires REAL, size INTEGER, hits INTEGER, "
+                       "atime REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)")
+            db.execute("CREATE TABLE IF NOT EXISTS vary (path TEXT PRIMARY KEY, headers TEXT)")
+
+    def db(self):
+        """
+        Returns the index database connection of the current thread and process.
+        """
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(os.path.join(self.directory, "index.sqlite"), timeout=30,
+                                 isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
+
+    def bodyPath(self, digest):
+        return os.path.join(self.bodies, digest[:2], digest)
+
+    def get(self, key, stale=False):
+        db = self.db()
+        row = db.execute("SELECT digest, status, headers, rtype, created, expires, size, hits FROM entries "
+                         "WHERE key=?", (key,)).fetchone()
+        if row is None:
+            with self.lock:
+                self.misses += 1
+            return None
+        digest, status, headers, rtype, created, expires, size, hits = row
+        path = self.bodyPath(digest)
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            # body removed by eviction or another process
+            with db:
+                db.execute("DELETE FROM entries WHERE key=? AND digest=?", (key, digest))
+            with self.lock:
+                self.misses += 1
+            return None
+        entry = DiskEntry(key, path, status, [tuple(h) for h in json.loads(headers)],
+                          rtype, created, expires, size, hits, file=f)
+        if not entry.fresh():
+            with self.lock:
+                self.expired += 1
+                if not stale or not entry.validators():
+                    self.misses += 1
+                    f.close()
+                    return None
+            # counted as hit on successful revalidation
+            return entry
+        with self.lock:
+            self.hits += 1
+        entry.hits += 1
+        with db:
+            db.execute("UPDATE entries SET hits=hits+1, atime=? WHERE key=?", (time.time(), key))
+        return entry
+
+    def set(self, key, entry):
+        if entry.size > self.maxsize:
+            return
+        body = entry.body
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.bodyPath(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(body)
+                os.replace(tmp, path)
+            except Exception:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+        db = self.db()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            old = db.execute("SELECT digest FROM entries WHERE key=?", (key,)).fetchone()
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?,?,?,?,?,?,?,?,?,?)",
+                       (key, digest, entry.status, json.dumps(list(entry.headers)), entry.rtype,
+                        entry.created, entry.expires, entry.size, entry.hits, time.time()))
+            removed = [old[0]] if old and old[0] != digest else []
+            removed.extend(self._evict(db))
+        self._removeBodies(db, removed)
+
+    def update(self, entry, headers, expires):
+        db = self.db()
+        with db:
+            db.execute("UPDATE entries SET headers=?, expires=?, hits=hits+1, atime=? WHERE key=?",
+                       (json.dumps(list(headers)), expires, time.time(), entry.key))
+        entry.headers = headers
+        entry.expires = expires
+        entry.hits += 1
+        with self.lock:
+            self.hits += 1
+            self.revalidated += 1
+
+    def remove(self, key):
+        db = self.db()
+        with db:
+            row = db.execute("SELECT digest FROM entries WHERE key=?", (key,)).fetchone()
+            db.execute("DELETE FROM entries WHERE key=?", (key,))
+        if row:
+            self._removeBodies(db, [row[0]])
+
+    def clear(self):
+        db = self.db()
+        with db:
+            digests = [r[0] for r in db.execute("SELECT DISTINCT digest FROM entries")]
+            db.execute("DELETE FROM entries")
+            db.execute("DELETE FROM vary")
+        self._removeBodies(db, digests)
+
+    def getVary(self, path):
+        row = self.db().execute("SELECT headers FROM vary WHERE path=?", (path,)).fetchone()
+        return tuple(json.loads(row[0])) if row else ()
+
+    def setVary(self, path, vary):
+        db = self.db()
+        with db:
+            if vary:
+                db.execute("INSERT OR REPLACE INTO vary VALUES (?,?)", (path, json.dumps(vary)))
+            else:
+                db.execute("DELETE FROM vary WHERE path=?", (path,))
+
+    def statistics(self):
+        entries, size = self.db().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        with self.lock:
+            return dict(entries=entries, size=size, maxsize=self.maxsize,
+                        hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        expired=self.expired, revalidated=self.revalidated)
+
+    def _evict(self, db):
+        # removes entries until the cache size is below maxsize. expects a running transaction.
+        # returns the digests of removed entries.
+        size = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if size <= self.maxsize:
+            return []
+        order = "hits, atime" if self.policy == "lfu" else "atime"
+        removed = []
+        for key, digest, esize in db.execute("SELECT key, digest, size FROM entries ORDER BY %s" % order).fetchall():
+            db.execute("DELETE FROM entries WHERE key=?", (key,))
+            removed.append(digest)
+            size -= esize
+            with self.lock:
+                self.evictions += 1
+            if size <= self.maxsize:
+                break
+        return removed
+
+    def _removeBodies(self, db, digests):
+        # removes body files not referenced by any entry
+        for digest in set(digests):
+            if db.execute("SELECT 1 FROM entries WHERE digest=? LIMIT 1", (digest,)).fetchone():
+                continue
+            try:
+                os.remove(self.bodyPath(digest))
+            except OSError:
+                pass
@@ -0,0 +1,341 @@
+# Copyright 2015 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under BSD-license. See license.txt
+#
+"""
+Response compression
+--------------------
+Content negotiation and compression for file and proxy responses. `gzip` and `deflate`
+are always available, `br` and `zstd` if the `brotli` or `zstandard` packages are
+installed.
+
+Proxy responses are compressed by the `outpost.filterinc.compress` filter. Buffered
+responses with an ETag are compressed once and the compressed variant is stored in the
+variant cache keyed by ETag and encoding. Streamed responses are compressed chunk-wise.
+
+The file server sends precompressed files (e.g. `app.js.gz`, `app.js.br`) if the
+encoding is listed in `files.precompressed` and accepted by the client.
+
+Settings ::
+
+    compress.encodings = br gzip deflate    accepted encodings in order of preference
+    compress.level = 6                      compression level
+    compress.minsize = 256                  min. body size in bytes
+    compress.cache = 16777216               variant cache size in bytes. 0 disables the cache
+    files.precompressed = br gzip           precompressed file encodings. Disabled by default
+"""
+import threading
+import zlib
+from collections import OrderedDict
+
+from outpost.cache import resourceUrl
+from outpost.filtermanager import FilterIter
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# file extension of precompressed files
+EXTENSIONS = {"gzip": ".gz", "br": ".br", "zstd": ".zst"}
+
+COMPRESSIBLE_TYPES = ("application/json", "application/javascript", "application/xml",
+                      "application/xhtml+xml", "application/rss+xml", "application/atom+xml",
+                      "application/ld+json", "application/manifest+json", "image/svg+xml")
+
+
+def available():
+    """
+    Returns the supported encodings in default order of preference.
+    """
+    encodings = []
+    if brotli is not None:
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    encodings.extend(("gzip", "deflate"))
+    return tuple(encodings)
+
+
+def parseAcceptEncoding(header):
+    """
+    Parses the Accept-Encoding header.
+
+    :return: dict encoding: quality
+    """
+    accepted = {}
+    for part in (header or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, params = part.partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip().lower()] = q
+    return accepted
+
+
+def negotiate(header, encodings):
+    """
+    Selects the encoding for the response.
+
+    :param header: Accept-Encoding request header
+    :param encodings: encodings in order of server preference
+    :return: encoding or None for identity
+    """
+    if not header:
+        return None
+    accepted = parseAcceptEncoding(header)
+    best, quality = None, 0.0
+    for name in encodings:
+        q = accepted.get(name, accepted.get("x-gzip") if name == "gzip" else None)
+        if q is None:
+            q = accepted.get("*", 0.0)
+        if q > quality:
+            best, quality = name, q
+    return best
+
+
+def compressible(response, minsize=0):
+    """
+    Checks if the response is worth compressing: successful, not already encoded, text
+    content type and not smaller than `minsize` if the length is known.
+    """
+    if response.status_int != 200 or response.content_encoding:
+        return False
+    ct = response.content_type or ""
+    if not (ct.startswith("text/") or ct in COMPRESSIBLE_TYPES):
+        return False
+    if response.headers.get("Cache-Control", "").find("no-transform") != -1:
+        return False
+    length = response.content_length
+    if length is not None and length < minsize:
+        return False
+    return True
+
+
+class Compressor(object):
+    """
+    Incremental compressor. Call `compress()` for each chunk and `flush()` at the end.
+    """
+
+    def __init__(self, encoding, level=6):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self.obj = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            # http deflate is the zlib format
+            self.obj = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+        elif encoding == "br" and brotli is not None:
+            self.obj = brotli.Compressor(quality=min(level, 11))
+        elif encoding == "zstd" and zstandard is not None:
+            self.obj = zstandard.ZstdCompressor(level=level).compressobj()
+        else:
+            raise ValueError("Unsupported encoding %s" % encoding)
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self.obj.process(data)
+        return self.obj.compress(data)
+
+    def flush(self):
+        if self.encoding == "br":
+            return self.obj.finish()
+        return self.obj.flush()
+
+
+def compressBody(body, encoding, level=6):
+    c = Compressor(encoding, level)
+    return c.compress(body) + c.flush()
+
+
+def compressIter(chunks, encoding, level=6):
+    """
+    Compresses the body iterator chunk-wise. Empty compressor output is not yielded.
+    """
+    c = Compressor(encoding, level)
+    for chunk in chunks:
+        data = c.compress(chunk)
+        if data:
+            yield data
+    yield c.flush()
+
+
+def decompress(body, encoding):
+    """
+    Decodes the body. `encoding` is the Content-Encoding header value, multiple
+    encodings are removed in reverse order.
+    """
+    for name in reversed([e.strip().lower() for e in (encoding or "").split(",")]):
+        if name in ("gzip", "x-gzip"):
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        elif name == "deflate":
+            try:
+                body = zlib.decompress(body)
+            except zlib.error:
+                # raw deflate stream without zlib header
+                body = zlib.decompress(body, -zlib.MAX_WBITS)
+        elif name == "br" and brotli is not None:
+            body = brotli.decompress(body)
+        elif name == "zstd" and zstandard is not None:
+            body = zstandard.ZstdDecompressor().decompressobj().decompress(body)
+        elif name not in ("", "identity"):
+            raise ValueError("Unsupported encoding %s" % name)
+    return body
+
+
+def acceptDecodable(header):
+    """
+    Removes encodings from the Accept-Encoding header which cannot be decoded.
+    """
+    supported = available() + ("x-gzip", "identity")
+    parts = [p.strip() for p in (header or "").split(",")]
+    return ", ".join(p for p in parts if p and p.split(";")[0].strip().lower() in supported)
+
+
+class VariantCache(object):
+    """
+    Bounded cache for compressed response bodies keyed by url, ETag and encoding. The
+    url is part of the key because backends may use the same ETag for different
+    resources (e.g. generated from mtime and size). Least recently used variants are
+    removed if the size exceeds `maxsize` bytes.
+    """
+
+    def __init__(self, maxsize=16*1024*1024):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, url, etag, encoding):
+        key = (url, etag, encoding)
+        with self.lock:
+            body = self.entries.get(key)
+            if body is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def set(self, url, etag, encoding, body):
+        if len(body) > self.maxsize:
+            return
+        key = (url, etag, encoding)
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.entries[key] = body
+            self.size += len(body)
+            while self.size > self.maxsize:
+                _, old = self.entries.popitem(last=False)
+                self.size -= len(old)
+
+    def statistics(self):
+        with self.lock:
+            return dict(entries=len(self.entries), size=self.size, maxsize=self.maxsize,
+                        hits=self.hits, misses=self.misses)
+
+
+__lock__ = threading.Lock()
+
+
+def getVariantCache(settings):
+    """
+    Returns the variant cache stored as `compress.variants` in settings or None if
+    disabled. The cache is created on first use.
+    """
+    variants = settings.get("compress.variants")
+    if variants is not None:
+        return variants or None
+    with __lock__:
+        variants = settings.get("compress.variants")
+        if variants is None:
+            maxsize = settings.get("compress.cache")
+            maxsize = int(maxsize) if maxsize is not None else 16*1024*1024
+            variants = settings["compress.variants"] = VariantCache(maxsize) if maxsize else False
+    return variants or None
+
+
+def encodings(settings, override=None):
+    """
+    Returns the configured and available encodings in order of preference.
+    """
+    names = override or settings.get("compress.encodings")
+    if not names:
+        return available()
+    if isinstance(names, str):
+        names = names.replace(",", " ").split()
+    supported = available()
+    return tuple(n for n in names if n in supported)
+
+
+def addVary(response, name="Accept-Encoding"):
+    vary = response.vary or ()
+    if name.lower() not in [v.lower() for v in vary]:
+        response.vary = tuple(vary) + (name,)
+
+
+def weakETag(response):
+    # the compressed body differs from the identity body
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        response.headers["ETag"] = "W/" + etag
+
+
+def compressResponse(response, request, settings, options=None, url=None):
+    """
+    Compresses the response body with the best encoding accepted by the client.
+    Buffered bodies of responses with an ETag are cached as compressed variant. Other
+    bodies are compressed chunk-wise without reading the body first.
+
+    :param options: dict with optional `encodings`, `level` and `minsize` overriding the
+                    settings
+    :param url: url handler of the resource. the variant key uses its resource url
+                (see `cache.resourceUrl`) or the request url if None.
+    :return: response
+    """
+    options = options or {}
+    level = int(options.get("level") or settings.get("compress.level") or 6)
+    minsize = int(options.get("minsize") or settings.get("compress.minsize") or 256)
+    if not compressible(response, minsize):
+        return response
+    addVary(response)
+    encoding = negotiate(request.headers.get("Accept-Encoding"), encodings(settings, options.get("encodings")))
+    if encoding is None:
+        return response
+
+    app_iter = response.app_iter
+    if isinstance(app_iter, (list, tuple)):
+        body = b"".join(app_iter)
+        if len(body) < minsize:
+            return response
+        etag = response.headers.get("ETag")
+        variants = getVariantCache(settings) if etag else None
+        data = None
+        if variants is not None:
+            key = resourceUrl(url) if url is not None else request.url
+            data = variants.get(key, etag, encoding)
+        if data is None:
+            data = compressBody(body, encoding, level)
+            if variants is not None:
+                variants.set(key, etag, encoding, data)
+        response.body = data
+    else:
+        response.app_iter = FilterIter(compressIter(app_iter, encoding, level), app_iter)
+        response.content_length = None
+    response.content_encoding = encoding
+    weakETag(response)
+    return response
@@ -1,16 +1,52 @@
 # Copyright 2015 Arndt Droullier, Nive GmbH. All rights reserved.
 # Released under BSD-license. See license.txt
 #
+"""
+File server
+-----------
+The static view and the file index are created once by `server.setup()` and stored as
+`files.static` and `files.index` in the settings.
+
+The file index stores size, modification time, content type and etag of served files.
+Index entries are checked with `os.stat` if older than `files.index.check` seconds
+(default 2, 0 in debug mode). Files found in the index are sent without further file
+system lookups using `wsgi.file_wrapper`. Directories, missing and invalid paths are
+handled by pyramid's static view.
+
+Small indexed files can be kept in memory by the asset cache (`files.cache`). Cached
+files are invalidated if the index entry changes.
+
+Precompressed files (e.g. `app.js.gz`) are sent for the encodings listed in
+`files.precompressed` if accepted by the client, not older than the original file and
+no post filter requires the uncompressed body. See `outpost.compress`.
+
+Settings ::
+
+    files.index = true          enable the file index
+    files.index.check = 2       seconds before index entries are checked again
+    files.cache.size = 0        asset cache size in bytes. 0 disables the cache
+    files.cache.threshold = 262144  max. file size stored in the asset cache
+    files.cache.stats = /__cache  path of the asset cache statistics view (json)
+    files.precompressed = br gzip   encodings of precompressed files. Requires the index
+"""
 import logging
+import os
 import pdb
 import re
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate
 from mimetypes import guess_type
 
+from pyramid.response import Response, FileIter
+from pyramid.settings import asbool
 from pyramid.static import static_view
 
 from zope.interface import alsoProvides
 
 from outpost import filtermanager
+from outpost import compress
 
 __ct_cache__ = {}
 
@@ -23,6 +59,282 @@ def serveFile(context, request):
     return server.response()
 
 
+def defaultFile(settings):
+    df = settings.get("server.default_path")
+    # bw 0.2.6
+    if df is None:
+        df = settings.get("server.defaultfile")
+    return df
+
+
+def contentType(name, settings):
+    """
+    Returns the content type for the file name. Falls back to `server.content_type`.
+    """
+    global __ct_cache__
+    ext = ".".join(name.split(".")[1:])
+    if ext in __ct_cache__:
+        return __ct_cache__[ext]
+    ct = guess_type(name, strict=False)[0] or settings.get("server.content_type")
+    __ct_cache__[ext] = ct
+    return ct
+
+
+def staticView(settings):
+    """
+    Creates the pyramid static view for `files.directory`.
+    """
+    df = defaultFile(settings)
+    if df:
+        # the index is joined to the directory path
+        return static_view(root_dir=settings["files.directory"],
+                           use_subpath=True,
+                           index=df.lstrip("/"))
+    return static_view(root_dir=settings["files.directory"],
+                       use_subpath=True)
+
+
+class FileInfo(object):
+    """
+    File index entry
+    """
+    __slots__ = ("path", "size", "mtime", "content_type", "etag", "checked", "encoding")
+
+    def __init__(self, path, stat, content_type, encoding=None):
+        self.path = path
+        self.content_type = content_type
+        self.encoding = encoding
+        self.update(stat)
+
+    def update(self, stat):
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.etag = "%x-%x" % (stat.st_mtime_ns, stat.st_size)
+        self.checked = time.time()
+
+
+class FileIndex(object):
+    """
+    Index of served files. Maps request subpaths to `FileInfo` entries. Entries are
+    added on first request and checked with `os.stat` after `check` seconds.
+    """
+
+    def __init__(self, directory, settings, check=2):
+        self.directory = os.path.abspath(directory)
+        self.settings = settings
+        self.check = check
+        self.default = (defaultFile(settings) or "").lstrip("/")
+        encodings = settings.get("files.precompressed") or ()
+        if isinstance(encodings, str):
+            encodings = encodings.replace(",", " ").split()
+        self.encodings = tuple(e for e in encodings if e in compress.EXTENSIONS)
+        self.entries = {}
+        # missing precompressed files
+        self.missing = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fromSettings(settings):
+        if not asbool(settings.get("files.index", True)):
+            return None
+        check = settings.get("files.index.check")
+        if check is None:
+            check = 0 if asbool(settings.get("debug")) else 2
+        return FileIndex(settings["files.directory"], settings, check=float(check))
+
+    def lookup(self, subpath, directory=False, encoding=None):
+        """
+        Returns the `FileInfo` for the request subpath or None if the file does not exist
+        or cannot be handled by the index.
+
+        :param subpath: tuple of path segments
+        :param directory: the request path ends with a slash
+        :param encoding: lookup the precompressed file for the encoding
+        """
+        key = (subpath, directory, encoding)
+        info = self.entries.get(key)
+        if info is not None:
+            if time.time() - info.checked < self.check:
+                return info
+            try:
+                stat = os.stat(info.path)
+            except OSError:
+                self.remove(key)
+                return None
+            if stat.st_mtime != info.mtime or stat.st_size != info.size:
+                info.update(stat)
+            else:
+                info.checked = time.time()
+            return info
+        if encoding is not None and time.time() - self.missing.get(key, 0) < self.check:
+            return None
+        path = self.resolve(subpath, directory)
+        if path is None:
+            return None
+        name = os.path.basename(path)
+        if encoding is not None:
+            path += compress.EXTENSIONS[encoding]
+        try:
+            stat = os.stat(path)
+        except OSError:
+            if encoding is not None:
+                self.missing[key] = time.time()
+            return None
+        if not os.path.isfile(path):
+            return None
+        info = FileInfo(path, stat, contentType(name, self.settings), encoding)
+        with self.lock:
+            self.entries[key] = info
+            self.missing.pop(key, None)
+        return info
+
+    def variant(self, info, subpath, directory, accept):
+        """
+        Returns the precompressed file for the best encoding accepted by the client or
+        None. Precompressed files older than the original file are ignored.
+
+        :param info: `FileInfo` of the original file
+        :param accept: Accept-Encoding request header
+        """
+        if not self.encodings or not accept:
+            return None
+        found = {}
+        for encoding in self.encodings:
+            v = self.lookup(subpath, directory, encoding)
+            if v is not None and v.mtime >= info.mtime:
+                found[encoding] = v
+        if not found:
+            return None
+        return found.get(compress.negotiate(accept, [e for e in self.encodings if e in found]))
+
+    def resolve(self, subpath, directory=False):
+        """
+        Returns the file system path for the subpath. Returns None for invalid paths and
+        directories.
+        """
+        for segment in subpath:
+            if segment in ("", ".", "..") or "/" in segment or "\\" in segment or "\0" in segment:
+                return None
+        path = os.path.join(self.directory, *subpath)
+        if not subpath or directory:
+            if not self.default or not os.path.isdir(path):
+                return None
+            path = os.path.join(path, self.default)
+        return path
+
+    def remove(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.missing.clear()
+
+    def response(self, info, request, cache_max_age=3600):
+        """
+        Creates the file response for the index entry.
+        """
+        f = open(info.path, "rb")
+        wrapper = request.environ.get("wsgi.file_wrapper", FileIter)
+        response = Response(conditional_response=True)
+        response.app_iter = wrapper(f, 64*1024)
+        response.content_length = info.size
+        response.last_modified = info.mtime
+        response.etag = info.etag
+        response.cache_expires = cache_max_age
+        return response
+
+
+class AssetCache(object):
+    """
+    Bounded in-memory cache for small files. Stores the file body and the precomputed
+    response headers. Least recently used files are removed if the cache size exceeds
+    `maxsize` bytes. Entries are invalidated if size or modification time of the file
+    index entry changes.
+    """
+
+    def __init__(self, maxsize=16*1024*1024, threshold=256*1024):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    @staticmethod
+    def fromSettings(settings):
+        maxsize = int(settings.get("files.cache.size") or 0)
+        if not maxsize:
+            return None
+        return AssetCache(maxsize=maxsize,
+                          threshold=int(settings.get("files.cache.threshold") or 256*1024))
+
+    def response(self, info, request, cache_max_age=3600):
+        """
+        Creates the file response for the index entry from memory. Files larger than
+        `threshold` are not cached.
+        """
+        entry = self.get(info)
+        if entry is None:
+            with open(info.path, "rb") as f:
+                body = f.read()
+            headers = [("Content-Length", str(len(body))),
+                       ("Last-Modified", formatdate(info.mtime, usegmt=True)),
+                       ("ETag", '"%s"' % info.etag)]
+            entry = (body, headers, info.mtime, info.size)
+            if len(body) == info.size:
+                self.set(info.path, entry)
+        body, headers = entry[0], entry[1]
+        response = Response(app_iter=[body], headerlist=list(headers), conditional_response=True)
+        response.cache_expires = cache_max_age
+        return response
+
+    def get(self, info):
+        with self.lock:
+            entry = self.entries.get(info.path)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[2] != info.mtime or entry[3] != info.size:
+                # file changed
+                self._remove(info.path)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(info.path)
+            self.hits += 1
+            return entry
+
+    def set(self, path, entry):
+        size = len(entry[0])
+        if size > self.threshold or size > self.maxsize:
+            return
+        with self.lock:
+            self._remove(path)
+            self.entries[path] = entry
+            self.size += size
+            while self.size > self.maxsize:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def statistics(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return dict(entries=len(self.entries), size=self.size, maxsize=self.maxsize,
+                        hits=self.hits, misses=self.misses, evictions=self.evictions,
+                        ratio=float(self.hits)/requests if requests else 0.0)
+
+    def _remove(self, path):
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.size -= len(entry[0])
+
+
 class FileServer(object):
     """
     The file server handles local file serving based on the directory setting.
@@ -48,40 +360,46 @@ class FileServer(object):
             return e.response
 
         if file is None:
-            df = settings.get("server.default_path")
-            # bw 0.2.6
-            if df is None:
-                df = settings.get("server.defaultfile")
-            if df:
-                static = static_view(root_dir=settings["files.directory"],
-                                     use_subpath=True,
-                                     index=df)
+            index = settings.get("files.index")
+            info = None
+            if isinstance(index, FileIndex):
+                info = index.lookup(tuple(self.request.subpath), self.request.path_info.endswith("/"))
+            if info is not None:
+                # indexed file: no static view and file system lookups
+                variant = index.variant(info, tuple(self.request.subpath), self.request.path_info.endswith("/"),
+                                        self.request.headers.get("Accept-Encoding"))
+                if variant is not None and self.bodyFiltered(info.content_type):
+                    variant = None
+                target = variant or info
+                assets = settings.get("files.cache")
+                if isinstance(assets, AssetCache) and target.size <= assets.threshold:
+                    file = assets.response(target, self.request)
+                else:
+                    file = index.response(target, self.request)
+                if variant is not None:
+                    file.content_encoding = variant.encoding
+                if index.encodings:
+                    compress.addVary(file)
+                ct = info.content_type
             else:
-                static = static_view(root_dir=settings["files.directory"],
-                                     use_subpath=True)
-            file = static(self.context, self.request)
-            alsoProvides(file, filtermanager.IFileRequest)
-
-            # adjust headers
-            #file.headers["Cache-control"] = "no-cache"
-            #file.headers["Pragma"] = "no-cache"
-            #file.headers["Expires"] = "0"
-            #if "Last-Modified" in file.headers:
-            #    del file.headers["Last-Modified"]
-            # set default mime type to text/html
-            if len(self.request.subpath):
-                name = self.request.subpath[-1]
-            else:
-                name = df
+                static = settings.get("files.static")
+                if static is None:
+                    static = staticView(settings)
+                file = static(self.context, self.request)
 
-            # cache content type
-            global __ct_cache__
-            ext = ".".join(name.split(".")[1:])
-            if ext in __ct_cache__:
-                ct = __ct_cache__[ext]
-            else:
-                ct = guess_type(name, strict=False)[0] or settings.get("server.content_type")
-                __ct_cache__[ext] = ct
+                # adjust headers
+                #file.headers["Cache-control"] = "no-cache"
+                #file.headers["Pragma"] = "no-cache"
+                #file.headers["Expires"] = "0"
+                #if "Last-Modified" in file.headers:
+                #    del file.headers["Last-Modified"]
+                # set default mime type to text/html
+                if len(self.request.subpath):
+                    name = self.request.subpath[-1]
+                else:
+                    name = defaultFile(settings) or ""
+                ct = contentType(name, settings)
+            alsoProvides(file, filtermanager.IFileRequest)
 
             file.headers["Content-Type"] = ct
             file.content_type = ct
@@ -99,6 +417,19 @@ class FileServer(object):
         # run post file server hooked filters
         file = filtermanager.runPostHook(file, self.request, self.url) #=> Ready to filter and return the current file. Step once (n) to apply filters.
         return file
+
+    def bodyFiltered(self, content_type):
+        """
+        Checks if a post filter requires the uncompressed file body. Filters handling
+        encoded bodies set the `encoded` attribute.
+        """
+        response = filtermanager.EmptyFileResponse()
+        response.content_type = content_type
+        for ff in filtermanager.lookupBodyFilters("post", response, self.request, self.url,
+                                                  modes=("body", "stream")):
+            if not getattr(ff.callable, "encoded", False):
+                return True
+        return False
         
 
 
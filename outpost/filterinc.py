@@ -2,17 +2,24 @@
 # Released under BSD-license. See license.txt
 #
 import os
-import gzip
 import logging
 import re
+import time
+import uuid
+
+import requests
+import urllib3
 
-from io import StringIO
 from zope.interface import alsoProvides
-from pyramid.renderers import render
-from pyramid.response import Response
+from pyramid.renderers import RendererHelper
+from pyramid.response import Response, FileIter
 from pyramid.httpexceptions import HTTPFound
+from pyramid.settings import asbool
 
+from outpost import cache
+from outpost import compress as compressor
 from outpost import filtermanager
+from outpost.proxy import Proxy
 
 def template(response, request, filterconf, url):
     """
@@ -29,10 +36,21 @@ def template(response, request, filterconf, url):
     The template is called with `content` and `response` attributes in the templates
     namespace. Also the original request is passed as `request`.
 
+    The template path is resolved when the filter configuration is loaded and the
+    renderer is reused for all requests. In debug mode the renderer is looked up for
+    each request and templates are reloaded if changed (`pyramid.reload_templates`).
+
+    If `splice` is true the template is rendered with a placeholder as `content` and
+    the encoded response body is inserted unescaped at the placeholders position. This saves
+    decoding and encoding the body. The template must insert `content` exactly once
+    and must not alter it. Otherwise the filter falls back to rendering the decoded
+    body.
+
     Settings ::
 
         template: the template path
         values: additional values passed to the templates namespace
+        splice: insert the encoded body into the rendered template. default false
 
     Example ini file section ::
 
@@ -49,7 +67,34 @@ def template(response, request, filterconf, url):
     tmpl = filterconf.settings.get("template")
     if not tmpl:
         return response
-    # extend relative path
+    renderer = getattr(filterconf, "renderer", None)
+    if renderer is None or renderer.registry is not request.registry:
+        renderer = RendererHelper(name=getattr(filterconf, "template", None) or templatePath(tmpl),
+                                  registry=request.registry)
+        if not asbool(request.registry.settings.get("debug")):
+            filterconf.renderer = renderer
+    values = {"response": response}
+    v2 = filterconf.settings.get("values")
+    if v2 and isinstance(v2, dict):
+        values.update(v2)
+    charset = response.charset or "utf-8"
+    if filterconf.settings.get("splice"):
+        # render the template with a placeholder and splice the encoded body
+        values["content"] = SPLICE_MARKER
+        result = renderer.render(values, None, request=request).encode(charset)
+        parts = result.split(SPLICE_MARKER.encode(charset))
+        if len(parts) == 2:
+            response.body = parts[0] + response.body + parts[1]
+            return response
+    values["content"] = response.text
+    response.text = renderer.render(values, None, request=request)
+    return response
+
+
+def templatePath(tmpl):
+    """
+    Extends relative template paths based on the current working directory.
+    """
     wd = os.getcwd()+os.sep
     if tmpl.startswith("."+os.sep):
         tmpl = wd + tmpl[2:]
@@ -58,14 +103,20 @@ def template(response, request, filterconf, url):
         tmpl = os.path.normpath(tmpl)
     elif tmpl.find(":") == -1 and not tmpl.startswith(os.sep):
         tmpl = wd + tmpl
-    if not tmpl:
-        return response
-    values = {"content": response.text, "response": response}
-    v2 = filterconf.settings.get("values")
-    if v2 and isinstance(v2, dict):
-        values.update(v2)
-    response.text = render(tmpl, values, request=request)
-    return response
+    return tmpl
+
+
+def _setupTemplate(filterconf):
+    # resolves the template path. called by `FilterConf.fromDict()`.
+    tmpl = (filterconf.settings or {}).get("template")
+    if tmpl:
+        filterconf.template = templatePath(tmpl)
+    filterconf.renderer = None
+
+template.setup = _setupTemplate
+
+# placeholder for the response body in splice mode. no characters escaped by templates.
+SPLICE_MARKER = "outpost0splice0" + uuid.uuid4().hex
 
 
 def replacestr(response, request, filterconf, url):
@@ -76,10 +127,23 @@ def replacestr(response, request, filterconf, url):
 
     Settings
 
-    replacestr: one or a list of strings to be replaced ::
+    replacestr: one or a list of strings to be replaced. `str` is a regular expression
+    unless `literal` is true. If `literal` is not set, strings without regular expression
+    syntax are replaced as literals. Set `literal` for urls and host names, otherwise `.`
+    matches any character ::
 
         {"str": "old", "new": "new"}
 
+        {"replace": [{"str": "old", "new": "new"},
+                     {"str": "www.nive.io", "new": "nive.io", "literal": true}]}
+
+    The replacements are compiled once when the filter configuration is loaded and
+    applied in a single pass over the body. If all strings are literals the body is
+    processed as bytes without decoding.
+
+    In `stream` mode the body is processed chunk-wise. Matches crossing chunk boundaries
+    are replaced as long as they are not longer than `window` bytes (default 1024).
+
     Example ini file section ::
 
         filter = [
@@ -94,12 +158,148 @@ def replacestr(response, request, filterconf, url):
     settings = filterconf.settings
     if not settings:
         return response
+    replacer = getattr(filterconf, "replacer", None)
+    if replacer is None:
+        replacer = _setupReplacestr(filterconf)
+    if not replacer.replacements:
+        return response
+    charset = response.charset or "utf-8"
+    if filterconf.mode == "stream":
+        pattern, new = replacer.bytesPattern(charset)
+        window = settings.get("window") or max(1024, replacer.maxlength)
+        return filtermanager.streamFilter(response, ChunkReplacer(pattern, new, window))
     # process
-    response.unicode_body = re.sub(settings["str"], settings["new"], response.unicode_body)
-    #response.unicode_body = response.unicode_body.replace(settings["str"], settings["new"])
+    if replacer.literal:
+        response.body = replacer.replaceBytes(response.body, charset)
+    else:
+        response.unicode_body = replacer.replaceText(response.unicode_body)
     return response
 
 
+def _setupReplacestr(filterconf):
+    # compiles the replacements. called by `FilterConf.fromDict()`.
+    filterconf.replacer = Replacer.fromSettings(filterconf.settings or {})
+    return filterconf.replacer
+
+replacestr.setup = _setupReplacestr
+
+
+class Replacer(object):
+    """
+    Compiled list of string replacements. All replacements are combined in a single
+    regular expression and applied in one pass. Literal strings are matched longest
+    first, so overlapping literals behave like a multi pattern matcher.
+
+    If all strings are literals the replacements can be applied to the encoded body
+    (`replaceBytes`). Otherwise the decoded body is processed (`replaceText`).
+    """
+
+    def __init__(self, replacements):
+        """
+        :param replacements: list of (str, new, literal) tuples
+        """
+        self.replacements = [(old, new, literal) for old, new, literal in replacements if old]
+        self.literal = all(literal for old, new, literal in self.replacements)
+        self.maxlength = max([len(old) for old, new, literal in self.replacements] or [0])
+        self.compiled = [re.compile(re.escape(old) if literal else old)
+                         for old, new, literal in self.replacements]
+        # replacement templates with group references of the combined pattern
+        self.templates = [new for old, new, literal in self.replacements]
+        if len(self.replacements) == 1:
+            self.pattern = self.compiled[0]
+        else:
+            order = sorted(range(len(self.replacements)), key=lambda i: -len(self.replacements[i][0])
+                           if self.replacements[i][2] else 0)
+            self.pattern = re.compile("|".join("(?P<_r%d>%s)" % (i, self.compiled[i].pattern) for i in order))
+            base = 1
+            for i in order:
+                if not self.replacements[i][2]:
+                    self.templates[i] = _shiftGroups(self.replacements[i][1], base)
+                base += self.compiled[i].groups + 1
+        self._bytes = {}
+
+    @staticmethod
+    def fromSettings(settings):
+        items = settings.get("replace")
+        if items is None:
+            items = [settings] if settings.get("str") else []
+        replacements = []
+        for item in items:
+            old, new = item.get("str") or "", item.get("new") or ""
+            literal = item.get("literal")
+            if literal is None:
+                # plain strings without regular expression syntax
+                literal = not REGEX_SYNTAX.search(old) and "\\" not in new
+            replacements.append((old, new, bool(literal)))
+        return Replacer(replacements)
+
+    def replaceText(self, text):
+        if len(self.replacements) == 1 and not self.replacements[0][2]:
+            return self.pattern.sub(self.replacements[0][1], text)
+        return self.pattern.sub(self._expand, text)
+
+    def replaceBytes(self, body, charset):
+        if len(self.replacements) == 1:
+            old, new, literal = self.replacements[0]
+            return body.replace(old.encode(charset), new.encode(charset))
+        pattern, new = self.bytesPattern(charset)
+        return pattern.sub(new, body)
+
+    def bytesPattern(self, charset):
+        """
+        Returns the combined bytes pattern and replacement (template or callable) for
+        the charset.
+        """
+        compiled = self._bytes.get(charset)
+        if compiled is not None:
+            return compiled
+        if len(self.replacements) == 1:
+            old, new, literal = self.replacements[0]
+            new = new.encode(charset)
+            if literal:
+                new = new.replace(b"\\", b"\\\\")
+            compiled = (re.compile(self.compiled[0].pattern.encode(charset)), new)
+        elif self.literal:
+            # plain alternation of all literals, longest first
+            table = dict((old.encode(charset), new.encode(charset)) for old, new, literal in self.replacements)
+            pattern = b"|".join(re.escape(old) for old in sorted(table, key=len, reverse=True))
+            compiled = (re.compile(pattern), lambda m: table[m.group()])
+        else:
+            pieces = [(new.encode(charset), literal)
+                      for new, (old, n, literal) in zip(self.templates, self.replacements)]
+
+            def expand(m):
+                new, literal = pieces[int(m.lastgroup[2:])]
+                if literal:
+                    return new
+                return m.expand(new)
+            compiled = (re.compile(self.pattern.pattern.encode(charset)), expand)
+        self._bytes[charset] = compiled
+        return compiled
+
+    def _expand(self, m):
+        # expands the replacement from the combined match, so lookarounds keep their context
+        i = int(m.lastgroup[2:])
+        if self.replacements[i][2]:
+            return self.replacements[i][1]
+        return m.expand(self.templates[i])
+
+
+# regular expression metacharacters
+REGEX_SYNTAX = re.compile(r"[\\^$.*+?{}\[\]|()]")
+GROUP_REFERENCE = re.compile(r"\\(?:(\\)|g<(\d+)>|([1-9][0-9]?))")
+
+
+def _shiftGroups(template, base):
+    # converts numbered group references of a single pattern to the group numbers of
+    # the alternative starting at group `base` in the combined pattern
+    def shift(m):
+        if m.group(1):
+            return m.group()
+        return "\\g<%d>" % (base + int(m.group(2) or m.group(3)))
+    return GROUP_REFERENCE.sub(shift, template)
+
+
 def rewrite_urls(response, request, filterconf, url):
     """
     Rewirite proxied urls
@@ -116,19 +316,89 @@ def rewrite_urls(response, request, filterconf, url):
            "name": "rewrite_urls"}
           ]
 
+    Set `"mode": "stream"` to rewrite urls chunk-wise.
     """
     if not url:
         return response
+    if filterconf.mode == "stream":
+        charset = response.charset or "utf-8"
+        old = url.destDomain.encode(charset)
+        replacer = ChunkReplacer(re.compile(re.escape(old)),
+                                 url.srcDomain.encode(charset).replace(b"\\", b"\\\\"),
+                                 len(old))
+        return filtermanager.streamFilter(response, replacer)
     # rewrite urls
     response.unicode_body = url.rewriteUrls(response.unicode_body)
     return response
 
 
+class ChunkReplacer(object):
+    """
+    Search and replace a bytes regular expression in a chunked body. Used by `stream`
+    mode filters.
+
+    The last `window` bytes of each chunk are held back and processed with the next chunk,
+    so matches up to `window` bytes crossing chunk boundaries are replaced. Matches
+    ending at the end of the buffer are held back, since variable length patterns may
+    continue in the next chunk. `new` is expanded like the replacement in `re.sub()` or
+    called with the match if it is a callable.
+    """
+
+    def __init__(self, pattern, new, window):
+        self.pattern = pattern
+        self.new = new
+        self.window = window
+        # replacement without group references
+        self.literal = isinstance(new, bytes) and new.find(b"\\") == -1
+
+    def __call__(self, chunks):
+        pending = b""
+        for chunk in chunks:
+            if not chunk:
+                continue
+            buf = pending + chunk
+            data, pending = self.replace(buf, len(buf)-self.window, final=False)
+            if data:
+                yield data
+        if pending:
+            data, pending = self.replace(pending, len(pending))
+            yield data
+
+    def replace(self, buf, safe, final=True):
+        # replaces all matches starting before `safe` and returns the processed data
+        # and the remaining bytes
+        out = []
+        pos = 0
+        end = None
+        for m in self.pattern.finditer(buf):
+            if m.start() > safe:
+                break
+            if not final and m.end() == len(buf):
+                # the match may continue in the next chunk
+                end = m.start()
+                break
+            out.append(buf[pos:m.start()])
+            if self.literal:
+                out.append(self.new)
+            else:
+                out.append(self.new(m) if callable(self.new) else m.expand(self.new))
+            pos = m.end()
+        if end is None:
+            end = max(pos, safe)
+        out.append(buf[pos:end])
+        return b"".join(out), buf[end:]
+
+
 def compress(response, request, filterconf, url):
     """
     Compress response body
     ----------------------
-    Compress the resposne with gzip on the fly.
+    Compress the response with the best encoding accepted by the client (br, zstd,
+    gzip or deflate). Streamed responses are compressed chunk-wise, buffered
+    responses with an ETag are compressed once and cached. See `outpost.compress`.
+
+    Optional settings: `encodings` list of encodings, `level` compression level,
+    `minsize` min. body size.
 
     Example ini file section ::
 
@@ -136,24 +406,17 @@ def compress(response, request, filterconf, url):
           {"callable": "outpost.filterinc.compress",
            "apply_to": "proxy",
            "content_type": "text/",
-           "settings": {},
+           "settings": {"encodings": ["br", "gzip"]},
            "name": "compress"}
           ]
 
     """
-    response.content_encoding = "gzip"
-    response.accept_ranges = "bytes"
-    response.content_length = len(response.body)
-    # compress
-    zipped = StringIO()
-    gz = gzip.GzipFile(fileobj=zipped, mode="wb")
-    gz.write(response.body)
-    gz.close()
+    return compressor.compressResponse(response, request, request.registry.settings,
+                                       filterconf.settings, url=url)
 
-    zipped.seek(0)
-    response.body = zipped.read()
-    zipped.close()
-    return response
+compress.filtermode = "stream"
+# encoded responses are not changed
+compress.encoded = True
 
 
 def add_header(response, request, filterconf, url):
@@ -182,6 +445,8 @@ def add_header(response, request, filterconf, url):
         response.headers[name] = value
     return response
 
+add_header.filtermode = "headers"
+
 
 def redirect(response, request, filterconf, url):
     """
@@ -204,14 +469,16 @@ def redirect(response, request, filterconf, url):
     url = filterconf.settings.get("url") or request.registry.settings.get("server.default_path")
     raise HTTPFound(location=url)
 
+redirect.filtermode = "headers"
 
-__file_cache__ = {}
 
 def cache_write(response, request, filterconf, url):
     """
     Write response to cache
     -----------------------
-    A simple ignorant python module level memory cache.
+    Stores successful GET responses in the response cache (see `outpost.cache`).
+    The time to live is taken from the responses `Cache-Control` and `Expires` headers
+    or `cache.ttl`. Set `ttl` in the filter settings to override the time to live.
 
     Example ini file section ::
 
@@ -220,32 +487,36 @@ def cache_write(response, request, filterconf, url):
            "hook": "post",
            "apply_to": "proxy",
            "content_type": "text/",
-           "settings": {},
+           "settings": {"ttl": 600},
            "name": "cache-write"}
           ]
 
     """
-    # do not cache responses loaded from cache
-    if request.environ.get("outpost.cache-hit"):
+    # do not cache responses loaded from cache or shared with a concurrent request
+    if request.environ.get("outpost.cache-hit") or request.environ.get("outpost.coalesced"):
         return response
-    if response.status_int!=200 or request.method=="POST":
+    if response.status_int!=200 or request.method!="GET":
         return response
 
-    global __file_cache__
-    path = url.fullPath
-    hp = str(hash(path))
     if filtermanager.IProxyRequest.providedBy(response):
         rtype = "proxy"
     else:
         rtype = "file"
-    __file_cache__[hp] = (response.body, response.status_code, response.headers, rtype)
+    ttl = (filterconf.settings or {}).get("ttl")
+    store = cache.getCache(request.registry.settings)
+    store.store(request, url, response.body, response.status_code, list(response.headerlist), rtype,
+                ttl=int(ttl) if ttl is not None else None)
     return response
 
 def cache_read(response, request, filterconf, url):
     """
     Read response from cache
     -----------------------
-    A simple ignorant python module level memory cache.
+    Returns GET and HEAD responses from the response cache (see `outpost.cache`).
+    Expired proxy responses are revalidated with a conditional backend request
+    (`If-None-Match`, `If-Modified-Since`). Conditional client requests matching the
+    cached response are answered with `304 Not Modified`. Set `ttl` to override the time
+    to live of revalidated responses.
 
     Set `abort=true` to finish proxy response if found in cache.
 
@@ -261,53 +532,222 @@ def cache_read(response, request, filterconf, url):
           ]
 
     """
-    global __file_cache__
-    path = url.fullPath
-    hp = str(hash(path))
-    if not hp in __file_cache__:
-        return None
-    body, status_code, headers, rtype = __file_cache__[hp]
-    response = Response(body=body, status=status_code)
-    response.headers.update(headers)
-    request.environ['outpost.cache-hit'] = True
+    if request.method not in ("GET", "HEAD"):
+        return response
+    store = cache.getCache(request.registry.settings)
+    entry = store.lookup(request, url, stale=True)
+    if entry is None:
+        return response
     log = logging.getLogger("outpost.proxy")
-    log.debug("cache hit %s" % path)
-    if rtype == "proxy":
+    try:
+        if not entry.fresh():
+            # conditional backend request
+            proxy = request.environ.get("proxy")
+            if proxy is None:
+                return response
+            try:
+                # blocking call. the asgi server runs filters in worker threads.
+                headers = dict(entry.validators(), **Proxy.fullRequest)
+                backend, body = Proxy.proxy(proxy, url, request, method="GET", headers=headers)
+            except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+                # the request is passed on to the backend
+                log.warning("cache revalidation failed %s %s" % (str(e), url.fullPath))
+                return response
+            if backend.status_code != 304:
+                # changed. the new response is processed by post filters and cache_write.
+                log.debug("cache revalidation %d %s" % (backend.status_code, url.fullPath))
+                return proxy.wrap(backend, body)
+            ttl = (filterconf.settings or {}).get("ttl")
+            store.refresh(entry, backend.headers, ttl=int(ttl) if ttl is not None else None)
+            log.debug("cache revalidated %s" % url.fullPath)
+        request.environ['outpost.cache-hit'] = True
+        if cache.notModified(request, entry):
+            response = cachedResponse(entry, status=304, request=request)
+            log.debug("cache hit 304 %s" % url.fullPath)
+        else:
+            response = cachedResponse(entry, request=request)
+            log.debug("cache hit %s" % url.fullPath)
+        if (filterconf.settings or {}).get("abort") is not False:
+            raise filtermanager.ResponseFinished(response=response)
+        return response
+    finally:
+        # the disk cache body file opened on lookup is closed if not served
+        entry.close()
+
+
+def cachedResponse(entry, status=None, request=None):
+    """
+    Creates a response for the cache entry. For status 304 only the validator and
+    caching headers are included. Disk cache entries are served from the body file
+    using `wsgi.file_wrapper` if available. Range requests are sliced from the cached
+    body.
+    """
+    if status == 304:
+        headers = [(k, v) for k, v in entry.headers if k.lower() in cache.UPDATE_HEADERS]
+        response = Response(status=304, headerlist=headers)
+    elif isinstance(entry, cache.DiskEntry):
+        f = entry.open()
+        wrapper = request.environ.get("wsgi.file_wrapper", FileIter) if request is not None else FileIter
+        response = Response(status=entry.status, headerlist=list(entry.headers))
+        response.app_iter = wrapper(f, 64*1024)
+        response.content_length = os.fstat(f.fileno()).st_size
+    else:
+        response = Response(body=entry.body, status=entry.status, headerlist=list(entry.headers))
+    if status != 304:
+        # handles range and conditional requests
+        response.conditional_response = True
+    if entry.rtype == "proxy":
         alsoProvides(response, filtermanager.IProxyRequest)
     else:
         alsoProvides(response, filtermanager.IFileRequest)
-    if filterconf.settings.get("abort") is not False:
-        raise filtermanager.ResponseFinished(response=response)
     return response
 
 
 # quick and dirty string filter callables
 
 def appendhead(response, request, filterconf, url):
-    htmlfile = filterconf.settings.get("appendhead")
-    if not htmlfile:
-        return response
-    try:
-        with open(htmlfile) as f:
-            data = f.read()
-    except IOError:
-        return response
-    # process
-    response.body = response.body.replace("</head>", data+"</head>")
-    return response
+    """
+    Inserts the contents of the file `appendhead` before the first `</head>` tag.
+    Set `mode` to `stream` to process streamed bodies without reading the body first.
+    """
+    return insertSnippet(response, request, filterconf, "appendhead", b"</head>", last=False)
 
 
 def appendbody(response, request, filterconf, url):
-    htmlfile = filterconf.settings.get("appendbody")
-    if not htmlfile:
-        return response
-    try:
-        with open(htmlfile) as f:
-            data = f.read()
-    except IOError:
+    """
+    Inserts the contents of the file `appendbody` before the last `</body>` tag.
+    Set `mode` to `stream` to process streamed bodies. The body following the last
+    `</body>` is held back until the end of the body.
+    """
+    return insertSnippet(response, request, filterconf, "appendbody", b"</body>", last=True)
+
+
+def insertSnippet(response, request, filterconf, key, marker, last):
+    """
+    Inserts the snippet file `filterconf.settings[key]` before the first or last
+    `marker` of the body. The body is processed as bytes.
+    """
+    snippet = getattr(filterconf, "snippet", None)
+    if snippet is None:
+        htmlfile = filterconf.settings.get(key)
+        if not htmlfile:
+            return response
+        snippet = filterconf.snippet = Snippet(htmlfile)
+    charset = response.charset or "utf-8"
+    data = snippet.get(charset, check=0 if asbool(request.registry.settings.get("debug")) else None)
+    if not data:
         return response
+    marker = marker.decode("ascii").encode(charset)
+    if filterconf.mode == "stream":
+        return filtermanager.streamFilter(response, ChunkInserter(marker, data, last))
     # process
-    response.body = response.body.replace("</body>", data+"</body>")
+    body = response.body
+    pos = body.rfind(marker) if last else body.find(marker)
+    if pos != -1:
+        response.body = body[:pos] + data + body[pos:]
     return response
 
 
+def _setupSnippet(filterconf):
+    # creates the snippet loader. called by `FilterConf.fromDict()`.
+    htmlfile = (filterconf.settings or {}).get(filterconf.callable.__name__)
+    filterconf.snippet = Snippet(htmlfile) if htmlfile else None
+
+appendhead.setup = appendbody.setup = _setupSnippet
+
+
+class Snippet(object):
+    """
+    File contents loaded once and reloaded if the files modification time changes.
+    The modification time is checked at most every `check` seconds. The file is
+    expected to be utf-8 encoded.
+    """
+
+    def __init__(self, path, check=2):
+        self.path = path
+        self.check = check
+        self.checked = None
+        self.mtime = None
+        self.data = None
+        self.encoded = {}
+
+    def get(self, charset="utf-8", check=None):
+        """
+        Returns the file contents encoded with `charset` or None if the file
+        does not exist.
+        """
+        now = time.time()
+        if self.checked is None or now - self.checked >= (self.check if check is None else check):
+            self.checked = now
+            self.load()
+        if self.data is None:
+            return None
+        encoded = self.encoded.get(charset)
+        if encoded is None:
+            try:
+                encoded = self.data.decode("utf-8").encode(charset)
+            except (UnicodeError, LookupError):
+                encoded = self.data
+            self.encoded[charset] = encoded
+        return encoded
+
+    def load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+            if mtime == self.mtime:
+                return
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except OSError:
+            self.mtime = self.data = None
+            return
+        self.encoded = {}
+        self.mtime, self.data = mtime, data
+
+
+class ChunkInserter(object):
+    """
+    Inserts `data` before the first or last occurrence of `marker` in a chunked body.
+    Used by `stream` mode filters.
+
+    The last `len(marker)-1` bytes of each chunk are held back to find markers crossing
+    chunk boundaries. If `last` is true, the body from the last marker found is held
+    back until the next marker or the end of the body.
+    """
+
+    def __init__(self, marker, data, last=False):
+        self.marker = marker
+        self.data = data
+        self.last = last
+
+    def __call__(self, chunks):
+        marker, keep = self.marker, len(self.marker) - 1
+        pending = b""
+        found = done = False
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if done:
+                yield chunk
+                continue
+            buf = pending + chunk
+            pos = buf.rfind(marker) if self.last else buf.find(marker)
+            if pos != -1 and not self.last:
+                yield buf[:pos] + self.data + buf[pos:]
+                pending = b""
+                done = True
+                continue
+            if pos != -1:
+                found = True
+                split = pos
+            elif found:
+                split = 0
+            else:
+                split = max(len(buf) - keep, 0)
+            if split:
+                yield buf[:split]
+            pending = buf[split:]
+        if found:
+            yield self.data + pending
+        elif pending:
+            yield pending
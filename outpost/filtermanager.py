@@ -4,15 +4,22 @@
 import logging
 import json
 import re
+import time
+from functools import lru_cache
 from zope.interface import Interface, implementer
 from pyramid.path import DottedNameResolver
 from pyramid.path import caller_package
 
+from outpost import profiling
+
 try:
   basestring
 except NameError:
   basestring = str
 
+FILTER_MODES = ("body", "stream", "headers")
+
+
 class IFilter(Interface):
     """
     IFilter marks filter configuration classes
@@ -36,6 +43,8 @@ class IProxyRequest(Interface):
 
     """
 
+RESPONSE_TYPES = (IFileRequest, IProxyRequest)
+
 @implementer(IProxyRequest)
 class EmptyProxyResponse(object):
     status_int = 200
@@ -60,6 +69,10 @@ class FilterConf(object):
     environ: match a request.environ field
     sub_filter: name of filter. trigger the named filter filter only if this filter has been executed
     is_sub_filter: True/False. if True run only if a preious filter has set this filters' name as sub_filter
+    mode: `body` the filter processes the complete response body (default). `stream` the filter
+          processes the body chunk-wise (see `streamFilter()`). `headers` the filter does not access
+          the body. Used to decide if streamed proxy responses have to be buffered.
+          Defaults to the callables `filtermode` attribute if set.
     settings: individual filter settings
     name: name, used to reference sub filter and in logging
 
@@ -93,6 +106,7 @@ class FilterConf(object):
     status=200  # defaults to 200
     sub_filter=None
     is_sub_filter=False
+    mode="body"
     settings=None
     name=""
 
@@ -117,6 +131,9 @@ class FilterConf(object):
             base = caller_package()
             cc = DottedNameResolver(base).resolve(fc.callable)
             fc.callable = cc
+        # default filter mode provided by the callable
+        if not conf.get("mode"):
+            fc.mode = getattr(fc.callable, "filtermode", None) or "body"
         # compile path and content_type regex if set
         if fc.path:
             fc.path = re.compile(fc.path)
@@ -140,6 +157,10 @@ class FilterConf(object):
                     s = int(s)
                     fc.status = lambda status: status==s
 
+        # let the callable prepare the configuration e.g. compile settings
+        setup = getattr(fc.callable, "setup", None)
+        if setup is not None:
+            setup(fc)
         return fc
 
     def __str__(self):
@@ -155,6 +176,8 @@ class FilterConf(object):
             result.append("Filter callable is *not* a callable! %s"% (repr(self.callable)))
         if not self.hook in ("post","pre","all",""):
             result.append("hook must be set to 'all', 'post', 'pre'! %s"% (str(self.hook)))
+        if not self.mode in FILTER_MODES:
+            result.append("mode must be set to %s! %s"% (", ".join(FILTER_MODES), str(self.mode)))
         if self.environ:
             if not "name" in self.environ and not "value" in self.environ:
                 result.append("environ must have 'name' and 'value' keys! %s"% (str(self.environ)))
@@ -205,39 +228,149 @@ def lookupFilter(hook, response, request, url):
     :param url:
     :return: list of filters
     """
-    all = request.registry.settings["filter"]
-    #matched = []
-    for ff in all:
-        # match pre/post hook
-        if ff.hook != hook:
-            continue
+    table = request.registry.settings["filter"]
+    if not isinstance(table, FilterTable):
+        table = FilterTable(table)
+    if IProxyRequest.providedBy(response):
+        rtype = IProxyRequest
+    elif IFileRequest.providedBy(response):
+        rtype = IFileRequest
+    else:
+        rtype = None
+    candidates = table.candidates(hook, rtype, str(url), response.content_type or "", response.status_int)
+    for ff in candidates:
         # match sub filter
         if ff.is_sub_filter:
             if ff.name in request.environ.get("outpost.sub_filter", ()):
-                #matched.append(ff)
                 yield ff
             continue
-        # match response type
-        if ff.apply_to:
+        # match custom response type interfaces
+        if ff.apply_to and ff.apply_to not in RESPONSE_TYPES:
             if not ff.apply_to.providedBy(response):
                 continue
         # match environ
-        if ff.environ is not None and ff.environ.value != request.environ.get(ff.environ.name):
+        if ff.environ is not None and ff.environ.get("value") != request.environ.get(ff.environ.get("name")):
             continue
-        # match path
-        if ff.path:
-            if ff.path.search(str(url)) is None:
+        yield ff
+
+
+class FilterTable(tuple):
+    """
+    Compiled filter lookup table. Contains the list of filter configurations in
+    configured order and is returned by `parseJsonString()`.
+
+    Filters are bucketed by hook and response type (`apply_to`) and path regular
+    expressions are merged in a single expression. The static part of the lookup
+    (hook, response type, path, content type and status) is memoized in a bounded
+    LRU cache. Sub filters, `environ` matches and custom `apply_to` interfaces are
+    evaluated per request by `lookupFilter()`.
+    """
+    cachesize = 1024
+
+    def __new__(cls, filters=(), cachesize=None):
+        return tuple.__new__(cls, filters)
+
+    def __init__(self, filters=(), cachesize=None):
+        if cachesize:
+            self.cachesize = int(cachesize)
+        self.buckets = {}
+        for hook in set(ff.hook for ff in self):
+            for rtype in RESPONSE_TYPES+(None,):
+                self.buckets[(hook, rtype)] = tuple(
+                    (i, ff) for i, ff in enumerate(self)
+                    if ff.hook == hook and (ff.is_sub_filter or not ff.apply_to or ff.apply_to is rtype
+                                            or ff.apply_to not in RESPONSE_TYPES))
+        self.paths, self.fallback = self._compilePaths()
+        self.candidates = lru_cache(maxsize=self.cachesize)(self._candidates)
+
+    def _candidates(self, hook, rtype, path, content_type, status):
+        # returns a tuple of filters possibly matching. uncached.
+        matched = self.matchPaths(path)
+        result = []
+        for i, ff in self.buckets.get((hook, rtype), ()):
+            if ff.is_sub_filter:
+                result.append(ff)
                 continue
-        # match content type
-        if ff.content_type:
-            if ff.content_type.search(response.content_type) is None:
+            if ff.path and not i in matched:
                 continue
-        # match status
-        if ff.status:
-            if not ff.status(response.status_int):
+            if ff.content_type and ff.content_type.search(content_type) is None:
                 continue
-        yield ff
-    #return matched
+            if ff.status and not ff.status(status):
+                continue
+            result.append(ff)
+        return tuple(result)
+
+    def matchPaths(self, path):
+        """
+        Returns the set of filter indexes with path regular expressions matching `path`.
+        """
+        matched = set()
+        if self.paths is not None:
+            m = self.paths.match(path)
+            for name, value in m.groupdict().items():
+                if value is not None and name.startswith("_f"):
+                    matched.add(int(name[2:]))
+        for i, ff in self.fallback:
+            if ff.path.search(path) is not None:
+                matched.add(i)
+        return matched
+
+    def _compilePaths(self):
+        # merges path expressions in a single regex with one optional lookahead per filter.
+        # expressions with backreferences or flags are matched one by one.
+        merged = []
+        fallback = []
+        for i, ff in enumerate(self):
+            if not ff.path or ff.is_sub_filter:
+                continue
+            pattern = ff.path.pattern
+            if not isinstance(pattern, str) or ff.path.flags != re.UNICODE or \
+                    re.search(r"\\[1-9]|\(\?P=|\(\?[aiLmsux]", pattern):
+                fallback.append((i, ff))
+                continue
+            merged.append((i, ff))
+        if not merged:
+            return None, tuple(fallback)
+        try:
+            paths = re.compile("".join(r"(?:(?=[\s\S]*?(?P<_f%d>%s))|)" % (i, ff.path.pattern)
+                                       for i, ff in merged))
+        except re.error:
+            return None, tuple(merged+fallback)
+        return paths, tuple(fallback)
+
+
+def lookupBodyFilter(hook, response, request, url, modes=("body",)):
+    """
+    Lookup the first filter matching the current request and response requiring the
+    complete response body. Sub filters activated by matching filters are included.
+
+    :param hook:
+    :param request:
+    :param response:
+    :param url:
+    :param modes: filter modes requiring the complete body
+    :return: filter or None
+    """
+    for ff in lookupBodyFilters(hook, response, request, url, modes):
+        return ff
+    return None
+
+
+def lookupBodyFilters(hook, response, request, url, modes=("body",)):
+    """
+    Lookup all filters matching the current request and response in one of the filter
+    `modes`. Sub filters activated by matching filters are included.
+
+    :return: iterator of filters
+    """
+    all = request.registry.settings["filter"]
+    for ff in lookupFilter(hook, response, request, url):
+        if ff.mode in modes:
+            yield ff
+        if ff.sub_filter:
+            for sf in all:
+                if sf.is_sub_filter and sf.name == ff.sub_filter and sf.mode in modes:
+                    yield sf
 
 
 def applyFilter(filterconf, response, request, url):
@@ -251,14 +384,93 @@ def applyFilter(filterconf, response, request, url):
     :return: response
     """
     # load filter.
-    response = filterconf.callable(response, request, filterconf, url)
+    settings = request.registry.settings
+    if settings.get("metrics.instance") is None and not settings.get("filter.timing"):
+        response = filterconf.callable(response, request, filterconf, url)
+    else:
+        response = _timedFilter(filterconf, response, request, url)
     _trackFilter(filterconf, request)
     # activate subfilter
     _activateSubFilter(filterconf, request)
     return response
 
 
-def parseJsonString(jsonstr, exitOnTestFailure=True):
+def _timedFilter(filterconf, response, request, url):
+    # applies the filter and records duration and body sizes in metrics and for the
+    # Server-Timing header
+    settings = request.registry.settings
+    metrics = settings.get("metrics.instance")
+    name = filterconf.name or str(filterconf.callable)
+    before = _bodySize(response)
+    t = time.perf_counter()
+    try:
+        response = filterconf.callable(response, request, filterconf, url)
+    finally:
+        seconds = time.perf_counter() - t
+        if metrics is not None:
+            metrics.observe("outpost_filter_seconds", (name, filterconf.hook), seconds)
+        profiling.timing(request, name, seconds)
+    if metrics is not None and before is not None:
+        after = _bodySize(response)
+        if after is not None:
+            metrics.inc("outpost_filter_bytes_in_total", (name, filterconf.hook), before)
+            metrics.inc("outpost_filter_bytes_out_total", (name, filterconf.hook), after)
+    return response
+
+
+def _bodySize(response):
+    # size of buffered response bodies. None for streamed or empty responses.
+    app_iter = getattr(response, "app_iter", None)
+    if not isinstance(app_iter, (list, tuple)):
+        return None
+    return sum(len(chunk) for chunk in app_iter)
+
+
+def streamFilter(response, transform):
+    """
+    Applies a chunk-wise filter to the response body. Used by filters in `stream` mode.
+
+    `transform` is called with the current body iterator and must return an iterable of
+    the filtered body chunks. The response body is not read before the response is
+    returned to the client ::
+
+        def runfilter(response, request, filterconf, url):
+            def upper(chunks):
+                for chunk in chunks:
+                    yield chunk.upper()
+            return streamFilter(response, upper)
+
+    :param response:
+    :param transform: callable
+    :return: response
+    """
+    app_iter = response.app_iter
+    response.app_iter = FilterIter(transform(app_iter), app_iter)
+    # the length of the filtered body is unknown
+    response.content_length = None
+    return response
+
+
+class FilterIter(object):
+    """
+    WSGI app_iter returning the chunks of a stream filter. Closes the wrapped
+    app_iter.
+    """
+
+    def __init__(self, chunks, app_iter):
+        self.chunks = chunks
+        self.app_iter = app_iter
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        close = getattr(self.app_iter, "close", None)
+        if close is not None:
+            close()
+
+
+def parseJsonString(jsonstr, exitOnTestFailure=True, cachesize=None):
     """
     Parse and test filter configuration from json string.
 
@@ -266,14 +478,15 @@ def parseJsonString(jsonstr, exitOnTestFailure=True):
 
     :param jsonstr:
     :param exitOnTestFailure:
-    :return: list of parsed filter
+    :param cachesize: size of the filter lookup cache
+    :return: FilterTable of parsed filter
     """
     log = logging.getLogger("outpost")
     if jsonstr is None:
-        return ()
+        return FilterTable()
     jsonstr = jsonstr.strip()
     if not jsonstr:
-        return ()
+        return FilterTable()
     ff = json.loads(jsonstr)
     if isinstance(ff, dict):
         ff = (FilterConf.fromDict(ff),)
@@ -301,7 +514,7 @@ def parseJsonString(jsonstr, exitOnTestFailure=True):
                                                         tf.apply_to or "all requests"))
     if exitOnTestFailure and err:
         raise ConfigurationError("Invalid filter configurations found. See error log for details.")
-    return ok
+    return FilterTable(ok, cachesize=cachesize)
 
 
 def _trackFilter(ff, request):
@@ -0,0 +1,316 @@
+# Copyright 2015 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under BSD-license. See license.txt
+#
+"""
+Metrics
+-------
+Optional request metrics exposed in Prometheus text format. Enabled by setting the path
+of the metrics view ::
+
+    metrics.path = /__metrics
+
+Recorded metrics:
+
+- outpost_request_seconds: request latency by route (proxy, files) and status
+- outpost_backend_seconds: backend response time by status
+- outpost_backend_retries_total: retries, hedged requests and retries rejected by the
+  retry budget (kind: retry, hedge, exhausted)
+- outpost_filter_seconds: filter processing time by filter name and hook
+- outpost_filter_quantile_seconds: estimated p50 and p99 filter processing time
+- outpost_filter_bytes_in_total, outpost_filter_bytes_out_total: buffered body bytes
+  before and after filtering
+- outpost_request_bytes_total, outpost_response_bytes_total: body bytes by route
+
+Statistics of connection pools, upstream hosts, response cache, asset cache and
+compressed variant cache are added on collection.
+
+Values are recorded in per thread counters without locking. The counters of all
+threads are summed up when the metrics are collected. `Metrics` is stored as
+`metrics.instance` in the settings.
+"""
+import bisect
+import threading
+import time
+
+from pyramid.response import Response
+
+from outpost import pool
+
+# histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name: type, help, label names
+METRICS = {
+    "outpost_request_seconds": ("histogram", "Request latency", ("route", "status")),
+    "outpost_backend_seconds": ("histogram", "Backend response time", ("status",)),
+    "outpost_backend_retries_total": ("counter", "Backend retries, hedged requests and retries denied by the budget", ("kind",)),
+    "outpost_filter_seconds": ("histogram", "Filter processing time", ("filter", "hook")),
+    "outpost_filter_bytes_in_total": ("counter", "Body bytes passed to the filter", ("filter", "hook")),
+    "outpost_filter_bytes_out_total": ("counter", "Body bytes returned by the filter", ("filter", "hook")),
+    "outpost_request_bytes_total": ("counter", "Request body bytes", ("route",)),
+    "outpost_response_bytes_total": ("counter", "Response body bytes", ("route",)),
+}
+
+
+class Metrics(object):
+    """
+    Metrics registry. Histograms and counters are stored per thread.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(buckets)
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fromSettings(settings):
+        if not settings.get("metrics.path"):
+            return None
+        return Metrics()
+
+    def shard(self):
+        """
+        Returns the counters of the current thread.
+        """
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = {}
+            with self.lock:
+                self.shards.append(shard)
+        return shard
+
+    def observe(self, name, labels, value):
+        """
+        Adds the value to the histogram `name`.
+
+        :param labels: tuple of label values in the order of the metrics label names
+        """
+        shard = self.shard()
+        h = shard.get((name, labels))
+        if h is None:
+            # bucket counts, +Inf, sum
+            h = shard[(name, labels)] = [0] * (len(self.buckets) + 1) + [0.0]
+        h[bisect.bisect_left(self.buckets, value)] += 1
+        h[-1] += value
+
+    def inc(self, name, labels, value=1):
+        """
+        Increments the counter `name`.
+        """
+        shard = self.shard()
+        shard[(name, labels)] = shard.get((name, labels), 0) + value
+
+    def collect(self):
+        """
+        Returns the sum of all thread counters as dictionary `(name, labels): value`.
+        Histogram values are lists of bucket counts followed by the sum.
+        """
+        with self.lock:
+            shards = list(self.shards)
+        result = {}
+        for shard in shards:
+            for key, value in list(shard.items()):
+                if isinstance(value, list):
+                    current = result.get(key)
+                    if current is None:
+                        result[key] = list(value)
+                    else:
+                        for i, v in enumerate(value):
+                            current[i] += v
+                else:
+                    result[key] = result.get(key, 0) + value
+        return result
+
+    def prometheus(self, settings=None):
+        """
+        Returns all metrics in Prometheus text format. If `settings` is passed, pool and
+        cache statistics are included.
+        """
+        values = self.collect()
+        lines = []
+        for name in sorted(METRICS):
+            mtype, help, labelnames = METRICS[name]
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, mtype))
+            for (n, labels), value in sorted(values.items(), key=lambda i: i[0]):
+                if n != name:
+                    continue
+                if mtype == "histogram":
+                    lines.extend(self._histogram(name, labelnames, labels, value))
+                else:
+                    lines.append("%s%s %s" % (name, _labels(labelnames, labels), _number(value)))
+        lines.append("# TYPE outpost_filter_quantile_seconds gauge")
+        for (n, labels), value in sorted(values.items(), key=lambda i: i[0]):
+            if n != "outpost_filter_seconds":
+                continue
+            for q in (0.5, 0.99):
+                lines.append("outpost_filter_quantile_seconds%s %s" % (
+                    _labels(("filter", "hook", "quantile"), labels + (_number(q),)),
+                    _number(self.quantile(value, q))))
+        if settings is not None:
+            lines.extend(statistics(settings))
+        return "\n".join(lines) + "\n"
+
+    def quantile(self, histogram, q):
+        """
+        Estimates the quantile `q` of the histogram values by linear interpolation
+        within the bucket.
+        """
+        counts = histogram[:-1]
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    # +Inf bucket
+                    return self.buckets[-1]
+                lower = self.buckets[i-1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def _histogram(self, name, labelnames, labels, value):
+        lines = []
+        count = 0
+        for i, le in enumerate(self.buckets + ("+Inf",)):
+            count += value[i]
+            le = le if isinstance(le, str) else _number(le)
+            lines.append("%s_bucket%s %d" % (name, _labels(labelnames + ("le",), labels + (le,)), count))
+        lines.append("%s_sum%s %s" % (name, _labels(labelnames, labels), _number(value[-1])))
+        lines.append("%s_count%s %d" % (name, _labels(labelnames, labels), count))
+        return lines
+
+
+def statistics(settings):
+    """
+    Returns the pool, upstream and cache statistics as Prometheus text lines.
+    """
+    lines = []
+    pools = pool.statistics()
+    if pools:
+        lines.append("# TYPE outpost_pool_connections gauge")
+        for host, stats in sorted(pools.items()):
+            for state in ("in_use", "idle"):
+                lines.append("outpost_pool_connections%s %d" % (_labels(("host", "state"), (host, state)),
+                                                                 stats[state]))
+        lines.append("# TYPE outpost_pool_requests_total counter")
+        for host, stats in sorted(pools.items()):
+            lines.append("outpost_pool_requests_total%s %d" % (_labels(("host",), (host,)), stats["requests"]))
+    upstreams = settings.get("proxy.upstreams")
+    if upstreams is not None:
+        stats = upstreams.statistics()
+        lines.append("# TYPE outpost_upstream_active gauge")
+        for host, values in sorted(stats.items()):
+            lines.append("outpost_upstream_active%s %d" % (_labels(("host",), (host,)), values["active"]))
+        lines.append("# TYPE outpost_upstream_up gauge")
+        for host, values in sorted(stats.items()):
+            lines.append("outpost_upstream_up%s %d" % (_labels(("host",), (host,)), values["available"]))
+        lines.append("# TYPE outpost_upstream_errors_total counter")
+        for host, values in sorted(stats.items()):
+            lines.append("outpost_upstream_errors_total%s %d" % (_labels(("host",), (host,)), values["errors"]))
+    caches = []
+    for name, key in (("response", "cache.instance"), ("assets", "files.cache"), ("variants", "compress.variants")):
+        cache = settings.get(key)
+        if cache and hasattr(cache, "statistics"):
+            caches.append((name, cache.statistics()))
+    if caches:
+        for metric, stat, mtype in (("outpost_cache_hits_total", "hits", "counter"),
+                                    ("outpost_cache_misses_total", "misses", "counter"),
+                                    ("outpost_cache_entries", "entries", "gauge"),
+                                    ("outpost_cache_bytes", "size", "gauge")):
+            lines.append("# TYPE %s %s" % (metric, mtype))
+            for name, stats in caches:
+                lines.append("%s%s %s" % (metric, _labels(("cache",), (name,)), _number(stats.get(stat, 0))))
+    return lines
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for v in values)
+    return "{%s}" % ",".join('%s="%s"' % (n, v) for n, v in zip(names, escaped))
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class CountingIter(object):
+    """
+    WSGI app_iter counting the response bytes of streamed responses.
+    """
+
+    def __init__(self, app_iter, metrics, route):
+        self.app_iter = app_iter
+        self.metrics = metrics
+        self.route = route
+
+    def __iter__(self):
+        size = 0
+        try:
+            for chunk in self.app_iter:
+                size += len(chunk)
+                yield chunk
+        finally:
+            self.metrics.inc("outpost_response_bytes_total", (self.route,), size)
+
+    def close(self):
+        if hasattr(self.app_iter, "close"):
+            self.app_iter.close()
+
+
+def record(metrics, route, request, response, seconds):
+    """
+    Records latency and body sizes of a request.
+    """
+    metrics.observe("outpost_request_seconds", (route, str(response.status_int)), seconds)
+    if request.content_length:
+        metrics.inc("outpost_request_bytes_total", (route,), request.content_length)
+    if response.content_length is not None:
+        metrics.inc("outpost_response_bytes_total", (route,), response.content_length)
+    elif not isinstance(response.app_iter, (list, tuple)):
+        response.app_iter = CountingIter(response.app_iter, metrics, route)
+    else:
+        metrics.inc("outpost_response_bytes_total", (route,), sum(len(c) for c in response.app_iter))
+
+
+def tween(handler, registry):
+    """
+    Pyramid tween recording request metrics. Registered by `server.setup()` if metrics
+    are enabled. Requests failing with an unhandled exception are recorded with
+    status 500.
+    """
+    metrics = registry.settings.get("metrics.instance")
+    if metrics is None:
+        return handler
+
+    def measure(request):
+        t = time.perf_counter()
+        response = None
+        try:
+            response = handler(request)
+        finally:
+            matched = getattr(request, "matched_route", None)
+            route = matched.name if matched is not None else "none"
+            if response is None:
+                metrics.observe("outpost_request_seconds", (route, "500"), time.perf_counter() - t)
+            else:
+                record(metrics, route, request, response, time.perf_counter() - t)
+        return response
+
+    return measure
+
+
+def metricsView(request):
+    settings = request.registry.settings
+    metrics = settings["metrics.instance"]
+    response = Response(body=metrics.prometheus(settings).encode("utf-8"))
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    response.cache_control = "no-cache"
+    return response
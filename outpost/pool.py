@@ -0,0 +1,152 @@
+# Copyright 2015 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under BSD-license. See license.txt
+#
+"""
+Backend connection pools
+------------------------
+Connection pool configuration and statistics for the proxy session.
+
+Settings ::
+
+    proxy.pool.connections = 20     number of cached host pools
+    proxy.pool.maxsize = 30         max. number of kept-alive connections per host
+    proxy.pool.block = false        wait for a free connection if the pool is exhausted
+    proxy.pool.stats = /__pool      optional path returning the pool statistics as json
+
+The pool settings are applied to http and https backends. `statistics()` returns the
+live statistics of all pools ::
+
+    {"http://test.nive.io:80": {"in_use": 2, "idle": 8, "created": 10,
+                                "discarded": 0, "waits": 0, "requests": 530, "maxsize": 30}}
+
+"""
+import threading
+import weakref
+
+from requests.adapters import HTTPAdapter
+from pyramid.settings import asbool
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+__adapters__ = weakref.WeakSet()
+
+
+def adapterFromSettings(settings):
+    """
+    Creates a `PoolAdapter` based on the `proxy.pool.*` and `proxy.retry` settings.
+    """
+    return PoolAdapter(pool_connections=int(settings.get("proxy.pool.connections") or 20),
+                       pool_maxsize=int(settings.get("proxy.pool.maxsize") or 30),
+                       pool_block=asbool(settings.get("proxy.pool.block", False)),
+                       max_retries=int(settings.get("proxy.retry") or 0))
+
+
+def mount(session, adapter):
+    """
+    Mounts the adapter for http and https urls.
+    """
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def statistics():
+    """
+    Returns the statistics of all connection pools as dictionary. Pools of different
+    adapters connecting to the same host are summed up.
+    """
+    result = {}
+    for adapter in list(__adapters__):
+        for key, values in adapter.statistics().items():
+            if key in result:
+                for name, value in values.items():
+                    result[key][name] += value
+            else:
+                result[key] = values
+    return result
+
+
+class PoolAdapter(HTTPAdapter):
+    """
+    Requests transport adapter using connection pools with statistics.
+    """
+
+    def __init__(self, *args, **kw):
+        HTTPAdapter.__init__(self, *args, **kw)
+        __adapters__.add(self)
+
+    def init_poolmanager(self, *args, **kw):
+        HTTPAdapter.init_poolmanager(self, *args, **kw)
+        self.poolmanager.pool_classes_by_scheme = {"http": StatsHTTPConnectionPool,
+                                                   "https": StatsHTTPSConnectionPool}
+
+    def statistics(self):
+        """
+        Returns the statistics of the adapters connection pools by `scheme://host:port`.
+        """
+        pools = self.poolmanager.pools
+        with pools.lock:
+            current = list(pools._container.values())
+        result = {}
+        for pool in current:
+            if not hasattr(pool, "statistics"):
+                continue
+            result["%s://%s:%s" % (pool.scheme, pool.host, pool.port)] = pool.statistics()
+        return result
+
+
+class PoolStats(object):
+    """
+    Connection pool mixin counting connections.
+
+    - in_use: connections currently checked out
+    - idle: kept-alive connections available in the pool
+    - created: new connections
+    - discarded: connections closed because the pool was full
+    - waits: requests waiting for a free connection (if `proxy.pool.block` is true)
+    - requests: total number of checked out connections
+    """
+
+    def __init__(self, *args, **kw):
+        self._statslock = threading.Lock()
+        self._stats = dict(in_use=0, created=0, discarded=0, waits=0, requests=0)
+        super(PoolStats, self).__init__(*args, **kw)
+
+    def _count(self, name, value=1):
+        with self._statslock:
+            self._stats[name] += value
+
+    def _new_conn(self):
+        self._count("created")
+        return super(PoolStats, self)._new_conn()
+
+    def _get_conn(self, timeout=None):
+        if self.block and self.pool is not None and self.pool.empty():
+            self._count("waits")
+        conn = super(PoolStats, self)._get_conn(timeout=timeout)
+        with self._statslock:
+            self._stats["in_use"] += 1
+            self._stats["requests"] += 1
+        return conn
+
+    def _put_conn(self, conn):
+        with self._statslock:
+            self._stats["in_use"] -= 1
+        if conn is not None and self.pool is not None and self.pool.full():
+            self._count("discarded")
+        return super(PoolStats, self)._put_conn(conn)
+
+    def statistics(self):
+        with self._statslock:
+            stats = dict(self._stats)
+        pool = self.pool
+        stats["idle"] = len([c for c in list(pool.queue) if c is not None]) if pool is not None else 0
+        stats["maxsize"] = pool.maxsize if pool is not None else 0
+        return stats
+
+
+class StatsHTTPConnectionPool(PoolStats, HTTPConnectionPool):
+    pass
+
+
+class StatsHTTPSConnectionPool(PoolStats, HTTPSConnectionPool):
+    pass
@@ -0,0 +1,127 @@
+# Copyright 2015 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under BSD-license. See license.txt
+#
+"""
+Profiling
+---------
+Filter timing and a sampling profiler to find slow filters in production.
+
+If `filter.timing` is enabled each filter call is timed and the durations are added to
+the response as `Server-Timing` header together with the backend response time and
+the total processing time ::
+
+    Server-Timing: strfilter;dur=0.81, backend;dur=12.40, total;dur=14.02
+
+If metrics are enabled (`metrics.path`) filter durations and body sizes are recorded
+as well (see `outpost.metrics`).
+
+The sampling profiler runs `cProfile` for every nth request and writes the profile to
+`profile.directory`. Load the files with `pstats` or `snakeviz`.
+
+Settings ::
+
+    filter.timing = false       add the Server-Timing header
+    profile.sample = 0          profile every nth request. 0 disables the profiler
+    profile.directory = profiles    directory for profile files
+"""
+import cProfile
+import itertools
+import logging
+import os
+import re
+import threading
+import time
+
+
+def timing(request, name, seconds):
+    """
+    Adds a duration to the Server-Timing header of the current request if
+    `filter.timing` is enabled.
+    """
+    if request.registry.settings.get("filter.timing"):
+        request.environ.setdefault("outpost.timing", []).append((name, seconds))
+
+
+def serverTiming(request, response, total=None):
+    """
+    Sets the Server-Timing header based on the durations recorded for the request.
+    """
+    entries = request.environ.get("outpost.timing") or []
+    if total is not None:
+        entries = entries + [("total", total)]
+    if not entries:
+        return response
+    response.headers["Server-Timing"] = ", ".join(
+        "%s;dur=%.2f" % (re.sub(r"[^\w.-]", "_", name), seconds*1000) for name, seconds in entries)
+    return response
+
+
+def timingTween(handler, registry):
+    """
+    Pyramid tween adding the Server-Timing header. Registered by `server.setup()` if
+    `filter.timing` is enabled.
+    """
+    def measure(request):
+        t = time.perf_counter()
+        response = handler(request)
+        return serverTiming(request, response, time.perf_counter() - t)
+
+    return measure
+
+
+class Sampler(object):
+    """
+    Profiles every nth request with cProfile. Only one request is profiled at a time,
+    a sampled request is skipped if another one is being profiled.
+    """
+
+    def __init__(self, sample, directory):
+        self.sample = sample
+        self.directory = directory
+        self.counter = itertools.count(1)
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def fromSettings(settings):
+        sample = int(settings.get("profile.sample") or 0)
+        if sample <= 0:
+            return None
+        return Sampler(sample, settings.get("profile.directory") or "profiles")
+
+    def __call__(self, handler, request):
+        if next(self.counter) % self.sample or not self.lock.acquire(False):
+            return handler(request)
+        try:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return handler(request)
+            finally:
+                profile.disable()
+                self.dump(profile, request)
+        finally:
+            self.lock.release()
+
+    def dump(self, profile, request):
+        name = re.sub(r"[^\w.-]", "_", request.path_info.strip("/"))[:80] or "root"
+        path = os.path.join(self.directory, "%d-%s.prof" % (time.time()*1000, name))
+        try:
+            profile.dump_stats(path)
+        except OSError as e:
+            logging.getLogger("outpost").error("Profile dump failed: %s" % str(e))
+
+
+def profileTween(handler, registry):
+    """
+    Pyramid tween running the sampling profiler. Registered by `server.setup()` if
+    `profile.sample` is set.
+    """
+    sampler = registry.settings.get("profile.sampler")
+    if sampler is None:
+        return handler
+
+    def profiled(request):
+        return sampler(handler, request)
+
+    return profiled
@@ -1,17 +1,29 @@
 # Copyright 2015 Arndt Droullier, Nive GmbH. All rights reserved.
 # Released under BSD-license. See license.txt
 #
+import copy
 import logging
 import requests
 import pdb
 import re
+import threading
+import time
 
+from concurrent import futures
 from zope.interface import alsoProvides
+from pyramid.httpexceptions import HTTPNotFound
 from pyramid.response import Response
+from pyramid.settings import asbool
 
 from outpost import filtermanager
+from outpost import compress
+from outpost import profiling
+from outpost import upstream as balancer
+from outpost.cache import resourceUrl
 
-__session_cache__ = None
+# hop-by-hop headers are not forwarded (RFC 7230 6.1)
+HOP_HEADERS = ("connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te",
+               "trailer", "transfer-encoding", "upgrade")
 
 
 # delegate views to the proxy server
@@ -30,12 +42,32 @@ class Proxy(object):
     The Proxy class handles all requests forwarded to an external server.
     The url must be an instance of a UrlHandler class.
 
-    It is currently only meant to connect to a single backend server and
-    supports keep-alives and cookie sessions.
-
-    The proxy reads the backend servers response completely into memory.
-    Streaming is currently not supported.
+    The backend host is selected by the url handler. If `proxy.host` lists multiple
+    hosts, requests are balanced between them (see `outpost.upstream`). Keep-alives
+    and cookie sessions are supported. Failed requests of idempotent methods can be
+    retried and hedged (see `outpost.retry`).
+
+    By default the proxy reads the backend servers response completely into memory.
+    If `proxy.stream` is enabled the backend response is passed to the client in chunks
+    as soon as the headers are received. Streaming can be limited to matching paths and
+    content types by `proxy.stream.path` and `proxy.stream.content_type` (regular
+    expressions). If a post hook filter matches the response and needs the full body
+    (filter mode `body`) the response is buffered for the current request.
+
+    `Range` and `If-Range` request headers are forwarded to the backend and partial
+    responses (206) are passed to the client. Range requests are sent with identity
+    encoding so byte ranges and content length refer to the transferred body. If a post
+    filter requires the complete body of a partial response, the complete body is
+    requested and the range is sliced from the filtered response.
+
+    If `proxy.passthrough` is enabled, encoded backend responses (e.g. gzip) are passed
+    to the client without decoding as long as no post filter requires the decoded body.
+    Only encodings the proxy can decode are requested from the backend.
     """
+    chunksize = 65536
+    bufferModes = ("body",)
+    # request headers removed to request the complete body
+    fullRequest = {"range": None, "if-range": None}
     
     def __init__(self, url, request, debug):
         self.request = request
@@ -56,13 +88,41 @@ class Proxy(object):
         except filtermanager.ResponseFinished as e:
             return e.response
 
+        sliced = False
         if response is None:
-            response, body = self.proxy(self.url, request)
+            stream = self.streamPath(self.url)
+            response, body = self.proxy(self.url, request, stream=stream)
+            if response.status_code == 206 and self.bodyFilter(response, request, status=200) is not None:
+                # filters of the complete response require the body. the range is sliced from the filtered response.
+                response.close()
+                response, body = self.proxy(self.url, request, stream=stream, headers=self.fullRequest)
+                sliced = True
+            if body is None and not self.streamResponse(response, request):
+                # read the remaining backend response
+                body = self.readBody(response, request)
 
         else:
             # pre hook returned response
             body = response.body
 
+        proxy_response = self.wrap(response, body)
+        proxy_response.conditional_response = sliced
+
+        # run post proxy request hooked filters
+        proxy_response = filtermanager.runPostHook(proxy_response, request, self.url)
+
+        return proxy_response
+
+
+    def wrap(self, response, body):
+        """
+        Converts the backend response to a pyramid response and cleans up the headers.
+        If body is None the backend response is streamed.
+
+        :return: response providing IProxyRequest
+        """
+        request = self.request
+
         def removeHeader(key, values):
             # the default header key should be the standard capitilized version e.g 'Content-Length'
             try:
@@ -83,7 +143,8 @@ class Proxy(object):
             removeHeader('Content-Length', headers)
         if 'transfer-encoding' in keys:
             removeHeader('Transfer-Encoding', headers)
-        if 'content-encoding' in keys:
+        encoded = self.keepEncoding(response, request)
+        if 'content-encoding' in keys and not encoded:
             removeHeader('Content-Encoding', headers)
         if 'connection' in keys:
             removeHeader('Connection', headers)
@@ -103,81 +164,511 @@ class Proxy(object):
             local = str(self.url.host).split(":")[0]
             cookie = cookie.replace(local, host)
             headers['set-cookie'] = cookie
-            
-        proxy_response = Response(body=body, status=response.status_code)
+
+        if body is None:
+            proxy_response = Response(app_iter=self.streamIter(response), status=response.status_code)
+        else:
+            proxy_response = Response(body=body, status=response.status_code)
         proxy_response.headers.update(headers)
+        length = response.headers.get("Content-Length")
+        if length is not None and (body is None or request.method == "HEAD") and \
+                (encoded or response.headers.get("Content-Encoding", "identity") == "identity"):
+            # the unmodified body is passed to the client
+            proxy_response.content_length = int(length)
         alsoProvides(proxy_response, filtermanager.IProxyRequest)
-
-        # run post proxy request hooked filters
-        proxy_response = filtermanager.runPostHook(proxy_response, request, self.url)
-
         return proxy_response
 
-
-    def proxy(self, url, request, method=None, params=None):
-        log = logging.getLogger("outpost.proxy")
+    def streamIter(self, response):
+        """
+        Returns the app_iter for streamed backend responses.
+        """
+        if self.keepEncoding(response, self.request):
+            return RawStreamIter(response, self.chunksize)
+        return StreamIter(response, self.chunksize)
+
+    def readBody(self, response, request):
+        """
+        Reads the body of a streamed backend response. The body is not decoded if the
+        encoding is passed to the client.
+        """
+        if self.keepEncoding(response, request):
+            body = response.raw.read(decode_content=False)
+            response.raw.release_conn()
+            return body
+        return response.content
+
+    def keepEncoding(self, response, request):
+        """
+        Checks if the encoded backend response can be passed to the client without
+        decoding. Requires `proxy.passthrough` and no post filter matching the response
+        except `headers` mode filters and filters handling encoded bodies.
+        """
+        settings = request.registry.settings
+        if not asbool(settings.get("proxy.passthrough")):
+            return False
+        if response.headers.get("Content-Encoding", "identity") == "identity":
+            return False
+        ct = response.headers.get("Content-Type") or ""
+        empty = filtermanager.EmptyProxyResponse()
+        empty.status_int = response.status_code
+        empty.content_type = ct.split(";")[0]
+        for ff in filtermanager.lookupBodyFilters("post", empty, request, self.url, ("body", "stream")):
+            if not getattr(ff.callable, "encoded", False):
+                return False
+        return True
+
+
+    def streamPath(self, url):
+        """
+        Checks if the backend response for the url should be requested as stream.
+        """
+        settings = self.request.registry.settings
+        if not asbool(settings.get("proxy.stream")):
+            return False
+        path = settings.get("proxy.stream.path")
+        if path and re.search(path, str(url)) is None:
+            return False
+        return True
+
+    def streamResponse(self, response, request):
+        """
+        Checks if the streamed backend response can be passed to the client in chunks.
+        Returns False if the content type does not match `proxy.stream.content_type`
+        or a post filter requires the full body.
+        """
+        settings = request.registry.settings
+        ct = response.headers.get("Content-Type") or ""
+        match = settings.get("proxy.stream.content_type")
+        if match and re.search(match, ct) is None:
+            return False
+        ff = self.bodyFilter(response, request)
+        if ff is not None:
+            log = logging.getLogger("outpost.proxy")
+            log.debug("buffering response for filter %s: %s" % (str(ff), str(self.url)))
+            return False
+        return True
+
+    def bodyFilter(self, response, request, status=None):
+        """
+        Returns the first post filter requiring the full body of the backend response
+        or None. `status` replaces the response status for the lookup.
+        """
+        # lookup post filters with an empty response providing status and content type
+        ct = response.headers.get("Content-Type") or ""
+        empty = filtermanager.EmptyProxyResponse()
+        empty.status_int = status or response.status_code
+        empty.content_type = ct.split(";")[0]
+        return filtermanager.lookupBodyFilter("post", empty, request, self.url, self.bufferModes)
+
+    def prepare(self, url, request, method=None, params=None, stream=False, headers=None):
+        """
+        Prepares the backend request. `headers` replace the forwarded request headers.
+
+        :return: method, request parameter
+        """
         settings = request.registry.settings
 
         # prepare headers
+        extra = headers
         headers = {}
         for h,v in request.headers.environ.items():
             h = h.lower()
-            if h.startswith(("server_", "wsgi", "bfg", "webob", "outpost")):
+            if h.startswith(("server_", "wsgi", "bfg", "webob", "outpost", "asgi")):
                 continue
             elif h in ("proxy",):
                 continue
+            elif not isinstance(v, str) or h.find(".")!=-1:
+                # server extensions e.g. waitress.client-disconnected
+                continue
             elif h.startswith("http_"):
-                headers[h[5:]] = v
+                headers[h[5:].replace("_", "-")] = v
             elif h.find("_")!=-1:
                 headers[h.replace("_", "-")] = v
             else:
                 headers[h] = v
 
+        # headers listed in connection are hop-by-hop as well
+        hop = [h.strip().lower() for h in headers.get("connection", "").split(",")]
+        for h in HOP_HEADERS + tuple(hop):
+            headers.pop(h, None)
         headers["host"] = url.host
         headers["info"] = url.path
         if "content-length" in headers:
             del headers["content-length"]
-
-        parameter = {"headers": headers, "cookies": request.cookies, "timeout": float(settings.get("proxy.timeout"))}
+        if extra:
+            # None removes the header
+            for h,v in extra.items():
+                if v is None:
+                    headers.pop(h.lower(), None)
+                else:
+                    headers[h.lower()] = v
+        if "range" in headers:
+            # byte ranges of the unencoded body
+            headers["accept-encoding"] = "identity"
+        elif "accept-encoding" in headers:
+            # encoded responses are decoded if passthrough is off or a filter requires the body
+            headers["accept-encoding"] = compress.acceptDecodable(headers["accept-encoding"]) or "identity"
+
+        timeout = getattr(url, "timeout", None) or float(settings.get("proxy.timeout"))
+        parameter = {"headers": headers, "cookies": request.cookies, "timeout": timeout, "stream": stream}
         if request.method.lower() == "get":
             parameter["params"] = params or dict(request.params)
         else:
             parameter["data"] = params or request.body
+        return method or request.method, parameter
 
-        # request session cache on module level, supports keep-alive connections
-        usesession = settings.get("proxy.session", True)
-        if usesession:
-            global __session_cache__
-            if not __session_cache__:
-                __session_cache__ = requests.Session()
-                if settings.get("proxy.retry"):
-                    adapter = requests.adapters.HTTPAdapter(max_retries=int(settings.get("proxy.retry")),pool_connections=20,pool_maxsize=30)
-                    __session_cache__.mount("http://", adapter)
-            session = __session_cache__
-        else:
-            session = requests
+    def proxy(self, url, request, method=None, params=None, stream=False, headers=None):
+        """
+        Sends the request to the backend server.
+
+        If `stream` is true the body is not read and `None` is returned as body. Call
+        `response.iter_content()` or `response.content` to read the body.
+        `headers` replace the forwarded request headers e.g. for conditional requests.
+
+        :return: backend response, body
+        """
+        log = logging.getLogger("outpost.proxy")
+        settings = request.registry.settings
+        method, parameter = self.prepare(url, request, method, params, stream, headers)
+        # read the undecoded body
+        raw = asbool(settings.get("proxy.passthrough")) and not stream
+        if raw:
+            parameter["stream"] = True
+
+        # per thread sessions created by server.setup, supports keep-alive connections
+        sessions = getattr(url, "sessions", settings.get("proxy.sessions"))
 
         # trace in debugger
-        method = method or request.method
         if self.debug and settings.get("proxy.trace") and re.search(settings["proxy.trace"], url.destUrl):
             pdb.set_trace()
         try: #=> Ready to proxy the current request. Step once (n) to get the response. (c) to continue. Stack: method, url, parameter
-            response = session.request(method, url.destUrl, **parameter)
-            body = response.content
-            # status codes 200 - 299 are considered as success
-            if 200 <= response.status_code < 300:
-                size = response.raw.tell()
-                log.debug("%s %s, %d bytes in %d ms %s" % (method, response.status_code, size,
-                                                           response.elapsed.microseconds/1000, url.destUrl))
+            flight = settings.get("proxy.singleflight")
+            if flight is not None and not stream and method.upper() in ("GET", "HEAD"):
+                # share the backend response with concurrent identical requests
+                (response, body), shared = flight.do(flight.key(method, url, parameter["headers"]),
+                                                     lambda: self.call(sessions, method, url, parameter, raw))
+                if shared:
+                    request.environ["outpost.coalesced"] = True
+                    log.debug("%s %s, coalesced %s" % (method, response.status_code, url.destUrl))
             else:
-                log.debug("%s: %s %s, in %d ms %s" % (method, response.status_code, response.reason,
-                                                      response.elapsed.microseconds/1000, url.destUrl))
+                response, body = self.call(sessions, method, url, parameter, raw)
         except Exception as e:
             #todo excp types
             log.error("%s %s" % (str(e), url.destUrl))
             raise
+        if raw and body and not self.keepEncoding(response, request):
+            body = compress.decompress(body, response.headers.get("Content-Encoding"))
         return response, body
 
+    def upstream(self, url):
+        """
+        Returns the upstream group and the upstream selected by the url handler or
+        None, None for a single backend host.
+        """
+        upstreams = getattr(url, "upstreams", None)
+        if upstreams is None:
+            return None, None
+        return upstreams, url.upstream
+
+    def alternate(self, url):
+        """
+        Returns a copy of the url handler using the next available upstream or the url
+        handler itself for a single backend host.
+        """
+        upstreams, upstream = self.upstream(url)
+        if upstream is None:
+            return url
+        other = upstreams.alternate(upstream)
+        if other is upstream:
+            return url
+        url = copy.copy(url)
+        url.upstream = other
+        url.host = other.host
+        return url
+
+    def call(self, sessions, method, url, parameter, raw=False):
+        """
+        Sends the request with the session of the current thread. Failed requests of
+        idempotent methods are retried and hedged according to the retry policy of the
+        url handler (see `outpost.retry`).
+
+        :return: backend response, body
+        """
+        policy = getattr(url, "retry", None)
+        if policy is None or not policy.retryable(method):
+            return self.send(_session(sessions), method, url, parameter, raw)
+        log = logging.getLogger("outpost.proxy")
+        # raw reads are sent with stream=True but read the body completely
+        hedge = policy.hedge and not (parameter.get("stream") and not raw)
+        policy.budget.deposit()
+        attempt = 0
+        while True:
+            t = time.perf_counter()
+            try:
+                if hedge:
+                    response, body = self.hedged(policy, sessions, method, url, parameter, raw)
+                else:
+                    response, body = self.send(_session(sessions), method, url, parameter, raw)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if not self.retryAllowed(policy, attempt):
+                    raise
+                log.info("Retry %s %s: %s" % (method, url.destUrl, str(e)))
+            else:
+                if not policy.failed(response):
+                    policy.latency.record(time.perf_counter() - t)
+                    return response, body
+                if not self.retryAllowed(policy, attempt):
+                    return response, body
+                log.info("Retry %s %s: %s" % (method, url.destUrl, response.status_code))
+                response.close()
+            time.sleep(policy.backoffDelay(attempt))
+            attempt += 1
+            url = self.alternate(url)
+
+    def hedged(self, policy, sessions, method, url, parameter, raw=False):
+        """
+        Sends the request in the thread pool of the retry policy. If no response is
+        received within the hedge delay, a second request is sent to the next upstream
+        and the first successful response is returned.
+
+        The pool threads only send the requests. Metrics, timing and logging of the
+        returned response are recorded in the calling thread.
+
+        :return: backend response, body
+        """
+        stream = parameter.get("stream") and not raw
+
+        def fetch(url):
+            return url, self.fetch(_session(sessions), method, url, parameter, raw)
+
+        delay = policy.hedgeDelay()
+        if delay is None:
+            return self.send(_session(sessions), method, url, parameter, raw)
+        executor = policy.executor()
+        primary = executor.submit(fetch, url)
+        done, pending = futures.wait((primary,), timeout=delay)
+        if done or not policy.budget.withdraw():
+            url, (response, body, seconds) = primary.result()
+            self.observe(method, url, response, seconds, stream)
+            return response, body
+        self.countRetry("hedge")
+        hedge = executor.submit(fetch, self.alternate(url))
+        calls = [primary, hedge]
+        result = None
+        for call in futures.as_completed(calls):
+            calls.remove(call)
+            try:
+                current = call.result()
+            except Exception:
+                if calls:
+                    continue
+                if result is None:
+                    raise
+                current, result = result, None
+            response = current[1][0]
+            if policy.failed(response) and calls:
+                result = current
+                continue
+            for other in calls:
+                other.add_done_callback(_discard)
+            if result is not None:
+                result[1][0].close()
+            url, (response, body, seconds) = current
+            self.observe(method, url, response, seconds, stream)
+            return response, body
+
+    def retryAllowed(self, policy, attempt):
+        """
+        Returns true if retry number `attempt` (starting with 0) is allowed by the
+        policy and the retry budget.
+        """
+        if attempt >= policy.attempts:
+            return False
+        if not policy.budget.withdraw():
+            self.countRetry("exhausted")
+            return False
+        self.countRetry("retry")
+        return True
+
+    def countRetry(self, kind):
+        metrics = self.request.registry.settings.get("metrics.instance")
+        if metrics is not None:
+            metrics.inc("outpost_backend_retries_total", (kind,))
+
+    def send(self, session, method, url, parameter, raw=False):
+        """
+        Sends the prepared request. If `raw` is true the body is read without decoding.
+
+        :return: backend response, body
+        """
+        response, body, seconds = self.fetch(session, method, url, parameter, raw)
+        self.observe(method, url, response, seconds, parameter.get("stream") and not raw)
+        return response, body
+
+    def fetch(self, session, method, url, parameter, raw=False):
+        """
+        Sends the prepared request and tracks the upstream. Does not access the client
+        request, so it can be called in other threads.
+
+        :return: backend response, body, seconds
+        """
+        stream = parameter.get("stream")
+        upstreams, upstream = self.upstream(url)
+        if upstream is not None:
+            upstreams.acquire(upstream)
+        ok = False
+        t = time.perf_counter()
+        try:
+            response = session.request(method, url.destUrl, **parameter)
+            if raw:
+                body = response.raw.read(decode_content=False)
+                response.raw.release_conn()
+            else:
+                body = None if stream else response.content
+            ok = response.status_code not in balancer.FAILURE_STATUS
+        finally:
+            if upstream is not None:
+                upstreams.release(upstream, ok)
+        return response, body, time.perf_counter() - t
+
+    def observe(self, method, url, response, seconds, stream=False):
+        """
+        Records metrics and timing of a backend response and logs the request.
+        """
+        log = logging.getLogger("outpost.proxy")
+        metrics = self.request.registry.settings.get("metrics.instance")
+        if metrics is not None:
+            metrics.observe("outpost_backend_seconds", (str(response.status_code),), seconds)
+        profiling.timing(self.request, "backend", seconds)
+        # status codes 200 - 299 are considered as success
+        if stream:
+            log.debug("%s %s, streaming in %d ms %s" % (method, response.status_code,
+                                                        seconds*1000, url.destUrl))
+        elif 200 <= response.status_code < 300:
+            size = response.raw.tell()
+            log.debug("%s %s, %d bytes in %d ms %s" % (method, response.status_code, size,
+                                                       seconds*1000, url.destUrl))
+        else:
+            log.debug("%s: %s %s, in %d ms %s" % (method, response.status_code, response.reason,
+                                                  seconds*1000, url.destUrl))
+
+
+def _session(sessions):
+    # per thread session or the requests module without keep-alive
+    if sessions is None:
+        return requests
+    return sessions.session()
+
+
+def _discard(call):
+    # closes the response of a hedged request not used
+    if call.exception() is None:
+        call.result()[1][0].close()
+
+
+class SingleFlight(object):
+    """
+    Request coalescing for concurrent identical backend requests.
+
+    The first request for a key calls the backend, concurrent requests with the same key
+    wait for its result. Waiting requests call the backend themselves after `timeout`
+    seconds. The key is built from method, url and the values of the request headers
+    in `headers`.
+
+    Enabled by `proxy.coalesce = true`. Settings ::
+
+        proxy.coalesce.headers = authorization cookie accept accept-encoding accept-language
+        proxy.coalesce.timeout = 10
+
+    Only GET and HEAD requests without streaming are coalesced.
+    """
+    defaultHeaders = ("authorization", "cookie", "accept", "accept-encoding", "accept-language")
+
+    def __init__(self, headers=None, timeout=10.0):
+        self.headers = tuple(h.lower() for h in (headers or self.defaultHeaders))
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    @staticmethod
+    def fromSettings(settings):
+        headers = settings.get("proxy.coalesce.headers")
+        if headers:
+            headers = headers.replace(",", " ").split()
+        return SingleFlight(headers=headers, timeout=float(settings.get("proxy.coalesce.timeout") or 10))
+
+    def key(self, method, url, headers):
+        """
+        Returns the coalescing key. `headers` is the dictionary of lower case request
+        headers sent to the backend.
+        """
+        values = [method.upper(), resourceUrl(url)]
+        values.extend(str(headers.get(h, "")) for h in self.headers)
+        # include conditional request headers e.g. for cache revalidation
+        values.extend(str(headers.get(h, "")) for h in ("if-none-match", "if-modified-since", "range"))
+        return "\n".join(values)
+
+    def do(self, key, call):
+        """
+        Calls `call()` or waits for the result of the running call with the same key.
+
+        :return: result, shared
+        """
+        with self.lock:
+            flight = self.calls.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.calls[key] = _Flight()
+        if leader:
+            try:
+                flight.result = call()
+            except Exception as e:
+                flight.error = e
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                flight.done.set()
+            return flight.result, False
+        if not flight.done.wait(self.timeout):
+            return call(), False
+        if flight.error is not None:
+            raise flight.error
+        return flight.result, True
+
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class StreamIter(object):
+    """
+    WSGI app_iter passing the backend response to the client in chunks.
+    The backend connection is released when the iterator is closed.
+    """
+
+    def __init__(self, response, chunksize):
+        self.response = response
+        self.chunksize = chunksize
+
+    def __iter__(self):
+        return self.response.iter_content(self.chunksize)
+
+    def close(self):
+        self.response.close()
+
+
+class RawStreamIter(StreamIter):
+    """
+    WSGI app_iter passing the undecoded backend response to the client in chunks.
+    """
+
+    def __iter__(self):
+        return self.response.raw.stream(self.chunksize, decode_content=False)
+
 
 class ProxyUrlHandler(object):
     """
@@ -191,13 +682,19 @@ class ProxyUrlHandler(object):
   
         http://test.nive.io/datastore/api/keys
 
-    'http://test.nive.io' is looked up in the settings dict as `proxy.host`.
+    'http://test.nive.io' is looked up in the settings dict as `proxy.host` or in the
+    matching route of the routing table (see `outpost.routes`). If multiple hosts are
+    configured, the host is selected by the upstream group.
     
     Also urls in response bodies can be converted back to the source url.
     
     Attributes:
     - protocol: http or https
     - host: without protocol, including port
+    - origin: configured backend host(s) independent of the selected upstream
+    - route: matching route of the routing table `proxy.routes` or None
+    - timeout: backend timeout in seconds
+    - retry: retry policy (see `outpost.retry`) or None
     - path: path without protocol and domain
     - destUrl: valid proxy destination url
     - destDomain: valid proxy destination domain
@@ -211,12 +708,32 @@ class ProxyUrlHandler(object):
     
     """
     def __init__(self, request, settings):
-        self.host = settings.get("proxy.host")
-        self.protocol = settings.get("proxy.protocol") or "http"
         self.path = request.path_info     # path without host and query string
         self.qs = request.query_string
         if not self.path.startswith("/"):
             self.path = "/"+self.path
+        # backend route
+        self.route = None
+        self.sessions = settings.get("proxy.sessions")
+        self.upstreams = settings.get("proxy.upstreams")
+        self.retry = settings.get("proxy.retrypolicy")
+        table = settings.get("proxy.routetable")
+        if table is not None:
+            self.route = table.match(self.path)
+            if self.route is not None:
+                settings = self.route.settings
+                self.sessions = self.route.sessions or self.sessions
+                self.upstreams = self.route.upstreams
+                self.retry = self.route.retry
+            elif not settings.get("proxy.host"):
+                raise HTTPNotFound()
+        self.host = self.origin = settings.get("proxy.host")
+        self.upstream = None
+        if self.upstreams is not None:
+            self.upstream = self.upstreams.select(request)
+            self.host = self.upstream.host
+        self.protocol = settings.get("proxy.protocol") or "http"
+        self.timeout = float(settings.get("proxy.timeout") or 60)
         self.pathrewrite = None
         rw = settings.get("proxy.rewrite")
         if rw:
@@ -236,6 +753,14 @@ class ProxyUrlHandler(object):
             return "%s://%s%s?%s" % (self.protocol, self.host, self.rewritePath(self.path), self.qs)
         return "%s://%s%s" % (self.protocol, self.host, self.rewritePath(self.path))
 
+    @property
+    def keyPath(self):
+        # full path with the configured host(s) instead of the selected upstream host.
+        # used for cache and coalescing keys.
+        if self.qs:
+            return "%s://%s%s?%s" % (self.protocol, self.origin, self.rewritePath(self.path), self.qs)
+        return "%s://%s%s" % (self.protocol, self.origin, self.rewritePath(self.path))
+
     @property
     def destUrl(self):
         return "%s://%s%s" % (self.protocol, self.host, self.rewritePath(self.path))
@@ -0,0 +1,227 @@
+# Copyright 2015 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under BSD-license. See license.txt
+#
+"""
+Retries and hedged requests
+---------------------------
+Failed backend requests of idempotent methods are retried with exponential backoff and
+full jitter. Connection errors, timeouts and responses with a status listed in
+`proxy.retry.status` are retried up to `proxy.retry.attempts` times. If multiple backend
+hosts are configured (see `outpost.upstream`) a retry is sent to the next available host.
+
+Retries are limited by a retry budget shared by all requests of the process. Within the
+last 10 seconds the number of retries may not exceed `proxy.retry.budget` times the
+number of requests plus `proxy.retry.budget.min` retries per second. If a backend fails
+completely the backend load grows by the budget ratio instead of the number of attempts.
+
+Hedged requests (`proxy.hedge = true`) send a duplicate request to another backend host
+if the backend has not responded within the `proxy.hedge.percentile` latency of recent
+requests (or the fixed `proxy.hedge.delay`). The first successful response wins. Hedged
+requests take their share of the retry budget. Streamed requests are retried but not
+hedged.
+
+Settings ::
+
+    proxy.retry.attempts = 0            max. retries per request. 0 disables retries
+    proxy.retry.methods = GET HEAD OPTIONS PUT DELETE
+    proxy.retry.status = 502 503 504    response status codes to retry
+    proxy.retry.backoff = 0.025         base delay in seconds, doubled for each retry
+    proxy.retry.backoff.max = 1         max. delay in seconds
+    proxy.retry.budget = 0.2            retries allowed per request
+    proxy.retry.budget.min = 10         retries allowed per second regardless of traffic
+    proxy.hedge = false                 send hedged requests
+    proxy.hedge.percentile = 95         latency percentile of recent requests to wait for
+    proxy.hedge.delay =                 fixed delay in seconds instead of the percentile
+    proxy.hedge.threads = 20            thread pool size for hedged requests
+
+`proxy.retry` sets the connection retries of the connection pool (see `outpost.pool`)
+and is applied to each attempt.
+
+The `RetryPolicy` is stored as `proxy.retrypolicy` in the settings. Routes (see
+`outpost.routes`) have their own policy sharing the retry budget.
+"""
+import os
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pyramid.settings import asbool
+
+from outpost.upstream import FAILURE_STATUS
+
+IDEMPOTENT = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+
+class RetryBudget(object):
+    """
+    Limits retries to a ratio of requests in a sliding window of one second slots.
+    """
+
+    def __init__(self, ratio=0.2, minimum=10.0, window=10):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.window = window
+        self.stamps = [-1] * window
+        self.requests = [0] * window
+        self.retries = [0] * window
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def _slot(self, now):
+        second = int(now)
+        i = second % self.window
+        if self.stamps[i] != second:
+            self.stamps[i] = second
+            self.requests[i] = 0
+            self.retries[i] = 0
+        return i
+
+    def deposit(self):
+        """
+        Counts a request.
+        """
+        with self.lock:
+            self.requests[self._slot(time.monotonic())] += 1
+
+    def withdraw(self):
+        """
+        Returns true and counts the retry if the budget allows another retry.
+        """
+        now = time.monotonic()
+        with self.lock:
+            i = self._slot(now)
+            oldest = int(now) - self.window
+            requests = retries = 0
+            for n in range(self.window):
+                if self.stamps[n] > oldest:
+                    requests += self.requests[n]
+                    retries += self.retries[n]
+            if retries < self.ratio * requests + self.minimum * self.window:
+                self.retries[i] += 1
+                return True
+            self.rejected += 1
+            return False
+
+
+class Latency(object):
+    """
+    Recent backend latencies. Percentiles are recalculated every `interval` samples.
+    """
+
+    def __init__(self, size=1000, interval=100, minsamples=20):
+        self.size = size
+        self.interval = interval
+        self.minsamples = minsamples
+        self.samples = []
+        self.pos = 0
+        self.count = 0
+        self.sorted = None
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            if len(self.samples) < self.size:
+                self.samples.append(seconds)
+            else:
+                self.samples[self.pos] = seconds
+                self.pos = (self.pos + 1) % self.size
+            self.count += 1
+            if len(self.samples) >= self.minsamples and (self.sorted is None or self.count % self.interval == 0):
+                self.sorted = sorted(self.samples)
+
+    def percentile(self, p):
+        """
+        Returns the latency percentile in seconds or None if there are not enough samples.
+        """
+        values = self.sorted
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class RetryPolicy(object):
+    """
+    Retry and hedging configuration of a backend. `Proxy.call()` runs the requests.
+    """
+
+    def __init__(self, attempts=0, methods=IDEMPOTENT, status=FAILURE_STATUS, backoff=0.025,
+                 maxbackoff=1.0, budget=None, hedge=False, percentile=95.0, delay=None, threads=20):
+        self.attempts = attempts
+        self.methods = tuple(m.upper() for m in methods)
+        self.status = tuple(status)
+        self.backoff = backoff
+        self.maxbackoff = maxbackoff
+        self.budget = budget or RetryBudget()
+        self.hedge = hedge
+        self.percentile = percentile
+        self.delay = delay
+        self.threads = threads
+        self.latency = Latency()
+        self.pid = None
+        self.pool = None
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def fromSettings(settings, budget=None):
+        """
+        Returns the policy or None if retries and hedging are disabled. The retry
+        budget is created if `budget` is None.
+        """
+        attempts = int(settings.get("proxy.retry.attempts") or 0)
+        hedge = asbool(settings.get("proxy.hedge", False))
+        if not attempts and not hedge:
+            return None
+        if budget is None:
+            budget = RetryBudget(ratio=float(settings.get("proxy.retry.budget") or 0.2),
+                                 minimum=float(settings.get("proxy.retry.budget.min") or 10))
+        methods = settings.get("proxy.retry.methods")
+        status = settings.get("proxy.retry.status")
+        delay = settings.get("proxy.hedge.delay")
+        return RetryPolicy(attempts=attempts,
+                           methods=methods.replace(",", " ").split() if methods else IDEMPOTENT,
+                           status=[int(s) for s in status.replace(",", " ").split()] if status else FAILURE_STATUS,
+                           backoff=float(settings.get("proxy.retry.backoff") or 0.025),
+                           maxbackoff=float(settings.get("proxy.retry.backoff.max") or 1),
+                           budget=budget,
+                           hedge=hedge,
+                           percentile=float(settings.get("proxy.hedge.percentile") or 95),
+                           delay=float(delay) if delay else None,
+                           threads=int(settings.get("proxy.hedge.threads") or 20))
+
+    def retryable(self, method):
+        return method.upper() in self.methods
+
+    def failed(self, response):
+        """
+        Returns true if the response status should be retried.
+        """
+        return response.status_code in self.status
+
+    def backoffDelay(self, attempt):
+        """
+        Returns the random delay in seconds before retry number `attempt` (starting with 0).
+        """
+        return random.uniform(0, min(self.maxbackoff, self.backoff * 2 ** attempt))
+
+    def hedgeDelay(self):
+        """
+        Returns the seconds to wait before sending a hedged request or None if the latency
+        is not known yet.
+        """
+        if self.delay is not None:
+            return self.delay
+        return self.latency.percentile(self.percentile)
+
+    def executor(self):
+        """
+        Returns the thread pool for hedged requests of the current process.
+        """
+        if self.pid == os.getpid():
+            return self.pool
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pool = ThreadPoolExecutor(self.threads, thread_name_prefix="outpost-hedge")
+                self.pid = os.getpid()
+        return self.pool
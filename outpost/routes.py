@@ -0,0 +1,167 @@
+# Copyright 2015 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under BSD-license. See license.txt
+#
+"""
+Proxy routing table
+-------------------
+Maps path prefixes and regular expressions of proxied requests to different backends.
+Each route can define its own host (or list of hosts, see `outpost.upstream`),
+protocol, path rewrite, timeout, balancing policy and connection pool settings.
+Values not set in the route default to the global `proxy.*` settings ::
+
+    proxy.route = /
+    proxy.host = www.backend.local
+    proxy.routes = [
+        {"prefix": "/api/users", "host": "users.local:8080 users2.local:8080",
+         "rewrite": "/api/users /users", "timeout": 10, "balance": "leastconn",
+         "pool": {"maxsize": 50}},
+        {"regex": "^/api/v[0-9]+/orders", "host": "orders.local:8080", "protocol": "https"}
+      ]
+
+Route keys: `prefix` or `regex`, `host`, `protocol`, `rewrite`, `timeout`, `balance`,
+`hash`, `failures`, `eject`, `health` (health check path), `retry` (attempts), `hedge`
+and `pool` with `connections`, `maxsize` and `block`.
+
+Prefixes match complete path segments: `/api/users` matches `/api/users` and
+`/api/users/1` but not `/api/usersearch`. The longest matching prefix wins. Regular
+expressions are tried in configured order if no prefix matches. Requests not matching
+any route are sent to `proxy.host` or answered with 404 if no default host is set.
+
+Routes are matched against the path of requests handled by the proxy route
+(`proxy.route`). Prefixes are stored in a trie of path segments and regular
+expressions are merged in a single expression, so the lookup time does not depend
+on the number of routes.
+
+The compiled `RouteTable` is stored as `proxy.routetable` in the settings.
+"""
+import json
+import re
+
+from pyramid.settings import asbool
+
+from outpost.filtermanager import ConfigurationError
+from outpost.retry import RetryPolicy
+from outpost.session import SessionManager
+from outpost.upstream import UpstreamGroup
+
+# route keys mapped to proxy settings
+KEYS = {"host": "proxy.host", "protocol": "proxy.protocol", "rewrite": "proxy.rewrite",
+        "timeout": "proxy.timeout", "balance": "proxy.balance", "hash": "proxy.balance.hash",
+        "failures": "proxy.upstream.failures", "eject": "proxy.upstream.eject",
+        "health": "proxy.health.path", "retry": "proxy.retry.attempts", "hedge": "proxy.hedge"}
+
+POOLKEYS = {"connections": "proxy.pool.connections", "maxsize": "proxy.pool.maxsize",
+            "block": "proxy.pool.block"}
+
+# global settings used as route defaults
+DEFAULTS = ("proxy.protocol", "proxy.timeout", "proxy.balance", "proxy.balance.hash",
+            "proxy.upstream.failures", "proxy.upstream.eject", "proxy.health.interval",
+            "proxy.health.timeout", "proxy.pool.connections", "proxy.pool.maxsize",
+            "proxy.pool.block", "proxy.retry", "proxy.retry.attempts", "proxy.retry.methods",
+            "proxy.retry.status", "proxy.retry.backoff", "proxy.retry.backoff.max", "proxy.hedge",
+            "proxy.hedge.percentile", "proxy.hedge.delay", "proxy.hedge.threads")
+
+
+class Route(object):
+    """
+    Backend route. `settings` contains the route specific `proxy.*` settings used by
+    `ProxyUrlHandler` and `Proxy`.
+
+    - sessions: session manager with the routes connection pools or None to use the
+      global sessions
+    - upstreams: upstream group if multiple hosts are configured
+    - retry: retry policy or None
+    """
+
+    def __init__(self, conf, settings):
+        self.prefix = conf.get("prefix")
+        self.regex = conf.get("regex")
+        if not self.prefix and not self.regex:
+            raise ConfigurationError("Proxy route requires prefix or regex: %s" % json.dumps(conf))
+        if not conf.get("host"):
+            raise ConfigurationError("Proxy route requires a host: %s" % json.dumps(conf))
+        self.name = conf.get("name") or self.prefix or self.regex
+        values = dict((key, settings[key]) for key in DEFAULTS if settings.get(key) is not None)
+        for key, name in KEYS.items():
+            if conf.get(key) is not None:
+                values[name] = str(conf[key])
+        pool = conf.get("pool")
+        for key, name in POOLKEYS.items():
+            if pool and pool.get(key) is not None:
+                values[name] = str(pool[key])
+        self.settings = values
+        self.sessions = None
+        if pool and asbool(settings.get("proxy.session", True)):
+            self.sessions = SessionManager(values)
+        self.upstreams = UpstreamGroup.fromSettings(values)
+        # the retry budget is shared with the global policy
+        self.retry = RetryPolicy.fromSettings(values, getattr(settings.get("proxy.retrypolicy"), "budget", None))
+
+    def __str__(self):
+        return self.name
+
+
+class RouteTable(object):
+    """
+    Compiled routing table. `match(path)` returns the route for the path or None.
+    """
+
+    def __init__(self, routes):
+        self.routes = tuple(routes)
+        self.trie = {}
+        expressions = []
+        for i, route in enumerate(self.routes):
+            if route.prefix:
+                node = self.trie
+                for segment in _segments(route.prefix):
+                    node = node.setdefault(segment, {})
+                # the first route with an equal prefix wins
+                node.setdefault(None, route)
+            else:
+                expressions.append("(?P<_r%d>%s)" % (i, route.regex))
+        self.regex = re.compile("|".join(expressions)) if expressions else None
+
+    @staticmethod
+    def fromSettings(settings):
+        """
+        Parses `proxy.routes` (json list) and returns the table or None if no routes
+        are configured.
+        """
+        conf = settings.get("proxy.routes")
+        if isinstance(conf, str):
+            conf = conf.strip()
+            if not conf:
+                return None
+            try:
+                conf = json.loads(conf)
+            except ValueError as e:
+                raise ConfigurationError("Invalid proxy.routes: %s" % str(e))
+        if not conf:
+            return None
+        if isinstance(conf, dict):
+            conf = [conf]
+        return RouteTable([Route(c, settings) for c in conf])
+
+    def match(self, path):
+        """
+        Returns the route with the longest matching prefix or the first matching
+        regular expression.
+        """
+        node = self.trie
+        route = node.get(None)
+        for segment in _segments(path):
+            node = node.get(segment)
+            if node is None:
+                break
+            route = node.get(None, route)
+        if route is not None:
+            return route
+        if self.regex is not None:
+            m = self.regex.match(path)
+            if m is not None:
+                return self.routes[int(m.lastgroup[2:])]
+        return None
+
+
+def _segments(path):
+    return [s for s in path.split("/") if s]
@@ -5,10 +5,18 @@ import logging
 import os
 
 from pyramid.config import Configurator
+from pyramid.settings import asbool
 
 from outpost import filtermanager
-from outpost.proxy import callProxy
-from outpost.files import serveFile
+from outpost import pool
+from outpost import metrics
+from outpost import profiling
+from outpost.session import SessionManager
+from outpost.proxy import callProxy, SingleFlight
+from outpost.files import serveFile, staticView, FileIndex, AssetCache
+from outpost.upstream import UpstreamGroup
+from outpost.routes import RouteTable
+from outpost.retry import RetryPolicy
 
 
 def setup(global_config, **settings):
@@ -23,10 +31,14 @@ def setup(global_config, **settings):
 
     fileroute=proxyroute = None
     debug = settings.get("debug")
+    # template filters reload changed templates only in debug mode
+    if asbool(debug):
+        settings["pyramid.reload_templates"] = "true"
 
     # parse filter
     fstr = settings.get("filter")
-    settings["filter"] = filtermanager.parseJsonString(fstr, exitOnTestFailure=not debug)
+    settings["filter"] = filtermanager.parseJsonString(fstr, exitOnTestFailure=not debug,
+                                                       cachesize=settings.get("filter.cachesize"))
 
     # set up local file directory
     directory = settings.get("files.directory")
@@ -57,12 +69,23 @@ def setup(global_config, **settings):
     if path and not path.startswith("/"):
         settings["server.default_path"] = "/"+path
 
+    if directory:
+        # static view and file index are shared by all requests
+        settings["files.static"] = staticView(settings)
+        settings["files.index"] = FileIndex.fromSettings(settings)
+        if settings["files.index"] is not None:
+            settings["files.cache"] = AssetCache.fromSettings(settings)
+
     # set up proxy routing
     host = settings.get("proxy.host")
     # bw 0.2.6 renamed ini file setting
     if host is None:
         host = settings.get("proxy.domain")
-    if not host:
+    # retries and hedged requests. created first, routes share the retry budget.
+    settings["proxy.retrypolicy"] = RetryPolicy.fromSettings(settings)
+    # path based backend routes
+    settings["proxy.routetable"] = RouteTable.fromSettings(settings)
+    if not host and settings["proxy.routetable"] is None:
         log.info("Proxy target host empty ('proxy.host'). Request proxy disabled.")
     else:
         proxyroute = settings.get("proxy.route")
@@ -71,10 +94,25 @@ def setup(global_config, **settings):
         if not proxyroute.endswith("/"):
             proxyroute += "/"
         log.info("Proxying requests with path prefix '%s' to '%s'", proxyroute, host)
+        for route in getattr(settings["proxy.routetable"], "routes", ()):
+            log.info("Proxy route '%s' to '%s'", route.name, route.settings["proxy.host"])
+        # balance requests between multiple backend hosts
+        settings["proxy.upstreams"] = UpstreamGroup.fromSettings(settings)
+        # request sessions support keep-alive connections
+        if asbool(settings.get("proxy.session", True)):
+            settings["proxy.sessions"] = SessionManager(settings)
+        # coalesce concurrent identical requests
+        if asbool(settings.get("proxy.coalesce")):
+            settings["proxy.singleflight"] = SingleFlight.fromSettings(settings)
 
     if directory and fileroute==proxyroute:
         raise filtermanager.ConfigurationError("File and proxy routing is equal.")
 
+    # request metrics, filter timing and profiling
+    settings["metrics.instance"] = metrics.Metrics.fromSettings(settings)
+    settings["filter.timing"] = asbool(settings.get("filter.timing"))
+    settings["profile.sampler"] = profiling.Sampler.fromSettings(settings)
+
     # setup pyramid configuration and routes
     config = Configurator(settings = settings)
 
@@ -89,6 +127,30 @@ def setup(global_config, **settings):
         config.add_route("files", route+"*subpath")
         config.add_view(serveFile, route_name="files")
 
+    # connection pool statistics
+    statspath = settings.get("proxy.pool.stats")
+    if statspath:
+        config.add_route("pool.stats", statspath)
+        config.add_view(lambda request: pool.statistics(), route_name="pool.stats", renderer="json")
+
+    # metrics in prometheus format
+    if settings["metrics.instance"] is not None:
+        config.add_tween("outpost.metrics.tween")
+        config.add_route("metrics", settings["metrics.path"])
+        config.add_view(metrics.metricsView, route_name="metrics")
+
+    if settings["filter.timing"]:
+        config.add_tween("outpost.profiling.timingTween")
+    if settings["profile.sampler"] is not None:
+        config.add_tween("outpost.profiling.profileTween")
+
+    # asset cache statistics
+    statspath = settings.get("files.cache.stats")
+    if statspath and settings.get("files.cache") is not None:
+        assets = settings["files.cache"]
+        config.add_route("files.cache.stats", statspath)
+        config.add_view(lambda request: assets.statistics(), route_name="files.cache.stats", renderer="json")
+
     # swap order of route registration to handle fallbacks
     fallback = settings.get("server.fallback")
 
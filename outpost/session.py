@@ -0,0 +1,98 @@
+# Copyright 2015 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under BSD-license. See license.txt
+#
+"""
+Proxy sessions
+--------------
+The session manager is created by `server.setup()` and stored as `proxy.sessions` in the
+settings. Each thread uses its own `requests.Session`, all sessions share one connection
+pool adapter (see `outpost.pool`). In forked worker processes new sessions and pools are
+created on first use. Sessions are closed on shutdown.
+
+Cookies are not stored in the sessions. Client cookies are forwarded with each request
+and backend cookies are returned to the client.
+"""
+import atexit
+import os
+import threading
+import weakref
+
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+
+from outpost import pool
+
+__managers__ = weakref.WeakSet()
+
+
+class SessionManager(object):
+    """
+    Thread safe requests session provider. Call `session()` to get the session of the
+    current thread.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+        self._setup()
+        __managers__.add(self)
+
+    def _setup(self):
+        self.pid = os.getpid()
+        self.local = threading.local()
+        self.adapter = pool.adapterFromSettings(self.settings)
+        self.sessions = []
+
+    def session(self):
+        """
+        Returns the session for the current thread.
+        """
+        if self.pid != os.getpid():
+            self.reset()
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            # do not share backend cookies between clients
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            pool.mount(session, self.adapter)
+            with self.lock:
+                self.sessions.append(session)
+            self.local.session = session
+        return session
+
+    def reset(self):
+        """
+        Drops all sessions and connection pools without closing the connections. Called
+        in forked child processes; the connections belong to the parent process.
+        """
+        # the inherited lock may be held by a thread of the parent process
+        self.lock = threading.Lock()
+        self._setup()
+
+    def close(self):
+        """
+        Closes all sessions and pooled connections.
+        """
+        with self.lock:
+            sessions = self.sessions
+            adapter = self.adapter
+            self._setup()
+        for session in sessions:
+            session.close()
+        adapter.close()
+
+
+def _afterFork():
+    for manager in list(__managers__):
+        manager.reset()
+
+
+def _shutdown():
+    for manager in list(__managers__):
+        manager.close()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_afterFork)
+atexit.register(_shutdown)
@@ -6,6 +6,8 @@ import time
 
 import multiprocessing
 
+from outpost.tests.loadtest import Histogram
+
 class ClientRunner(multiprocessing.Process):
     name = ""
     loops = 0
@@ -35,12 +37,12 @@ class ClientRunner(multiprocessing.Process):
     def req(self, link):
         time.sleep(self.delay)
         url = self.host+link
-        t = time.time()
+        t = time.perf_counter()
         try:
             response = requests.request(self.options.get("method","GET"), url, **self.parameter)
             return (link,
                     response.status_code,
-                    response.elapsed.microseconds/1000.0/1000.0,
+                    time.perf_counter()-t,
                     len(response.content)+len(str(response.raw.headers)),
                     response.raw.tell(),
                     response.reason
@@ -48,7 +50,7 @@ class ClientRunner(multiprocessing.Process):
         except requests.exceptions.ConnectionError as e:
             return (link,
                     999,
-                    time.time()-t,
+                    time.perf_counter()-t,
                     0,
                     0,
                     str(e)
@@ -90,7 +92,12 @@ def report(stats, runtime):
             mlen = len(file)
     for file in files:
         fl = files[file]
-        print(file, " "*(mlen-len(file)), "- avg", "%.04f"%(sum(fl)/len(fl)), " min", "%.04f"%min(fl), " max", "%.04f"%max(fl), " size", sizes[file])
+        h = Histogram()
+        for v in fl:
+            h.record(v)
+        print(file, " "*(mlen-len(file)), "- avg", "%.04f"%(sum(fl)/len(fl)), " min", "%.04f"%min(fl), " max", "%.04f"%max(fl),
+              " p50", "%.04f"%h.percentile(50), " p90", "%.04f"%h.percentile(90), " p99", "%.04f"%h.percentile(99),
+              " size", sizes[file])
 
     for err in errors:
         print(err)
@@ -0,0 +1,419 @@
+# Copyright 2015 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under BSD-license. See license.txt
+#
+"""
+Load benchmark
+--------------
+Runs predefined load scenarios against a local outpost server and a stand-in backend
+and reports throughput and latency percentiles as JSON. Both servers run in separate
+processes, the load generator uses one thread and keep-alive session per connection.
+
+Modes:
+
+- closed: `concurrency` clients send the next request as soon as the previous
+  response is received. Measures the maximum throughput.
+- open: requests are scheduled at a fixed `rate` regardless of response times.
+  Latency is measured from the scheduled start, so queueing delays are included
+  (no coordinated omission).
+
+Scenarios:
+
+- static: small and medium static files served from the file directory
+- json: small JSON responses from the proxied backend
+- large: 2 MB proxied response body
+- html: proxied HTML page with replacestr, appendhead and template filters
+
+Usage ::
+
+    python -m outpost.tests.loadtest --scenario json --mode closed --concurrency 10 --duration 10
+    python -m outpost.tests.loadtest --scenario all --mode open --rate 200 --output result.json
+    python -m outpost.tests.loadtest --scenario all --compare result.json
+
+`--compare` loads a previous result file and reports scenarios whose throughput
+dropped or p99 latency increased by more than `--tolerance` (default 0.1).
+The exit code is 1 if a regression is found.
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+
+class Histogram(object):
+    """
+    Log-linear latency histogram in the style of HdrHistogram. Values are recorded in
+    microseconds. Each power of two range is split into `subbuckets` linear buckets,
+    so percentiles are accurate within 1/subbuckets relative error.
+    """
+
+    def __init__(self, subbuckets=128):
+        self.subbuckets = subbuckets
+        self.shift = subbuckets.bit_length() - 1
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def index(self, value):
+        # bucket index of a value in microseconds
+        exponent = max(value.bit_length() - self.shift - 1, 0)
+        return (exponent << self.shift) + (value >> exponent)
+
+    def value(self, index):
+        # highest value of the bucket
+        exponent = max((index >> self.shift) - 1, 0)
+        sub = index - (exponent << self.shift)
+        return ((sub + 1) << exponent) - 1
+
+    def record(self, seconds):
+        value = max(int(round(seconds * 1000000)), 0)
+        i = self.index(value)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, count in other.counts.items():
+            self.counts[i] = self.counts.get(i, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        """
+        Returns the value at percentile `p` (0-100) in seconds.
+        """
+        if not self.count:
+            return 0.0
+        rank = max(int(round(p / 100.0 * self.count)), 1)
+        seen = 0
+        for i in sorted(self.counts):
+            seen += self.counts[i]
+            if seen >= rank:
+                return min(self.value(i), self.max) / 1000000.0
+        return self.max / 1000000.0
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "min": (self.min or 0) / 1000000.0,
+            "mean": self.total / 1000000.0 / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p99.9": self.percentile(99.9),
+            "max": self.max / 1000000.0,
+        }
+
+
+# stand-in backend ---------------------------------------------------------------
+
+SMALL_JSON = b'{"id": 1, "name": "outpost", "items": [1, 2, 3], "active": true}'
+LARGE_BODY = b"0123456789abcdef" * (128 * 1024)
+HTML_PAGE = (b"<html><head><title>Page</title></head><body>" +
+             b"<p><a href='http://backend/page'>Link</a> Lorem ipsum dolor sit amet.</p>" * 500 +
+             b"</body></html>")
+
+
+def backend(environ, start_response):
+    """
+    WSGI app simulating a backend with small JSON, large and HTML responses.
+    """
+    path = environ["PATH_INFO"]
+    if path.endswith(".json"):
+        body, ct = SMALL_JSON, "application/json"
+    elif path.endswith(".bin"):
+        body, ct = LARGE_BODY, "application/octet-stream"
+    else:
+        body, ct = HTML_PAGE, "text/html; charset=utf-8"
+    start_response("200 OK", [("Content-Type", ct), ("Content-Length", str(len(body)))])
+    return [body]
+
+
+def serve(app, ports, threads):
+    # runs in a child process. reports the port to the parent.
+    import waitress
+    logging.getLogger("waitress").setLevel(logging.ERROR)
+    server = waitress.create_server(app, host="127.0.0.1", port=0, threads=threads)
+    ports.put(server.effective_port)
+    server.run()
+
+
+def serveOutpost(settings, ports, threads):
+    from outpost.server import main
+    serve(main({}, **settings), ports, threads)
+
+
+def start(target, args):
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=target, args=args + (ports,) + (8,))
+    process.daemon = True
+    process.start()
+    port = int(ports.get(timeout=30))
+    return process, port
+
+
+# scenarios ----------------------------------------------------------------------
+
+SCENARIOS = {
+    "static": {"links": ["/files/small.txt", "/files/medium.js"], "filter": []},
+    "json": {"links": ["/proxy/data.json"], "filter": []},
+    "large": {"links": ["/proxy/large.bin"], "filter": []},
+    "html": {"links": ["/proxy/page.html"], "filter": [
+        {"callable": "outpost.filterinc.replacestr", "hook": "post", "content_type": "text/html",
+         "settings": {"replace": [{"str": "http://backend/", "new": "/proxy/"},
+                                  {"str": "Lorem", "new": "LOREM"}]}},
+        {"callable": "outpost.filterinc.appendhead", "hook": "post", "content_type": "text/html",
+         "settings": {"appendhead": "{directory}/snippet.html"}},
+        {"callable": "outpost.filterinc.template", "hook": "post", "content_type": "text/html",
+         "settings": {"template": "{directory}/main.pt", "splice": True}},
+    ]},
+}
+
+
+def prepareDirectory():
+    """
+    Creates the file directory with static files, snippet and template.
+    """
+    directory = tempfile.mkdtemp(prefix="outpost-bench-")
+    files = {"small.txt": b"x" * 1024,
+             "medium.js": b"var a = 1;\n" * 10000,
+             "snippet.html": b"<script>var config = {};</script>",
+             "main.pt": b"<div class='layout'>${structure: content}</div>"}
+    for name, data in files.items():
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(data)
+    return directory
+
+
+def serverSettings(scenario, backendport, directory):
+    filters = json.dumps(SCENARIOS[scenario]["filter"]).replace("{directory}", directory)
+    return {"proxy.host": "127.0.0.1:%d" % backendport,
+            "proxy.route": "proxy",
+            "proxy.timeout": "30",
+            "files.directory": directory,
+            "files.route": "files",
+            "pyramid.includes": "pyramid_chameleon",
+            "filter": filters}
+
+
+# load generator -----------------------------------------------------------------
+
+class Result(object):
+    """
+    Latency histogram and counters of one worker.
+    """
+
+    def __init__(self):
+        self.histogram = Histogram()
+        self.requests = 0
+        self.errors = 0
+        self.bytes = 0
+
+    def merge(self, other):
+        self.histogram.merge(other.histogram)
+        self.requests += other.requests
+        self.errors += other.errors
+        self.bytes += other.bytes
+
+
+def fetch(session, url, result, started):
+    try:
+        response = session.get(url)
+        size = len(response.content)
+        ok = 200 <= response.status_code < 400
+    except requests.exceptions.RequestException:
+        size, ok = 0, False
+    result.histogram.record(time.perf_counter() - started)
+    result.requests += 1
+    result.bytes += size
+    if not ok:
+        result.errors += 1
+
+
+def closedLoop(urls, concurrency, duration):
+    """
+    Each worker sends requests back to back until `duration` seconds passed.
+    """
+    results = [Result() for i in range(concurrency)]
+    end = time.perf_counter() + duration
+
+    def worker(result, offset):
+        session = requests.Session()
+        i = offset
+        while time.perf_counter() < end:
+            fetch(session, urls[i % len(urls)], result, time.perf_counter())
+            i += 1
+        session.close()
+
+    runThreads(worker, results)
+    return results
+
+
+def openLoop(urls, concurrency, duration, rate):
+    """
+    Requests are scheduled every 1/rate seconds and processed by `concurrency`
+    workers. Latency includes the time a request waited for a free worker.
+    """
+    results = [Result() for i in range(concurrency)]
+    schedule = queue.Queue()
+    count = int(duration * rate)
+    begin = time.perf_counter() + 0.1
+    for i in range(count):
+        schedule.put((begin + i / float(rate), urls[i % len(urls)]))
+
+    def worker(result, offset):
+        session = requests.Session()
+        while True:
+            try:
+                started, url = schedule.get_nowait()
+            except queue.Empty:
+                break
+            wait = started - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            fetch(session, url, result, started)
+        session.close()
+
+    runThreads(worker, results)
+    return results
+
+
+def runThreads(worker, results):
+    threads = [threading.Thread(target=worker, args=(result, i)) for i, result in enumerate(results)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def runScenario(scenario, mode="closed", concurrency=10, duration=10.0, rate=100, warmup=1.0):
+    """
+    Starts backend and outpost server and runs the scenario.
+
+    :return: dict with throughput and latency percentiles in seconds
+    """
+    directory = prepareDirectory()
+    processes = []
+    try:
+        process, backendport = start(serve, (backend,))
+        processes.append(process)
+        process, port = start(serveOutpost, (serverSettings(scenario, backendport, directory),))
+        processes.append(process)
+        urls = ["http://127.0.0.1:%d%s" % (port, link) for link in SCENARIOS[scenario]["links"]]
+        if warmup:
+            closedLoop(urls, concurrency, warmup)
+        t = time.perf_counter()
+        if mode == "open":
+            results = openLoop(urls, concurrency, duration, rate)
+        else:
+            results = closedLoop(urls, concurrency, duration)
+        runtime = time.perf_counter() - t
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        shutil.rmtree(directory, ignore_errors=True)
+    total = Result()
+    for result in results:
+        total.merge(result)
+    return {"scenario": scenario,
+            "mode": mode,
+            "concurrency": concurrency,
+            "rate": rate if mode == "open" else None,
+            "duration": runtime,
+            "requests": total.requests,
+            "errors": total.errors,
+            "bytes": total.bytes,
+            "throughput": total.requests / runtime if runtime else 0.0,
+            "latency": total.histogram.summary()}
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compares results with a baseline result file.
+
+    :return: list of regression messages
+    """
+    previous = dict(((r["scenario"], r["mode"]), r) for r in baseline.get("results", ()))
+    regressions = []
+    for result in results:
+        old = previous.get((result["scenario"], result["mode"]))
+        if old is None:
+            continue
+        if result["throughput"] < old["throughput"] * (1 - tolerance):
+            regressions.append("%s/%s throughput %.1f < %.1f req/s" % (
+                result["scenario"], result["mode"], result["throughput"], old["throughput"]))
+        if result["latency"]["p99"] > old["latency"]["p99"] * (1 + tolerance):
+            regressions.append("%s/%s p99 %.2f > %.2f ms" % (
+                result["scenario"], result["mode"], result["latency"]["p99"]*1000, old["latency"]["p99"]*1000))
+    return regressions
+
+
+def environment():
+    from importlib import metadata
+    try:
+        version = metadata.version("outpost")
+    except metadata.PackageNotFoundError:
+        version = None
+    return {"outpost": version, "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": multiprocessing.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="outpost load benchmark")
+    parser.add_argument("--scenario", default="all", help="%s or all" % ", ".join(sorted(SCENARIOS)))
+    parser.add_argument("--mode", default="closed", choices=("closed", "open"))
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--rate", type=float, default=100.0, help="requests per second in open mode")
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--compare", help="result file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    logging.getLogger("urllib3").setLevel(logging.ERROR)
+    scenarios = sorted(SCENARIOS) if args.scenario == "all" else args.scenario.split(",")
+    results = []
+    for scenario in scenarios:
+        result = runScenario(scenario, args.mode, args.concurrency, args.duration, args.rate, args.warmup)
+        latency = result["latency"]
+        print("%-8s %-6s %8.1f req/s  p50 %7.2f  p90 %7.2f  p99 %7.2f  p99.9 %7.2f ms  errors %d" % (
+            scenario, args.mode, result["throughput"], latency["p50"]*1000, latency["p90"]*1000,
+            latency["p99"]*1000, latency["p99.9"]*1000, result["errors"]), file=sys.stderr)
+        results.append(result)
+    data = {"environment": environment(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(data, f, indent=2)
+    else:
+        print(json.dumps(data, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for message in regressions:
+            print("Regression: " + message, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,322 @@
+# Copyright 2015 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under BSD-license. See license.txt
+#
+"""
+Micro benchmarks
+----------------
+Measures the hot paths of the request processing in isolation: filter lookup and
+application, url handler construction, backend request preparation, backend response
+wrapping and the `filterinc` transforms with body sizes from 1 KB to 10 MB.
+
+Each benchmark is calibrated to run at least 0.2 seconds per round. The best and the
+median time per call of 5 rounds are reported. Body transform timings include the
+creation of the response object.
+
+Usage ::
+
+    python -m outpost.tests.microbench
+    python -m outpost.tests.microbench --select filterinc.replacestr --sizes 1k,10m
+    python -m outpost.tests.microbench --output result.json
+    python -m outpost.tests.microbench --compare outpost/tests/benchmarks/baseline.json
+
+`--compare` reports benchmarks whose best time increased by more than `--tolerance`
+(default 0.2) and exits with 1. Baseline files are machine specific, create a new one
+on the machine the comparison runs on with `--output`.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import timeit
+
+from pyramid import testing
+from pyramid.request import Request
+from pyramid.response import Response
+from requests.models import Response as BackendResponse
+from requests.structures import CaseInsensitiveDict
+from zope.interface import alsoProvides
+
+from outpost import filterinc
+from outpost import filtermanager
+from outpost.proxy import Proxy, ProxyUrlHandler
+from outpost.tests.loadtest import environment
+
+
+SIZES = {"1k": 1024, "100k": 100*1024, "1m": 1024*1024, "10m": 10*1024*1024}
+
+# realistic filter configuration: header filters and body filters for html and css
+FILTERS = [
+    {"callable": "outpost.filterinc.add_header", "hook": "post", "apply_to": "proxy",
+     "settings": {"name": "X-Served-By", "value": "outpost"}, "name": "header"},
+    {"callable": "outpost.filterinc.add_header", "hook": "post", "apply_to": "file",
+     "path": r"\.js$", "settings": {"name": "Cache-Control", "value": "max-age=3600"}},
+    {"callable": "outpost.filterinc.replacestr", "hook": "post", "apply_to": "proxy",
+     "content_type": "text/html", "path": r"\.html$",
+     "settings": {"replace": [{"str": "http://backend/", "new": "/"}, {"str": "Lorem", "new": "LOREM"}]},
+     "name": "replace"},
+    {"callable": "outpost.filterinc.rewrite_urls", "hook": "post", "apply_to": "proxy",
+     "content_type": "text/html", "path": r"/app/", "settings": {}},
+    {"callable": "outpost.filterinc.redirect", "hook": "pre", "path": r"^/old/",
+     "settings": {"url": "/new/"}},
+    {"callable": "outpost.filterinc.replacestr", "hook": "post", "apply_to": "file",
+     "content_type": "text/css", "settings": {"replace": [{"str": "url(/", "new": "url(/static/", "literal": True}]}},
+    {"callable": "outpost.filterinc.add_header", "hook": "post", "status": 404,
+     "settings": {"name": "Cache-Control", "value": "no-cache"}},
+    {"callable": "outpost.filterinc.add_header", "hook": "post", "apply_to": "proxy",
+     "content_type": "application/json", "settings": {"name": "Access-Control-Allow-Origin", "value": "*"}},
+]
+
+REQUEST_HEADERS = {
+    "Host": "127.0.0.1:5556", "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101 Firefox/120.0",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.5", "Accept-Encoding": "gzip, deflate, br",
+    "Cookie": "session=0123456789abcdef; theme=dark", "Referer": "http://127.0.0.1:5556/index.html",
+    "Cache-Control": "max-age=0", "If-None-Match": '"v1"', "X-Requested-With": "XMLHttpRequest",
+}
+
+BACKEND_HEADERS = {
+    "Content-Type": "text/html; charset=utf-8", "Content-Length": "1024", "Connection": "keep-alive",
+    "Keep-Alive": "timeout=5", "Date": "Mon, 01 Jan 2024 00:00:00 GMT", "Server": "backend",
+    "Cache-Control": "max-age=60", "ETag": '"v1"', "Set-Cookie": "session=1; Domain=127.0.0.1; Path=/",
+    "Vary": "Accept-Encoding",
+}
+
+
+def htmlBody(size):
+    part = b"<p><a href='http://backend/page'>Link</a> Lorem ipsum dolor sit amet.</p>\n"
+    inner = part * max(size // len(part), 1)
+    return b"<html><head><title>Page</title></head><body>" + inner + b"</body></html>"
+
+
+class Context(object):
+    """
+    Registry, settings and request shared by the benchmarks.
+    """
+
+    def __init__(self, filters=FILTERS):
+        self.directory = tempfile.mkdtemp(prefix="outpost-bench-")
+        self.config = testing.setUp()
+        self.config.include("pyramid_chameleon")
+        self.settings = {"proxy.host": "backend:8080", "proxy.timeout": "10",
+                         "filter": filtermanager.parseJsonString(json.dumps(filters))}
+        self.config.registry.settings = self.settings
+
+    def request(self, path="/app/index.html"):
+        request = Request.blank(path, headers=REQUEST_HEADERS)
+        request.registry = self.config.registry
+        return request
+
+    def close(self):
+        testing.tearDown()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def proxyResponse(body, content_type="text/html"):
+    response = Response(body=body, content_type=content_type, charset="utf-8")
+    alsoProvides(response, filtermanager.IProxyRequest)
+    return response
+
+
+def filterConf(fn, settings, mode=None):
+    conf = {"callable": fn, "settings": settings}
+    if mode:
+        conf["mode"] = mode
+    return filtermanager.FilterConf.fromDict(conf)
+
+
+# benchmarks. each returns the callable to be timed --------------------------------
+
+def benchLookup(ctx):
+    request = ctx.request()
+    response = proxyResponse(b"<html></html>")
+    url = ProxyUrlHandler(request, ctx.settings)
+    return lambda: list(filtermanager.lookupFilter("post", response, request, url))
+
+
+def benchPostHook(ctx):
+    request = ctx.request()
+    url = ProxyUrlHandler(request, ctx.settings)
+    body = htmlBody(SIZES["1k"])
+
+    def run():
+        # applied filters are tracked per request
+        request.environ.pop("outpost.filter", None)
+        return filtermanager.runPostHook(proxyResponse(body), request, url)
+    return run
+
+
+def benchUrlHandler(ctx):
+    request = ctx.request()
+    settings = ctx.settings
+    return lambda: ProxyUrlHandler(request, settings)
+
+
+def benchPrepare(ctx):
+    request = ctx.request()
+    url = ProxyUrlHandler(request, ctx.settings)
+    proxy = Proxy(url, request, debug=False)
+    return lambda: proxy.prepare(url, request)
+
+
+def benchWrap(ctx):
+    request = ctx.request()
+    url = ProxyUrlHandler(request, ctx.settings)
+    proxy = Proxy(url, request, debug=False)
+    body = htmlBody(SIZES["1k"])
+    backend = BackendResponse()
+    backend.status_code = 200
+    backend.headers = CaseInsensitiveDict(BACKEND_HEADERS)
+    backend._content = body
+    return lambda: proxy.wrap(backend, body)
+
+
+def transform(fn, settings, mode=None, content_type="text/html"):
+    # returns a benchmark applying the filter to a body of the given size. `settings`
+    # may be a callable returning the filter settings.
+    def bench(ctx, size):
+        request = ctx.request()
+        url = ProxyUrlHandler(request, ctx.settings)
+        fc = filterConf(fn, settings(ctx) if callable(settings) else settings, mode)
+        body = htmlBody(size)
+        if mode == "stream":
+            chunks = [body[i:i+64*1024] for i in range(0, len(body), 64*1024)]
+
+            def run():
+                response = Response(app_iter=list(chunks), content_type=content_type, charset="utf-8")
+                response = fn(response, request, fc, url)
+                for chunk in response.app_iter:
+                    pass
+            return run
+        return lambda: fn(proxyResponse(body, content_type), request, fc, url)
+    return bench
+
+
+def _snippet(ctx):
+    path = os.path.join(ctx.directory, "snippet.html")
+    with open(path, "wb") as f:
+        f.write(b"<script>var config = {};</script>")
+    return {"appendhead": path, "appendbody": path}
+
+
+def _template(ctx):
+    return {"template": os.path.join(os.path.dirname(__file__), "tmpl.pt")}
+
+
+def _templateSplice(ctx):
+    settings = _template(ctx)
+    settings["splice"] = True
+    return settings
+
+
+BENCHMARKS = [
+    ("filtermanager.lookupFilter", benchLookup, False),
+    ("filtermanager.runPostHook", benchPostHook, False),
+    ("proxy.ProxyUrlHandler", benchUrlHandler, False),
+    ("proxy.prepare", benchPrepare, False),
+    ("proxy.wrap", benchWrap, False),
+    ("filterinc.replacestr", transform(filterinc.replacestr, {"str": "Lorem", "new": "LOREM"}), True),
+    ("filterinc.replacestr.list", transform(filterinc.replacestr, {"replace": [
+        {"str": "http://backend/", "new": "/"}, {"str": "Lorem", "new": "LOREM"}]}), True),
+    ("filterinc.replacestr.regex", transform(filterinc.replacestr, {"str": "href='([^']*)'",
+                                                                   "new": "href='/proxy\\1'"}), True),
+    ("filterinc.replacestr.stream", transform(filterinc.replacestr, {"str": "Lorem", "new": "LOREM"},
+                                              mode="stream"), True),
+    ("filterinc.rewrite_urls", transform(filterinc.rewrite_urls, {}), True),
+    ("filterinc.appendhead", transform(filterinc.appendhead, _snippet), True),
+    ("filterinc.appendbody", transform(filterinc.appendbody, _snippet), True),
+    ("filterinc.template", transform(filterinc.template, _template), True),
+    ("filterinc.template.splice", transform(filterinc.template, _templateSplice), True),
+    ("filterinc.compress", transform(filterinc.compress, {"encodings": "gzip"}), True),
+]
+
+
+def measure(fn, rounds=5, mintime=0.2):
+    """
+    Calibrates the number of calls per round and returns best and median seconds per call.
+    """
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        t = timer.timeit(number)
+        if t >= mintime or number >= 1000000:
+            break
+        number = max(number * 2, int(number * mintime / max(t, 1e-9) * 1.1))
+    times = [t / number] + [timer.timeit(number) / number for i in range(rounds - 1)]
+    return {"best": min(times), "median": statistics.median(times), "calls": number}
+
+
+def run(select=None, sizes=("1k", "100k", "1m"), rounds=5, mintime=0.2, report=None):
+    """
+    Runs the benchmarks and returns a dict name: result.
+    """
+    results = {}
+    ctx = Context()
+    try:
+        for name, bench, sized in BENCHMARKS:
+            if select and not any(name.startswith(s) for s in select):
+                continue
+            for size in (sizes if sized else (None,)):
+                key = "%s[%s]" % (name, size) if size else name
+                fn = bench(ctx, SIZES[size]) if size else bench(ctx)
+                results[key] = measure(fn, rounds, mintime)
+                if report is not None:
+                    report(key, results[key])
+    finally:
+        ctx.close()
+    return results
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    :return: list of (name, baseline seconds, current seconds) of slower benchmarks
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline.get("results", {}).get(name)
+        if old and result["best"] > old["best"] * (1 + tolerance):
+            regressions.append((name, old["best"], result["best"]))
+    return regressions
+
+
+def _format(seconds):
+    for unit, factor in (("s", 1), ("ms", 1e3), ("us", 1e6)):
+        if seconds * factor >= 1:
+            return "%8.2f %s" % (seconds * factor, unit)
+    return "%8.2f ns" % (seconds * 1e9)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="outpost micro benchmarks")
+    parser.add_argument("--select", help="comma separated benchmark name prefixes")
+    parser.add_argument("--sizes", default="1k,100k,1m", help="body sizes: %s" % ",".join(SIZES))
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--mintime", type=float, default=0.2, help="min. seconds per round")
+    parser.add_argument("--output", help="write the results to this json file")
+    parser.add_argument("--compare", help="baseline file to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    def report(name, result):
+        print("%-40s best %s  median %s" % (name, _format(result["best"]), _format(result["median"])),
+              file=sys.stderr)
+
+    select = args.select.split(",") if args.select else None
+    results = run(select, args.sizes.split(","), args.rounds, args.mintime, report)
+    data = {"environment": environment(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, old, new in regressions:
+            print("Regression: %s %s -> %s" % (name, _format(old).strip(), _format(new).strip()), file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
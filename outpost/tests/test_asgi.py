@@ -0,0 +1,132 @@
+import unittest
+import asyncio
+import gzip
+import os
+import threading
+from wsgiref.simple_server import make_server
+
+from outpost.tests.test_proxy import QuietHandler, backend, backend_requests, backend_ranges, media
+
+try:
+    import httpx
+    from outpost import asgi
+except ImportError:
+    httpx = None
+
+
+@unittest.skipIf(httpx is None, "httpx not installed")
+class ASGITest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = make_server("127.0.0.1", 0, backend, handler_class=QuietHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def app(self, **values):
+        settings = {"proxy.host": "127.0.0.1:%d" % self.server.server_port,
+                    "proxy.route": "api",
+                    "proxy.timeout": "10",
+                    "files.directory": os.path.dirname(__file__),
+                    "filter": ""}
+        settings.update(values)
+        return asgi.main({}, **settings)
+
+    def get(self, app, path, headers=None):
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+                response = await client.get(path, headers=headers)
+            if app.client is not None:
+                await app.client.aclose()
+            return response
+        return asyncio.run(run())
+
+    def test_proxy(self):
+        response = self.get(self.app(), "/api/data.json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"result": True})
+
+    def test_stream(self):
+        response = self.get(self.app(**{"proxy.stream": "true"}), "/api/index.html")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.content), 100026)
+
+    def test_filter(self):
+        flt = """{"callable": "outpost.filterinc.replacestr", "apply_to": "proxy", "mode": "stream",
+                  "settings": {"str": "<body>", "new": "<body>Updated!"}}"""
+        response = self.get(self.app(**{"proxy.stream": "true", "filter": flt}), "/api/index.html")
+        self.assertTrue(response.content.startswith(b"<html><body>Updated!xxx"))
+
+    def test_passthrough(self):
+        app = self.app(**{"proxy.passthrough": "true"})
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+                async with client.stream("GET", "/api/gzip.html", headers={"Accept-Encoding": "gzip"}) as response:
+                    raw = b"".join([chunk async for chunk in response.aiter_raw()])
+            await app.client.aclose()
+            return response, raw
+        response, raw = asyncio.run(run())
+        self.assertEqual(response.headers["Content-Encoding"], "gzip")
+        self.assertTrue(gzip.decompress(raw).startswith(b"<html><body>gzip"))
+
+    def test_range_body_filter(self):
+        flt = """{"callable": "outpost.filterinc.replacestr", "apply_to": "proxy",
+                  "settings": {"str": "nothing", "new": "changed"}}"""
+        response = self.get(self.app(filter=flt), "/api/media.txt", {"Range": "bytes=10-19"})
+        self.assertEqual(backend_ranges[-1][0], None)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.headers["Content-Range"], "bytes 10-19/102400")
+        self.assertEqual(response.content, media[10:20])
+
+    def test_cached_range(self):
+        flt = """[{"callable": "outpost.filterinc.cache_read", "hook": "pre", "apply_to": "proxy"},
+                  {"callable": "outpost.filterinc.cache_write", "apply_to": "proxy", "settings": {"ttl": 60}}]"""
+        app = self.app(filter=flt)
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+                await client.get("/api/media.txt")
+                response = await client.get("/api/media.txt", headers={"Range": "bytes=100-109"})
+            await app.client.aclose()
+            return response
+        response = asyncio.run(run())
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, media[100:110])
+        self.assertEqual(backend_ranges[-1][0], None)
+
+    def test_file(self):
+        response = self.get(self.app(), "/tmpl.pt")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"<html><body>${content}</body></html>")
+
+    def test_environ(self):
+        environ = asgi.makeEnviron({"method": "GET", "path": "/a", "query_string": b"b=1",
+                                    "headers": [(b"accept", b"text/html"), (b"content-type", b"text/plain")]}, b"")
+        self.assertEqual(environ["HTTP_ACCEPT"], "text/html")
+        self.assertEqual(environ["CONTENT_TYPE"], "text/plain")
+        self.assertEqual(environ["QUERY_STRING"], "b=1")
+
+    def test_revalidate(self):
+        flt = """[{"callable": "outpost.filterinc.cache_read", "hook": "pre", "apply_to": "proxy", "settings": {}},
+                  {"callable": "outpost.filterinc.cache_write", "hook": "post", "apply_to": "proxy", "settings": {}}]"""
+        app = self.app(filter=flt)
+        async def run():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as client:
+                responses = [await client.get("/api/etag.json") for i in range(3)]
+            await app.client.aclose()
+            return responses
+        del backend_requests[:]
+        for response in asyncio.run(run()):
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.content, b"{\"etag\": 1}")
+        self.assertEqual(backend_requests, [("/api/etag.json", None), ("/api/etag.json", '"v1"'),
+                                            ("/api/etag.json", '"v1"')])
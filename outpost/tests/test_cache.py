@@ -0,0 +1,277 @@
+import unittest
+import os
+import shutil
+import tempfile
+import time
+from email.utils import formatdate
+
+from pyramid import testing
+from pyramid.request import Request
+from pyramid.response import Response
+from zope.interface import directlyProvides
+
+from outpost import cache
+from outpost import filterinc
+from outpost import filtermanager
+from outpost.filtermanager import FilterConf
+
+
+class Url(object):
+    def __init__(self, path):
+        self.fullPath = path
+
+
+class TTLTest(unittest.TestCase):
+
+    def test_cache_control(self):
+        self.assertEqual(cache.responseTTL({"Cache-Control": "public, max-age=60"}, 5), 60)
+        self.assertEqual(cache.responseTTL({"Cache-Control": "max-age=60, s-maxage=10"}, 5), 10)
+        self.assertEqual(cache.responseTTL({"Cache-Control": "no-cache"}, 5), 0)
+        self.assertEqual(cache.responseTTL({"Cache-Control": "no-store"}, 5), None)
+        self.assertEqual(cache.responseTTL({"Cache-Control": "private, max-age=60"}, 5), None)
+        self.assertEqual(cache.responseTTL({"Vary": "*"}, 5), None)
+        self.assertEqual(cache.responseTTL({}, 5), 5)
+        self.assertEqual(cache.responseTTL({"Set-Cookie": "a=1"}, 5), None)
+
+    def test_expires(self):
+        now = time.time()
+        headers = {"Date": formatdate(now, usegmt=True), "Expires": formatdate(now+120, usegmt=True)}
+        self.assertEqual(cache.responseTTL(headers, 5), 120)
+        self.assertEqual(cache.responseTTL({"Expires": "0"}, 5), 0)
+
+    def test_vary(self):
+        self.assertEqual(cache.varyHeaders({"Vary": "Accept-Encoding, accept"}), ("accept", "accept-encoding"))
+        self.assertEqual(cache.varyHeaders({}), ())
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def entry(self, size, ttl=60, headers=()):
+        return cache.CacheEntry(b"x"*size, 200, list(headers), "proxy", ttl)
+
+    def test_lru(self):
+        c = cache.ResponseCache(maxsize=1000)
+        for i in range(5):
+            c.set(i, self.entry(200))
+            c.get(0)
+        self.assertEqual(sorted(c.entries), [0, 3, 4])
+        self.assertTrue(c.size <= 1000)
+        stats = c.statistics()
+        self.assertEqual(stats["evictions"], 2)
+        self.assertEqual(stats["hits"], 5)
+
+    def test_lfu(self):
+        c = cache.ResponseCache(maxsize=1000, policy="lfu")
+        c.set("a", self.entry(200))
+        c.set("b", self.entry(200))
+        c.set("c", self.entry(200))
+        c.get("a")
+        c.get("b")
+        c.set("d", self.entry(200))
+        self.assertEqual(sorted(c.entries), ["a", "b", "d"])
+
+    def test_expired(self):
+        c = cache.ResponseCache()
+        c.set("a", self.entry(10, ttl=0, headers=[("ETag", '"1"')]))
+        c.set("b", self.entry(10, ttl=0))
+        self.assertEqual(c.get("a"), None)
+        self.assertTrue(c.get("a", stale=True) is not None)
+        self.assertEqual(c.get("b", stale=True), None)
+        self.assertEqual(c.statistics()["expired"], 3)
+
+    def test_too_large(self):
+        c = cache.ResponseCache(maxsize=100)
+        c.set("a", self.entry(200))
+        self.assertEqual(len(c.entries), 0)
+
+    def test_vary(self):
+        c = cache.ResponseCache()
+        request = Request.blank("/a", headers={"Accept-Encoding": "gzip"})
+        url = Url("http://host/a")
+        c.store(request, url, b"gzip", 200, [("Vary", "Accept-Encoding")], "proxy")
+        self.assertEqual(c.lookup(request, url).body, b"gzip")
+        other = Request.blank("/a", headers={"Accept-Encoding": "br"})
+        self.assertEqual(c.lookup(other, url), None)
+        c.store(other, url, b"br", 200, [("Vary", "Accept-Encoding")], "proxy")
+        self.assertEqual(c.lookup(other, url).body, b"br")
+        self.assertEqual(c.lookup(request, url).body, b"gzip")
+
+    def test_no_store(self):
+        c = cache.ResponseCache()
+        request = testing.DummyRequest()
+        self.assertEqual(c.store(request, Url("a"), b"", 200, [("Cache-Control", "no-store")], "proxy"), None)
+
+    def test_not_cacheable_ttl(self):
+        # the ttl override does not skip the cacheability checks
+        c = cache.ResponseCache()
+        request = Request.blank("/a")
+        url = Url("http://host/a")
+        for headers in ([("Cache-Control", "private"), ("Set-Cookie", "session=1")],
+                        [("Cache-Control", "no-store")], [("Vary", "*")], [("set-cookie", "session=1")]):
+            self.assertEqual(c.store(request, url, b"private", 200, headers, "proxy", ttl=60), None)
+            self.assertEqual(c.lookup(request, url), None)
+        self.assertEqual(len(c.entries), 0)
+
+    def test_vary_pruned(self):
+        c = cache.ResponseCache(maxsize=1000)
+        request = Request.blank("/a", headers={"Accept-Encoding": "gzip"})
+        for i in range(10):
+            c.store(request, Url("http://host/%d" % i), b"x"*300, 200, [("Vary", "Accept-Encoding")], "proxy")
+        self.assertTrue(len(c.entries) < 10)
+        self.assertEqual(sorted(c.vary), sorted(set(cache._path(k) for k in c.entries)))
+        c.store(request, Url("http://host/expired"), b"x", 200, [("Vary", "Accept-Encoding")], "proxy", ttl=0)
+        self.assertEqual(c.lookup(request, Url("http://host/expired"), stale=True), None)
+        self.assertFalse("http://host/expired" in c.vary)
+        c.remove(next(iter(c.entries)))
+        self.assertEqual(len(c.vary), len(c.entries))
+        c.store(request, Url("http://host/large"), b"x"*2000, 200, [("Vary", "Accept-Encoding")], "proxy")
+        self.assertFalse("http://host/large" in c.vary)
+
+
+class DiskCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def entry(self, body, ttl=60, headers=()):
+        return cache.CacheEntry(body, 200, list(headers), "proxy", ttl)
+
+    def test_set_get(self):
+        c = cache.DiskCache(self.directory)
+        c.set("a", self.entry(b"aaa", headers=[("Content-Type", "text/html")]))
+        entry = c.get("a")
+        self.assertTrue(isinstance(entry, cache.DiskEntry))
+        self.assertEqual(entry.body, b"aaa")
+        self.assertEqual(entry.header("content-type"), "text/html")
+        self.assertEqual(c.get("b"), None)
+        # shared with other instances using the same directory
+        other = cache.DiskCache(self.directory)
+        self.assertEqual(other.get("a").body, b"aaa")
+        self.assertEqual(other.statistics()["entries"], 1)
+
+    def test_shared_bodies(self):
+        c = cache.DiskCache(self.directory)
+        c.set("a", self.entry(b"same"))
+        c.set("b", self.entry(b"same"))
+        path = c.get("a").path
+        c.remove("a")
+        self.assertTrue(os.path.exists(path))
+        c.remove("b")
+        self.assertFalse(os.path.exists(path))
+        c.set("c", self.entry(b"c"))
+        c.clear()
+        self.assertEqual(c.statistics()["entries"], 0)
+
+    def test_missing_body(self):
+        c = cache.DiskCache(self.directory)
+        c.set("a", self.entry(b"aaa"))
+        entry = c.get("a")
+        # the body opened on lookup is readable after eviction
+        c.clear()
+        self.assertEqual(entry.body, b"aaa")
+        c.set("a", self.entry(b"aaa"))
+        os.remove(c.get("a").path)
+        self.assertEqual(c.get("a"), None)
+        self.assertEqual(c.statistics()["entries"], 0)
+
+    def test_lru(self):
+        c = cache.DiskCache(self.directory, maxsize=1000)
+        for i in range(5):
+            c.set(str(i), self.entry(str(i).encode()*200))
+            c.get("0")
+        stats = c.statistics()
+        self.assertEqual(stats["entries"], 3)
+        self.assertEqual(stats["evictions"], 2)
+        self.assertTrue(c.get("0") is not None)
+        self.assertEqual(c.get("1"), None)
+
+    def test_refresh(self):
+        c = cache.DiskCache(self.directory)
+        c.set("a", self.entry(b"a", ttl=0, headers=[("ETag", '"1"')]))
+        entry = c.get("a", stale=True)
+        self.assertFalse(entry.fresh())
+        c.refresh(entry, {"ETag": '"1"', "Cache-Control": "max-age=60"})
+        entry = c.get("a")
+        self.assertTrue(entry.fresh())
+        self.assertEqual(entry.header("Cache-Control"), "max-age=60")
+        self.assertEqual(c.statistics()["revalidated"], 1)
+
+    def test_vary(self):
+        c = cache.DiskCache(self.directory)
+        request = Request.blank("/a", headers={"Accept-Encoding": "gzip"})
+        url = Url("http://host/a")
+        c.store(request, url, b"gzip", 200, [("Vary", "Accept-Encoding")], "proxy")
+        other = Request.blank("/a", headers={"Accept-Encoding": "br"})
+        self.assertEqual(c.lookup(other, url), None)
+        self.assertEqual(c.lookup(request, url).body, b"gzip")
+
+    def test_settings(self):
+        c = cache.ResponseCache.fromSettings({"cache.store": "disk", "cache.directory": self.directory})
+        self.assertTrue(isinstance(c, cache.DiskCache))
+        self.assertTrue(isinstance(cache.ResponseCache.fromSettings({}), cache.ResponseCache))
+
+    def test_cached_response(self):
+        c = cache.DiskCache(self.directory)
+        c.set("a", self.entry(b"file body", headers=[("Content-Type", "text/plain")]))
+        request = Request.blank("/a")
+        response = filterinc.cachedResponse(c.get("a"), request=request)
+        self.assertEqual(response.content_length, 9)
+        self.assertEqual(response.body, b"file body")
+
+    def test_cache_read_closes(self):
+        c = cache.DiskCache(self.directory)
+        files = []
+        get = c.get
+        def tracked(key, stale=False):
+            entry = get(key, stale)
+            files.append(entry.file)
+            return entry
+        c.get = tracked
+        request = testing.DummyRequest()
+        request.registry.settings = {"cache.instance": c}
+        url = Url("http://host/page.html")
+        read = FilterConf.fromDict({"callable": "outpost.filterinc.cache_read", "hook": "pre",
+                                    "settings": {"abort": False}})
+        # stale entry without proxy to revalidate
+        c.store(request, url, b"stale", 200, [("ETag", '"v1"')], "proxy", ttl=0)
+        self.assertEqual(filterinc.cache_read(None, request, read, url), None)
+        # client 304
+        c.store(request, url, b"fresh", 200, [("ETag", '"v1"')], "proxy", ttl=60)
+        request.headers["If-None-Match"] = '"v1"'
+        self.assertEqual(filterinc.cache_read(None, request, read, url).status_int, 304)
+        self.assertEqual(len(files), 2)
+        self.assertTrue(all(f.closed for f in files))
+
+
+class CacheFilterTest(unittest.TestCase):
+
+    def test_write_read(self):
+        request = testing.DummyRequest()
+        request.registry.settings = {"cache.ttl": "60"}
+        url = Url("http://host/page.html")
+        response = Response(body=b"cached", content_type="text/html")
+        directlyProvides(response, filtermanager.IProxyRequest)
+        write = FilterConf.fromDict({"callable": "outpost.filterinc.cache_write", "settings": {}})
+        read = FilterConf.fromDict({"callable": "outpost.filterinc.cache_read", "hook": "pre",
+                                    "settings": {"abort": False}})
+        self.assertEqual(filterinc.cache_read(None, request, read, url), None)
+        filterinc.cache_write(response, request, write, url)
+        cached = filterinc.cache_read(None, request, read, url)
+        self.assertEqual(cached.body, b"cached")
+        self.assertTrue(filtermanager.IProxyRequest.providedBy(cached))
+        self.assertTrue(request.environ["outpost.cache-hit"])
+        read.settings = {}
+        self.assertRaises(filtermanager.ResponseFinished, filterinc.cache_read, None, request, read, url)
+
+    def test_ttl_override(self):
+        request = testing.DummyRequest()
+        request.registry.settings = {}
+        url = Url("http://host/page.html")
+        response = Response(body=b"cached", cache_control="no-cache")
+        write = FilterConf.fromDict({"callable": "outpost.filterinc.cache_write", "settings": {"ttl": 60}})
+        filterinc.cache_write(response, request, write, url)
+        entry = cache.getCache(request.registry.settings).lookup(request, url)
+        self.assertEqual(entry.body, b"cached")
@@ -0,0 +1,113 @@
+import unittest
+import gzip
+import zlib
+
+from pyramid import testing
+from pyramid.request import Request
+from pyramid.response import Response
+
+from outpost import compress
+from outpost import filterinc
+from outpost.filtermanager import FilterConf
+
+
+class NegotiateTest(unittest.TestCase):
+
+    def test_negotiate(self):
+        encodings = ("br", "gzip", "deflate")
+        self.assertEqual(compress.negotiate("gzip, deflate, br", encodings), "br")
+        self.assertEqual(compress.negotiate("gzip, deflate", encodings), "gzip")
+        self.assertEqual(compress.negotiate("deflate, gzip;q=0.5", encodings), "deflate")
+        self.assertEqual(compress.negotiate("br;q=0, gzip", encodings), "gzip")
+        self.assertEqual(compress.negotiate("*", encodings), "br")
+        self.assertEqual(compress.negotiate("identity", encodings), None)
+        self.assertEqual(compress.negotiate("", encodings), None)
+        self.assertEqual(compress.negotiate("x-gzip", encodings), "gzip")
+
+    def test_encodings(self):
+        self.assertEqual(compress.encodings({"compress.encodings": "gzip unknown deflate"}), ("gzip", "deflate"))
+        self.assertTrue("gzip" in compress.encodings({}))
+
+    def test_compressor(self):
+        data = b"text " * 1000
+        self.assertEqual(gzip.decompress(compress.compressBody(data, "gzip")), data)
+        self.assertEqual(zlib.decompress(compress.compressBody(data, "deflate")), data)
+        chunks = list(compress.compressIter([data[:100], data[100:]], "gzip"))
+        self.assertEqual(gzip.decompress(b"".join(chunks)), data)
+        self.assertRaises(ValueError, compress.Compressor, "unknown")
+
+
+class Url(object):
+    def __init__(self, path):
+        self.fullPath = path
+
+
+class CompressResponseTest(unittest.TestCase):
+    body = b"<html>" + b"compressed text " * 100 + b"</html>"
+
+    def request(self, accept="gzip"):
+        request = Request.blank("/", headers={"Accept-Encoding": accept})
+        request.registry = testing.DummyRequest().registry
+        request.registry.settings = {"filter": ()}
+        return request
+
+    def test_buffered(self):
+        request = self.request()
+        response = Response(body=self.body, content_type="text/html")
+        response.etag = "abc"
+        compress.compressResponse(response, request, request.registry.settings)
+        self.assertEqual(response.content_encoding, "gzip")
+        self.assertEqual(response.headers["ETag"], 'W/"abc"')
+        self.assertEqual(response.vary, ("Accept-Encoding",))
+        self.assertEqual(gzip.decompress(response.body), self.body)
+        # cached variant
+        response = Response(body=self.body, content_type="text/html")
+        response.etag = "abc"
+        compress.compressResponse(response, request, request.registry.settings)
+        variants = compress.getVariantCache(request.registry.settings)
+        self.assertEqual(variants.statistics()["hits"], 1)
+        self.assertEqual(gzip.decompress(response.body), self.body)
+
+    def test_variant_url(self):
+        # equal etags of different resources do not share variants
+        request = self.request()
+        response = Response(body=self.body, content_type="text/html")
+        response.etag = "static"
+        compress.compressResponse(response, request, request.registry.settings, url=Url("http://host/a"))
+        other = b"<html>" + b"other text " * 100 + b"</html>"
+        response = Response(body=other, content_type="text/html")
+        response.etag = "static"
+        compress.compressResponse(response, request, request.registry.settings, url=Url("http://host/b"))
+        self.assertEqual(gzip.decompress(response.body), other)
+        variants = compress.getVariantCache(request.registry.settings)
+        self.assertEqual(variants.statistics()["entries"], 2)
+
+    def test_stream(self):
+        request = self.request("deflate")
+        response = Response(app_iter=iter([self.body[:100], self.body[100:]]), content_type="text/html")
+        compress.compressResponse(response, request, request.registry.settings)
+        self.assertEqual(response.content_encoding, "deflate")
+        self.assertEqual(response.content_length, None)
+        self.assertEqual(zlib.decompress(b"".join(response.app_iter)), self.body)
+
+    def test_skip(self):
+        request = self.request()
+        settings = request.registry.settings
+        response = Response(body=self.body, content_type="image/png")
+        compress.compressResponse(response, request, settings)
+        self.assertEqual(response.content_encoding, None)
+        response = Response(body=b"short", content_type="text/html")
+        compress.compressResponse(response, request, settings)
+        self.assertEqual(response.content_encoding, None)
+        response = Response(body=self.body, content_type="text/html")
+        compress.compressResponse(response, self.request("identity"), settings)
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(response.vary, ("Accept-Encoding",))
+
+    def test_filter(self):
+        request = self.request("gzip, deflate")
+        fc = FilterConf.fromDict({"callable": "outpost.filterinc.compress", "settings": {"encodings": ["deflate"]}})
+        self.assertEqual(fc.mode, "stream")
+        response = Response(body=self.body, content_type="text/html")
+        response = filterinc.compress(response, request, fc, "/")
+        self.assertEqual(zlib.decompress(response.body), self.body)
@@ -0,0 +1,189 @@
+import unittest
+import gzip
+import os
+import shutil
+import tempfile
+import time
+
+from pyramid.request import Request
+
+from outpost import files
+from outpost.server import main
+
+
+class FileIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, "sub"))
+        self.write("index.html", b"<html>index</html>")
+        self.write("sub/data.json", b"{}")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, data):
+        with open(os.path.join(self.directory, name), "wb") as f:
+            f.write(data)
+
+    def index(self, check=2):
+        settings = {"files.directory": self.directory, "server.default_path": "/index.html"}
+        return files.FileIndex(self.directory, settings, check=check)
+
+    def test_lookup(self):
+        index = self.index()
+        info = index.lookup(("index.html",))
+        self.assertEqual(info.size, 18)
+        self.assertEqual(info.content_type, "text/html")
+        self.assertTrue(index.lookup(("index.html",)) is info)
+        self.assertEqual(index.lookup(("sub", "data.json")).content_type, "application/json")
+        self.assertEqual(index.lookup((), True).path, info.path)
+        self.assertEqual(index.lookup(("missing.html",)), None)
+        self.assertEqual(index.lookup(("sub",)), None)
+        self.assertEqual(index.lookup(("..", "index.html")), None)
+
+    def test_refresh(self):
+        index = self.index(check=0)
+        info = index.lookup(("index.html",))
+        etag = info.etag
+        self.write("index.html", b"<html>changed index</html>")
+        os.utime(os.path.join(self.directory, "index.html"), (time.time()+10, time.time()+10))
+        info = index.lookup(("index.html",))
+        self.assertEqual(info.size, 26)
+        self.assertNotEqual(info.etag, etag)
+        os.remove(os.path.join(self.directory, "index.html"))
+        self.assertEqual(index.lookup(("index.html",)), None)
+
+    def test_settings(self):
+        settings = {"files.directory": self.directory, "debug": "False"}
+        self.assertEqual(files.FileIndex.fromSettings(settings).check, 2)
+        settings["debug"] = "true"
+        self.assertEqual(files.FileIndex.fromSettings(settings).check, 0)
+        settings["files.index"] = "false"
+        self.assertEqual(files.FileIndex.fromSettings(settings), None)
+
+
+class FileServerTest(unittest.TestCase):
+
+    def app(self, **values):
+        settings = {"files.directory": os.path.dirname(__file__),
+                    "files.route": "files",
+                    "filter": ""}
+        settings.update(values)
+        return main({}, **settings)
+
+    def test_index(self):
+        app = self.app()
+        response = Request.blank("/files/links.json").get_response(app)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, "application/json")
+        self.assertTrue(response.etag)
+        with open(os.path.join(os.path.dirname(__file__), "links.json"), "rb") as f:
+            self.assertEqual(response.body, f.read())
+        request = Request.blank("/files/links.json", headers={"If-None-Match": '"%s"' % response.etag})
+        self.assertEqual(request.get_response(app).status_int, 304)
+
+    def test_static_view(self):
+        app = self.app(**{"files.index": "false"})
+        response = Request.blank("/files/links.json").get_response(app)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, "application/json")
+        self.assertEqual(Request.blank("/files/missing.json").get_response(app).status_int, 404)
+
+
+class AssetCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name in ("a.js", "b.js", "c.js"):
+            with open(os.path.join(self.directory, name), "wb") as f:
+                f.write(b"x"*100)
+        settings = {"files.directory": self.directory}
+        self.index = files.FileIndex(self.directory, settings, check=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cache(self):
+        assets = files.AssetCache(maxsize=250, threshold=200)
+        request = Request.blank("/a.js")
+        for name in ("a.js", "a.js", "b.js", "c.js", "a.js"):
+            response = assets.response(self.index.lookup((name,)), request)
+            self.assertEqual(response.body, b"x"*100)
+            self.assertEqual(response.content_length, 100)
+        stats = assets.statistics()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 4)
+        self.assertEqual(stats["evictions"], 2)
+        self.assertEqual(stats["entries"], 2)
+        self.assertEqual(stats["ratio"], 0.2)
+
+    def test_invalidate(self):
+        assets = files.AssetCache()
+        request = Request.blank("/a.js")
+        assets.response(self.index.lookup(("a.js",)), request)
+        with open(os.path.join(self.directory, "a.js"), "wb") as f:
+            f.write(b"changed")
+        response = assets.response(self.index.lookup(("a.js",)), request)
+        self.assertEqual(response.body, b"changed")
+        self.assertEqual(assets.statistics()["hits"], 0)
+
+    def test_clear(self):
+        assets = files.AssetCache()
+        request = Request.blank("/a.js")
+        assets.response(self.index.lookup(("a.js",)), request)
+        assets.clear()
+        stats = assets.statistics()
+        self.assertEqual(stats["entries"], 0)
+        self.assertEqual(stats["size"], 0)
+        self.assertEqual(assets.response(self.index.lookup(("a.js",)), request).body, b"x"*100)
+
+    def test_server(self):
+        settings = {"files.directory": self.directory, "files.route": "files", "filter": "",
+                    "files.cache.size": "1000", "files.cache.stats": "/__cache"}
+        app = main({}, **settings)
+        response = Request.blank("/files/a.js").get_response(app)
+        self.assertEqual(response.body, b"x"*100)
+        self.assertTrue(response.etag)
+        response = Request.blank("/files/a.js").get_response(app)
+        self.assertEqual(response.body, b"x"*100)
+        stats = Request.blank("/__cache").get_response(app).json
+        self.assertEqual(stats["hits"], 1)
+
+
+class PrecompressedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, "app.js"), "wb") as f:
+            f.write(b"var a = 1;" * 100)
+        with open(os.path.join(self.directory, "app.js.gz"), "wb") as f:
+            f.write(gzip.compress(b"var a = 1;" * 100))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def app(self, **values):
+        settings = {"files.directory": self.directory, "files.route": "files", "filter": "",
+                    "files.precompressed": "br gzip"}
+        settings.update(values)
+        return main({}, **settings)
+
+    def test_precompressed(self):
+        app = self.app()
+        response = Request.blank("/files/app.js", headers={"Accept-Encoding": "gzip, br"}).get_response(app)
+        self.assertEqual(response.content_encoding, "gzip")
+        self.assertTrue(response.content_type in ("application/javascript", "text/javascript"))
+        self.assertEqual(response.vary, ("Accept-Encoding",))
+        self.assertEqual(gzip.decompress(response.body), b"var a = 1;" * 100)
+        response = Request.blank("/files/app.js").get_response(app)
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(response.body, b"var a = 1;" * 100)
+
+    def test_body_filter(self):
+        filters = '[{"callable": "outpost.filterinc.replacestr", "hook": "post", ' \
+                  '"settings": {"str": "var", "new": "let"}}]'
+        app = self.app(filter=filters)
+        response = Request.blank("/files/app.js", headers={"Accept-Encoding": "gzip"}).get_response(app)
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(response.body, b"let a = 1;" * 100)
@@ -72,6 +72,44 @@ class TemplateTest(unittest.TestCase):
         response = filterinc.template(response, request, settings, request.url)
         self.assertTrue(response.unicode_body=="<html><body>Original response</body></html>")
 
+    def test_chameleon_setup(self):
+        os.chdir(os.path.dirname(__file__))
+        settings = FilterConf.fromDict({"callable": filterinc.template, "settings":{"template": "tmpl.pt"}})
+        self.assertEqual(settings.template, os.path.join(os.path.dirname(__file__), "tmpl.pt"))
+        os.chdir(os.path.dirname(os.path.dirname(__file__)))
+        request = testing.DummyRequest()
+        config = testing.setUp(request=request)
+        config.include('pyramid_chameleon')
+        for i in range(2):
+            response = testing.DummyRequest().response
+            response.unicode_body = u"Original <b>response</b>"
+            response = filterinc.template(response, request, settings, request.url)
+            self.assertEqual(response.unicode_body, u"<html><body>Original &lt;b&gt;response&lt;/b&gt;</body></html>")
+        self.assertTrue(settings.renderer is not None)
+
+    def test_chameleon_debug(self):
+        request = testing.DummyRequest()
+        config = testing.setUp(request=request, settings={"debug": "False"})
+        config.include('pyramid_chameleon')
+        settings = FilterConf.fromDict({"callable": filterinc.template, "settings":{"template": "outpost.tests:tmpl.pt"}})
+        filterinc.template(testing.DummyRequest().response, request, settings, request.url)
+        self.assertTrue(settings.renderer is not None)
+        request.registry.settings["debug"] = "true"
+        settings = FilterConf.fromDict({"callable": filterinc.template, "settings":{"template": "outpost.tests:tmpl.pt"}})
+        filterinc.template(testing.DummyRequest().response, request, settings, request.url)
+        self.assertEqual(getattr(settings, "renderer", None), None)
+
+    def test_chameleon_splice(self):
+        settings = FilterConf.fromDict({"callable": filterinc.template,
+                                        "settings":{"template": "outpost.tests:tmpl.pt", "splice": True}})
+        request = testing.DummyRequest()
+        config = testing.setUp(request=request)
+        config.include('pyramid_chameleon')
+        response = testing.DummyRequest().response
+        response.unicode_body = u"Original <b>response</b> \u00e4"
+        response = filterinc.template(response, request, settings, request.url)
+        self.assertEqual(response.unicode_body, u"<html><body>Original <b>response</b> \u00e4</body></html>")
+
 
 class ReplacestrTest(unittest.TestCase):
 
@@ -97,4 +135,201 @@ class ReplacestrTest(unittest.TestCase):
         response = filterinc.replacestr(response, request, settings, request.url)
         self.assertTrue(response.unicode_body==u"<html><body>Updated!</body></html>", response.unicode_body)
 
+    def test_list(self):
+        response = testing.DummyRequest().response
+        response.unicode_body = u"<html><head></head><body>\u00e4</body></html>"
+        request = testing.DummyRequest()
+        settings = FilterConf.fromDict({"callable": filterinc.replacestr,
+                                        "settings": {"replace": [{"str": u"<body>", "new": u"<body>Updated!"},
+                                                                 {"str": u"<b", "new": u"<B"},
+                                                                 {"str": u"\u00e4", "new": u"ae"}]}})
+        self.assertTrue(settings.replacer.literal)
+        response = filterinc.replacestr(response, request, settings, request.url)
+        self.assertEqual(response.unicode_body, u"<html><head></head><body>Updated!ae</body></html>")
+
+    def test_list_regex(self):
+        response = testing.DummyRequest().response
+        response.unicode_body = u"<a href='a'>1</a><a href='b'>22</a>"
+        request = testing.DummyRequest()
+        settings = FilterConf.fromDict({"callable": filterinc.replacestr,
+                                        "settings": {"replace": [{"str": u"href='(.)'", "new": u"href='/\\1'"},
+                                                                 {"str": u"[0-9]+", "new": u"n"},
+                                                                 {"str": u"a+", "new": u"x", "literal": True}]}})
+        self.assertFalse(settings.replacer.literal)
+        response = filterinc.replacestr(response, request, settings, request.url)
+        self.assertEqual(response.unicode_body, u"<a href='/a'>n</a><a href='/b'>n</a>")
+
+    def test_list_context(self):
+        # lookarounds and group references are expanded from the combined match
+        replacer = filterinc.Replacer.fromSettings({"replace": [{"str": u"(?<=a)b", "new": u"X"},
+                                                                {"str": u"c", "new": u"Y"},
+                                                                {"str": u"\\bw(\\d)", "new": u"v\\1\\g<0>"}]})
+        self.assertEqual(replacer.replaceText(u"abc bb w1 aw2"), u"aXY bb v1w1 aw2")
+        pattern, new = replacer.bytesPattern("utf-8")
+        self.assertEqual(pattern.sub(new, b"abc bb w1 aw2"), b"aXY bb v1w1 aw2")
+
+    def test_literal_detection(self):
+        replacer = filterinc.Replacer.fromSettings({"replace": [
+            {"str": u"http://127.0.0.1:8080/assets/", "new": u"https://cdn.nive.io/", "literal": True},
+            {"str": u"<head>", "new": u"<head>1"}]})
+        self.assertTrue(replacer.literal)
+        self.assertEqual(replacer.replaceBytes(b"http://127.0.0.1:8080/assets/a.js http://127-0-0-1:8080/assets/<head>",
+                                               "utf-8"),
+                         b"https://cdn.nive.io/a.js http://127-0-0-1:8080/assets/<head>1")
+        # `.` matches any character unless literal is set
+        replacer = filterinc.Replacer.fromSettings({"str": u"www.nive.io", "new": u"nive.io"})
+        self.assertFalse(replacer.literal)
+        self.assertEqual(replacer.replaceText(u"www.nive.io www1nive.io"), u"nive.io nive.io")
+        self.assertFalse(filterinc.Replacer.fromSettings({"str": u"a+", "new": u"b"}).literal)
+        self.assertFalse(filterinc.Replacer.fromSettings({"str": u"a.b", "new": u"b", "literal": False}).literal)
+
+    def test_list_stream(self):
+        from pyramid.response import Response
+        response = Response(app_iter=[b"<html><he", b"ad></head><bo", b"dy></body></html>"],
+                            content_type="text/html", charset="utf-8")
+        request = testing.DummyRequest()
+        settings = FilterConf.fromDict({"callable": filterinc.replacestr, "mode": "stream",
+                                        "settings": {"replace": [{"str": u"<head>", "new": u"<head>1"},
+                                                                 {"str": u"<body>", "new": u"<body>2"}]}})
+        response = filterinc.replacestr(response, request, settings, request.url)
+        self.assertEqual(b"".join(response.app_iter), b"<html><head>1</head><body>2</body></html>")
+
+
+
+
+class StreamTest(unittest.TestCase):
+
+    def response(self, chunks):
+        from pyramid.response import Response
+        return Response(app_iter=chunks, content_type="text/html", charset="utf-8")
+
+    def test_replacestr_boundary(self):
+        response = self.response([b"<html><bo", b"dy></bo", b"dy><body>", b"</html>"])
+        request = testing.DummyRequest()
+        settings = FilterConf.fromDict({"mode": "stream", "settings":{"str": u"<body>", "new": u"<body>Updated!"}})
+        response = filterinc.replacestr(response, request, settings, request.url)
+        self.assertEqual(b"".join(response.app_iter), b"<html><body>Updated!</body><body>Updated!</html>")
+
+    def test_replacestr_regex(self):
+        response = self.response([b"a1", b"23b", b"4", b"56c"])
+        request = testing.DummyRequest()
+        settings = FilterConf.fromDict({"mode": "stream", "settings":{"str": u"[0-9]+", "new": u"#", "window": 4}})
+        response = filterinc.replacestr(response, request, settings, request.url)
+        self.assertEqual(b"".join(response.app_iter), b"a#b#c")
+
+    def test_replacestr_greedy(self):
+        # matches ending at the chunk end may continue in the next chunk
+        response = self.response([b"bbbbaa", b"aab", b"a", b"a", b"b"])
+        request = testing.DummyRequest()
+        settings = FilterConf.fromDict({"mode": "stream", "settings":{"str": u"a+", "new": u"X", "window": 2}})
+        response = filterinc.replacestr(response, request, settings, request.url)
+        self.assertEqual(b"".join(response.app_iter), b"bbbbXbXb")
+
+    def test_replacestr_groups(self):
+        response = self.response([b"<a href='x'>", b"<a hr", b"ef='y'>"])
+        request = testing.DummyRequest()
+        settings = FilterConf.fromDict({"mode": "stream", "settings":{"str": u"href='(.)'", "new": u"href='/\\1'"}})
+        response = filterinc.replacestr(response, request, settings, request.url)
+        self.assertEqual(b"".join(response.app_iter), b"<a href='/x'><a href='/y'>")
+
+    def test_replacestr_buffered(self):
+        response = testing.DummyRequest().response
+        response.unicode_body = u"<html><body></body></html>"
+        request = testing.DummyRequest()
+        settings = FilterConf.fromDict({"mode": "stream", "settings":{"str": u"<body>", "new": u"<body>Updated!"}})
+        response = filterinc.replacestr(response, request, settings, request.url)
+        self.assertEqual(response.body, b"<html><body>Updated!</body></html>")
+
+    def test_rewrite_urls(self):
+        class Url(object):
+            destDomain = "http://backend:8080"
+            srcDomain = ""
+        response = self.response([b"<a href='http://back", b"end:8080/page'>", b"http://backend:8080"])
+        request = testing.DummyRequest()
+        settings = FilterConf.fromDict({"mode": "stream", "settings": {}})
+        response = filterinc.rewrite_urls(response, request, settings, Url())
+        self.assertEqual(b"".join(response.app_iter), b"<a href='/page'>")
+
 
+class SnippetTest(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "snippet.html")
+        self.write(b"<script>x</script>")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def write(self, data):
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def response(self, chunks):
+        from pyramid.response import Response
+        return Response(app_iter=chunks, content_type="text/html", charset="utf-8")
+
+    def test_appendhead(self):
+        response = self.response([b"<html><head></head><body><head></head></body></html>"])
+        request = testing.DummyRequest()
+        settings = FilterConf.fromDict({"callable": filterinc.appendhead, "settings": {"appendhead": self.path}})
+        response = filterinc.appendhead(response, request, settings, request.url)
+        self.assertEqual(response.body, b"<html><head><script>x</script></head><body><head></head></body></html>")
+
+    def test_appendbody(self):
+        response = self.response([b"<html><body><p>&lt;/body&gt;</body></p></body></html>"])
+        request = testing.DummyRequest()
+        settings = FilterConf.fromDict({"callable": filterinc.appendbody, "settings": {"appendbody": self.path}})
+        response = filterinc.appendbody(response, request, settings, request.url)
+        self.assertEqual(response.body, b"<html><body><p>&lt;/body&gt;</body></p><script>x</script></body></html>")
+
+    def test_missing(self):
+        response = self.response([b"<html><head></head></html>"])
+        request = testing.DummyRequest()
+        settings = FilterConf.fromDict({"callable": filterinc.appendhead,
+                                        "settings": {"appendhead": self.path+".missing"}})
+        response = filterinc.appendhead(response, request, settings, request.url)
+        self.assertEqual(response.body, b"<html><head></head></html>")
+
+    def test_reload(self):
+        snippet = filterinc.Snippet(self.path)
+        self.assertEqual(snippet.get(), b"<script>x</script>")
+        self.write(b"<script>changed</script>")
+        os.utime(self.path, (os.stat(self.path).st_mtime+10,)*2)
+        self.assertEqual(snippet.get(), b"<script>x</script>")
+        self.assertEqual(snippet.get(check=0), b"<script>changed</script>")
+        os.remove(self.path)
+        self.assertEqual(snippet.get(check=0), None)
+
+    def test_debug(self):
+        request = testing.DummyRequest()
+        request.registry.settings = {"debug": "False"}
+        settings = FilterConf.fromDict({"callable": filterinc.appendhead, "settings": {"appendhead": self.path}})
+        filterinc.appendhead(self.response([b"<head></head>"]), request, settings, request.url)
+        self.write(b"<script>changed</script>")
+        os.utime(self.path, (os.stat(self.path).st_mtime+10,)*2)
+        response = filterinc.appendhead(self.response([b"<head></head>"]), request, settings, request.url)
+        self.assertEqual(response.body, b"<head><script>x</script></head>")
+        request.registry.settings = {"debug": "true"}
+        response = filterinc.appendhead(self.response([b"<head></head>"]), request, settings, request.url)
+        self.assertEqual(response.body, b"<head><script>changed</script></head>")
+
+    def test_stream_head(self):
+        response = self.response([b"<html><he", b"ad></he", b"ad><body><head></head>", b"</body></html>"])
+        request = testing.DummyRequest()
+        settings = FilterConf.fromDict({"callable": filterinc.appendhead, "mode": "stream",
+                                        "settings": {"appendhead": self.path}})
+        response = filterinc.appendhead(response, request, settings, request.url)
+        self.assertEqual(b"".join(response.app_iter),
+                         b"<html><head><script>x</script></head><body><head></head></body></html>")
+
+    def test_stream_body(self):
+        response = self.response([b"<html><body>a</bo", b"dy>b</", b"body>", b"c", b"</html>"])
+        request = testing.DummyRequest()
+        settings = FilterConf.fromDict({"callable": filterinc.appendbody, "mode": "stream",
+                                        "settings": {"appendbody": self.path}})
+        response = filterinc.appendbody(response, request, settings, request.url)
+        self.assertEqual(b"".join(response.app_iter),
+                         b"<html><body>a</body>b<script>x</script></body>c</html>")
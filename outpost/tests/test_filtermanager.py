@@ -350,3 +350,93 @@ class RunTest(unittest.TestCase):
         request.registry.settings = {"filter": (fc,)}
         filter = [f for f in filtermanager.lookupFilter("post", response, request, request.url)]
         self.assertTrue(len(filter)==1)
+
+
+class StreamFilterTest(unittest.TestCase):
+
+    def test_stream_filter(self):
+        closed = []
+        class Body(list):
+            def close(self):
+                closed.append(True)
+        def upper(chunks):
+            for chunk in chunks:
+                yield chunk.upper()
+        def runfilter(response, request, filterconf, url):
+            return filtermanager.streamFilter(response, upper)
+        fc = filtermanager.FilterConf.fromDict(dict(callable=runfilter, mode="stream"))
+        self.assertFalse(fc.test())
+        response = Response(app_iter=Body([b"a", b"b"]))
+        request = testing.DummyRequest()
+        response = filtermanager.applyFilter(fc, response, request, request.url)
+        self.assertEqual(list(response.app_iter), [b"A", b"B"])
+        response.app_iter.close()
+        self.assertTrue(closed)
+
+    def test_mode(self):
+        fc = filtermanager.FilterConf.fromDict(dict(callable="outpost.filterinc.replacestr", mode="chunked"))
+        self.assertTrue(len(fc.test())==1)
+        fc = filtermanager.FilterConf.fromDict(dict(callable="outpost.filterinc.add_header"))
+        self.assertEqual(fc.mode, "headers")
+
+
+class FilterTableTest(unittest.TestCase):
+
+    def filters(self):
+        confs = []
+        for i, (apply_to, path, ct) in enumerate((("proxy", r"\.html$", "text/html"),
+                                                  ("file", r"^/files/", None),
+                                                  (None, r"index\.(html|htm)", None),
+                                                  ("proxy", r"(a)\1", None),
+                                                  (None, None, "image/"))):
+            confs.append(filtermanager.FilterConf.fromDict(dict(
+                callable="outpost.filterinc.replacestr",
+                apply_to=apply_to, path=path, content_type=ct,
+                settings={}, name="f%d" % i)))
+        return filtermanager.FilterTable(confs, cachesize=10)
+
+    def lookup(self, table, response, path):
+        request = testing.DummyRequest()
+        request.registry.settings = {"filter": table}
+        return [f.name for f in filtermanager.lookupFilter("post", response, request, path)]
+
+    def test_table(self):
+        table = self.filters()
+        self.assertEqual(len(table), 5)
+        self.assertEqual(table[0].name, "f0")
+        self.assertEqual(len(table.fallback), 1)
+
+    def test_lookup(self):
+        table = self.filters()
+        response = Response(content_type="text/html")
+        directlyProvides(response, filtermanager.IProxyRequest)
+        self.assertEqual(self.lookup(table, response, "/files/index.html"), ["f0", "f2"])
+        self.assertEqual(self.lookup(table, response, "/aa/x"), ["f3"])
+        directlyProvides(response, filtermanager.IFileRequest)
+        self.assertEqual(self.lookup(table, response, "/files/index.htm"), ["f1", "f2"])
+        response.content_type = "image/png"
+        self.assertEqual(self.lookup(table, response, "/files/image.png"), ["f1", "f4"])
+        response.status_int = 404
+        self.assertEqual(self.lookup(table, response, "/files/image.png"), [])
+
+    def test_cache(self):
+        table = self.filters()
+        response = Response(content_type="text/html")
+        directlyProvides(response, filtermanager.IProxyRequest)
+        for i in range(20):
+            self.lookup(table, response, "/page%d.html" % i)
+        self.lookup(table, response, "/page19.html")
+        info = table.candidates.cache_info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.currsize, 10)
+
+    def test_environ(self):
+        fc = filtermanager.FilterConf.fromDict(dict(
+            callable="outpost.filterinc.replacestr",
+            environ={"name": "outpost.test", "value": True}))
+        response = Response()
+        request = testing.DummyRequest()
+        request.registry.settings = {"filter": filtermanager.FilterTable((fc,))}
+        self.assertEqual(len(list(filtermanager.lookupFilter("post", response, request, "/"))), 0)
+        request.environ["outpost.test"] = True
+        self.assertEqual(len(list(filtermanager.lookupFilter("post", response, request, "/"))), 1)
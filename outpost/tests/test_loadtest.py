@@ -0,0 +1,40 @@
+import unittest
+
+from outpost.tests import loadtest
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_percentiles(self):
+        h = loadtest.Histogram()
+        for i in range(1, 10001):
+            h.record(i / 1000000.0 * 100)
+        self.assertEqual(h.count, 10000)
+        for p in (50, 90, 99, 99.9):
+            expected = p / 100.0 * 10000 * 100 / 1000000.0
+            self.assertAlmostEqual(h.percentile(p), expected, delta=expected/100)
+        self.assertEqual(h.percentile(100), 1.0)
+        self.assertEqual(h.summary()["min"], 0.0001)
+
+    def test_merge(self):
+        a, b = loadtest.Histogram(), loadtest.Histogram()
+        a.record(0.001)
+        b.record(0.5)
+        b.record(0.002)
+        a.merge(b)
+        self.assertEqual(a.count, 3)
+        self.assertEqual(a.max, 500000)
+        self.assertAlmostEqual(a.percentile(50), 0.002, delta=0.00002)
+
+    def test_large_values(self):
+        h = loadtest.Histogram()
+        h.record(12.5)
+        self.assertAlmostEqual(h.percentile(50), 12.5, delta=0.1)
+
+    def test_compare(self):
+        latency = {"p99": 0.01}
+        baseline = {"results": [{"scenario": "json", "mode": "closed", "throughput": 100.0, "latency": latency}]}
+        results = [{"scenario": "json", "mode": "closed", "throughput": 95.0, "latency": {"p99": 0.0105}}]
+        self.assertEqual(loadtest.compare(results, baseline), [])
+        results = [{"scenario": "json", "mode": "closed", "throughput": 80.0, "latency": {"p99": 0.02}}]
+        self.assertEqual(len(loadtest.compare(results, baseline)), 2)
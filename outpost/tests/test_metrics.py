@@ -0,0 +1,92 @@
+import unittest
+import os
+import threading
+from wsgiref.simple_server import make_server
+
+from pyramid.request import Request
+
+from outpost import metrics
+from outpost.server import main
+from outpost.tests.test_proxy import QuietHandler, backend
+
+
+class MetricsTest(unittest.TestCase):
+
+    def test_histogram(self):
+        m = metrics.Metrics(buckets=(0.1, 1.0))
+        m.observe("outpost_request_seconds", ("proxy", "200"), 0.05)
+        m.observe("outpost_request_seconds", ("proxy", "200"), 0.5)
+        m.observe("outpost_request_seconds", ("proxy", "200"), 5)
+        values = m.collect()
+        self.assertEqual(values[("outpost_request_seconds", ("proxy", "200"))], [1, 1, 1, 5.55])
+        text = m.prometheus()
+        self.assertTrue('outpost_request_seconds_bucket{route="proxy",status="200",le="0.1"} 1' in text)
+        self.assertTrue('outpost_request_seconds_bucket{route="proxy",status="200",le="+Inf"} 3' in text)
+        self.assertTrue('outpost_request_seconds_count{route="proxy",status="200"} 3' in text)
+
+    def test_threads(self):
+        m = metrics.Metrics()
+
+        def count():
+            for i in range(1000):
+                m.inc("outpost_response_bytes_total", ("files",), 2)
+
+        threads = [threading.Thread(target=count) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(m.collect()[("outpost_response_bytes_total", ("files",))], 8000)
+        self.assertEqual(len(m.shards), 4)
+
+    def test_labels(self):
+        self.assertEqual(metrics._labels(("a", "b"), ('x"y', "z\\")), '{a="x\\"y",b="z\\\\"}')
+        self.assertEqual(metrics._labels((), ()), "")
+
+
+class MetricsViewTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = make_server("127.0.0.1", 0, backend, handler_class=QuietHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_view(self):
+        filters = '[{"callable": "outpost.filterinc.add_header", "apply_to": "proxy", "name": "header", ' \
+                  '"settings": {"name": "X-Test", "value": "1"}}]'
+        app = main({}, **{"proxy.host": "127.0.0.1:%d" % self.server.server_port,
+                          "proxy.route": "api",
+                          "proxy.timeout": "10",
+                          "files.directory": os.path.dirname(__file__),
+                          "files.route": "files",
+                          "metrics.path": "/__metrics",
+                          "filter": filters})
+        self.assertEqual(Request.blank("/api/data.json").get_response(app).status_int, 200)
+        self.assertEqual(Request.blank("/files/links.json").get_response(app).status_int, 200)
+        response = Request.blank("/__metrics").get_response(app)
+        self.assertTrue(response.content_type.startswith("text/plain"))
+        text = response.text
+        self.assertTrue('outpost_request_seconds_count{route="proxy",status="200"} 1' in text)
+        self.assertTrue('outpost_request_seconds_count{route="files",status="200"} 1' in text)
+        self.assertTrue('outpost_backend_seconds_count{status="200"} 1' in text)
+        self.assertTrue('outpost_filter_seconds_count{filter="header",hook="post"} 1' in text)
+        self.assertTrue('outpost_response_bytes_total{route="proxy"} 16' in text)
+        self.assertTrue("outpost_pool_connections" in text)
+
+    def test_error(self):
+        from outpost.tests.test_upstream import freePort
+        app = main({}, **{"proxy.host": "127.0.0.1:%d" % freePort(),
+                          "proxy.route": "api",
+                          "proxy.timeout": "10",
+                          "metrics.path": "/__metrics",
+                          "filter": ""})
+        self.assertRaises(Exception, Request.blank("/api/data.json").get_response, app)
+        text = Request.blank("/__metrics").get_response(app).text
+        self.assertTrue('outpost_request_seconds_count{route="proxy",status="500"} 1' in text)
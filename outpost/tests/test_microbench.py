@@ -0,0 +1,31 @@
+import unittest
+
+from outpost.tests import microbench
+
+
+class MicrobenchTest(unittest.TestCase):
+
+    def test_run(self):
+        results = microbench.run(sizes=("1k",), rounds=1, mintime=0.001)
+        self.assertEqual(len(results), len(microbench.BENCHMARKS))
+        self.assertTrue(all(r["best"] > 0 for r in results.values()))
+
+    def test_select(self):
+        results = microbench.run(select=("proxy.",), sizes=("1k",), rounds=1, mintime=0.001)
+        self.assertEqual(sorted(results), ["proxy.ProxyUrlHandler", "proxy.prepare", "proxy.wrap"])
+
+    def test_filters(self):
+        # the benchmark filter configuration is applied as in production
+        ctx = microbench.Context()
+        try:
+            response = microbench.benchPostHook(ctx)()
+        finally:
+            ctx.close()
+        self.assertEqual(response.headers.get("X-Served-By"), "outpost")
+        self.assertFalse("None" in response.headers)
+        self.assertTrue(b"LOREM" in response.body)
+
+    def test_compare(self):
+        baseline = {"results": {"a": {"best": 1.0}, "b": {"best": 1.0}}}
+        results = {"a": {"best": 1.1}, "b": {"best": 1.5}, "c": {"best": 1.0}}
+        self.assertEqual(microbench.compare(results, baseline), [("b", 1.0, 1.5)])
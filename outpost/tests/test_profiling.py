@@ -0,0 +1,75 @@
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+from wsgiref.simple_server import make_server
+
+from pyramid.request import Request
+from pyramid.response import Response
+
+from outpost import profiling
+from outpost.server import main
+from outpost.tests.test_proxy import QuietHandler, backend
+
+
+class ProfilingTest(unittest.TestCase):
+    filters = '[{"callable": "outpost.filterinc.replacestr", "apply_to": "proxy", "name": "strfilter", ' \
+              '"settings": {"str": "true", "new": "false"}}]'
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = make_server("127.0.0.1", 0, backend, handler_class=QuietHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def app(self, **values):
+        settings = {"proxy.host": "127.0.0.1:%d" % self.server.server_port,
+                    "proxy.route": "api",
+                    "proxy.timeout": "10",
+                    "filter": self.filters}
+        settings.update(values)
+        return main({}, **settings)
+
+    def test_server_timing(self):
+        app = self.app(**{"filter.timing": "true"})
+        response = Request.blank("/api/data.json").get_response(app)
+        self.assertEqual(response.body, b"{\"result\": false}")
+        names = [v.split(";")[0] for v in response.headers["Server-Timing"].split(", ")]
+        self.assertEqual(names, ["backend", "strfilter", "total"])
+        response = Request.blank("/api/data.json").get_response(self.app())
+        self.assertFalse("Server-Timing" in response.headers)
+
+    def test_filter_metrics(self):
+        app = self.app(**{"metrics.path": "/__metrics"})
+        Request.blank("/api/data.json").get_response(app)
+        text = Request.blank("/__metrics").get_response(app).text
+        self.assertTrue('outpost_filter_bytes_in_total{filter="strfilter",hook="post"} 16' in text)
+        self.assertTrue('outpost_filter_bytes_out_total{filter="strfilter",hook="post"} 17' in text)
+        self.assertTrue('outpost_filter_quantile_seconds{filter="strfilter",hook="post",quantile="0.99"}' in text)
+
+    def test_sampler(self):
+        app = self.app(**{"profile.sample": "2", "profile.directory": self.directory})
+        for i in range(4):
+            Request.blank("/api/data.json").get_response(app)
+        files = os.listdir(self.directory)
+        self.assertEqual(len(files), 2)
+        self.assertTrue(files[0].endswith("-api_data.json.prof"))
+
+    def test_serverTiming(self):
+        request = Request.blank("/")
+        request.environ["outpost.timing"] = [("my filter", 0.001)]
+        response = profiling.serverTiming(request, Response(), 0.002)
+        self.assertEqual(response.headers["Server-Timing"], "my_filter;dur=1.00, total;dur=2.00")
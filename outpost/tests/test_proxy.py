@@ -0,0 +1,435 @@
+import unittest
+import gzip
+import threading
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+from pyramid import testing
+from pyramid.request import Request
+
+from outpost import filtermanager
+from outpost.proxy import Proxy, ProxyUrlHandler, StreamIter
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+backend_requests = []
+backend_ranges = []
+media = b"0123456789abcdef" * 6400
+
+def backend(environ, start_response):
+    path = environ["PATH_INFO"]
+    backend_requests.append((path, environ.get("HTTP_IF_NONE_MATCH")))
+    if path.endswith("/gzip.html"):
+        body = b"<html><body>" + b"gzip "*1000 + b"</body></html>"
+        headers = [("Content-Type", "text/html")]
+        if "gzip" in environ.get("HTTP_ACCEPT_ENCODING", ""):
+            body = gzip.compress(body)
+            headers.append(("Content-Encoding", "gzip"))
+        headers.append(("Content-Length", str(len(body))))
+        start_response("200 OK", headers)
+        return [body]
+    if path.endswith("/media.txt"):
+        backend_ranges.append((environ.get("HTTP_RANGE"), environ.get("HTTP_ACCEPT_ENCODING")))
+        rng = environ.get("HTTP_RANGE")
+        if rng:
+            start, end = [int(v) for v in rng[6:].split("-")]
+            body = media[start:end+1]
+            start_response("206 Partial Content", [("Content-Type", "text/plain"), ("Content-Length", str(len(body))),
+                                                   ("Content-Range", "bytes %d-%d/%d" % (start, end, len(media)))])
+            return [body]
+        start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", str(len(media))),
+                                  ("Accept-Ranges", "bytes")])
+        return [media]
+    if path.endswith("/etag.json"):
+        headers = [("Content-Type", "application/json"), ("ETag", '"v1"'), ("Cache-Control", "max-age=0")]
+        if environ.get("HTTP_IF_NONE_MATCH") == '"v1"':
+            start_response("304 Not Modified", headers)
+            return [b""]
+        start_response("200 OK", headers)
+        return [b"{\"etag\": 1}"]
+    if path.endswith(".html"):
+        body = b"<html><body>" + b"x"*100000 + b"</body></html>"
+        ct = "text/html; charset=utf-8"
+    else:
+        body = b"{\"result\": true}"
+        ct = "application/json"
+    start_response("200 OK", [("Content-Type", ct), ("Content-Length", str(len(body)))])
+    return [body]
+
+
+class ProxyTestBase(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = make_server("127.0.0.1", 0, backend, handler_class=QuietHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def settings(self, **values):
+        settings = {"proxy.host": "127.0.0.1:%d" % self.server.server_port,
+                    "proxy.timeout": "10",
+                    "proxy.session": False,
+                    "filter": ()}
+        settings.update(values)
+        return settings
+
+    def request(self, path, settings):
+        request = Request.blank(path)
+        request.registry = self.config.registry
+        request.registry.settings = settings
+        return request
+
+    def call(self, path, **values):
+        request = self.request(path, self.settings(**values))
+        url = ProxyUrlHandler(request, request.registry.settings)
+        return Proxy(url, request, debug=False).response()
+
+
+class PrepareTest(ProxyTestBase):
+
+    def test_server_extensions(self):
+        request = self.request("/index.html", self.settings())
+        request.environ["waitress.client-disconnected"] = lambda: False
+        request.environ["HTTP_X_TEST"] = "1"
+        url = ProxyUrlHandler(request, request.registry.settings)
+        method, parameter = Proxy(url, request, debug=False).prepare(url, request)
+        self.assertEqual(parameter["headers"]["x-test"], "1")
+        self.assertFalse([h for h in parameter["headers"] if h.startswith("waitress")])
+
+
+class StreamTest(ProxyTestBase):
+
+    def test_buffered(self):
+        response = self.call("/index.html")
+        self.assertEqual(response.status_int, 200)
+        self.assertNotIsInstance(response.app_iter, StreamIter)
+        self.assertTrue(response.body.endswith(b"</body></html>"))
+
+    def test_stream(self):
+        response = self.call("/index.html", **{"proxy.stream": "true"})
+        self.assertIsInstance(response.app_iter, StreamIter)
+        body = b"".join(response.app_iter)
+        response.app_iter.close()
+        self.assertEqual(len(body), 100026)
+
+    def test_stream_path(self):
+        response = self.call("/data.json", **{"proxy.stream": "true", "proxy.stream.path": r"\.html$"})
+        self.assertNotIsInstance(response.app_iter, StreamIter)
+
+    def test_stream_content_type(self):
+        response = self.call("/data.json", **{"proxy.stream": "true", "proxy.stream.content_type": "text/"})
+        self.assertNotIsInstance(response.app_iter, StreamIter)
+        self.assertEqual(response.body, b"{\"result\": true}")
+
+    def test_stream_body_filter(self):
+        fc = filtermanager.FilterConf.fromDict(dict(
+            callable="outpost.filterinc.replacestr",
+            apply_to="proxy",
+            content_type="text/html",
+            settings={"str": "<body>", "new": "<body>Updated!"}))
+        response = self.call("/index.html", **{"proxy.stream": "true", "filter": (fc,)})
+        self.assertNotIsInstance(response.app_iter, StreamIter)
+        self.assertTrue(response.body.startswith(b"<html><body>Updated!"))
+
+    def test_stream_headers_filter(self):
+        fc = filtermanager.FilterConf.fromDict(dict(
+            callable="outpost.filterinc.add_header",
+            apply_to="proxy",
+            settings={"name": "X-Test", "value": "1"}))
+        self.assertEqual(fc.mode, "headers")
+        response = self.call("/index.html", **{"proxy.stream": "true", "filter": (fc,)})
+        self.assertIsInstance(response.app_iter, StreamIter)
+        self.assertEqual(response.headers["X-Test"], "1")
+        response.app_iter.close()
+
+    def test_stream_stream_filter(self):
+        fc = filtermanager.FilterConf.fromDict(dict(
+            callable="outpost.filterinc.replacestr",
+            apply_to="proxy",
+            mode="stream",
+            settings={"str": "<body>", "new": "<body>Updated!"}))
+        response = self.call("/index.html", **{"proxy.stream": "true", "filter": (fc,)})
+        self.assertIsInstance(response.app_iter, filtermanager.FilterIter)
+        body = b"".join(response.app_iter)
+        response.app_iter.close()
+        self.assertTrue(body.startswith(b"<html><body>Updated!xxx"))
+
+
+class RangeTest(ProxyTestBase):
+
+    def call(self, path, headers=None, **values):
+        request = self.request(path, self.settings(**values))
+        request.headers.update(headers or {})
+        url = ProxyUrlHandler(request, request.registry.settings)
+        return Proxy(url, request, debug=False).response(), request
+
+    def test_range(self):
+        response, request = self.call("/media.txt", {"Range": "bytes=10-19"})
+        self.assertEqual(response.status_int, 206)
+        self.assertEqual(response.headers["Content-Range"], "bytes 10-19/102400")
+        self.assertEqual(response.body, media[10:20])
+        self.assertEqual(backend_ranges[-1], ("bytes=10-19", "identity"))
+
+    def test_stream_length(self):
+        response, request = self.call("/media.txt", **{"proxy.stream": "true"})
+        self.assertIsInstance(response.app_iter, StreamIter)
+        self.assertEqual(response.content_length, 102400)
+        response.app_iter.close()
+
+    def test_range_body_filter(self):
+        fc = filtermanager.FilterConf.fromDict(dict(
+            callable="outpost.filterinc.replacestr",
+            apply_to="proxy",
+            settings={"str": "nothing", "new": "changed"}))
+        response, request = self.call("/media.txt", {"Range": "bytes=10-19"}, filter=(fc,))
+        self.assertEqual(backend_ranges[-1][0], None)
+        response = request.get_response(response)
+        self.assertEqual(response.status_int, 206)
+        self.assertEqual(response.body, media[10:20])
+
+    def test_cached_range(self):
+        write = filtermanager.FilterConf.fromDict(dict(callable="outpost.filterinc.cache_write",
+                                                       settings={"ttl": 60}))
+        read = filtermanager.FilterConf.fromDict(dict(callable="outpost.filterinc.cache_read", hook="pre"))
+        settings = self.settings(filter=(read, write))
+        for headers in ({}, {"Range": "bytes=100-109"}):
+            request = self.request("/media.txt", settings)
+            request.headers.update(headers)
+            url = ProxyUrlHandler(request, settings)
+            response = request.get_response(Proxy(url, request, debug=False).response())
+        self.assertEqual(response.status_int, 206)
+        self.assertEqual(response.body, media[100:110])
+        self.assertEqual(backend_ranges[-1][0], None)
+
+
+class PassthroughTest(ProxyTestBase):
+    html = b"<html><body>" + b"gzip "*1000 + b"</body></html>"
+
+    def call(self, path, **values):
+        request = self.request(path, self.settings(**values))
+        request.headers["Accept-Encoding"] = "gzip, sdch"
+        url = ProxyUrlHandler(request, request.registry.settings)
+        return Proxy(url, request, debug=False).response()
+
+    def test_decoded(self):
+        response = self.call("/gzip.html")
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(response.body, self.html)
+
+    def test_passthrough(self):
+        response = self.call("/gzip.html", **{"proxy.passthrough": "true"})
+        self.assertEqual(response.content_encoding, "gzip")
+        self.assertEqual(gzip.decompress(response.body), self.html)
+
+    def test_passthrough_stream(self):
+        response = self.call("/gzip.html", **{"proxy.passthrough": "true", "proxy.stream": "true"})
+        self.assertEqual(response.content_encoding, "gzip")
+        body = b"".join(response.app_iter)
+        response.app_iter.close()
+        self.assertEqual(response.content_length, len(body))
+        self.assertEqual(gzip.decompress(body), self.html)
+
+    def test_passthrough_filter(self):
+        fc = filtermanager.FilterConf.fromDict(dict(
+            callable="outpost.filterinc.replacestr",
+            apply_to="proxy",
+            settings={"str": "<body>", "new": "<body>Updated!"}))
+        for stream in ("false", "true"):
+            response = self.call("/gzip.html", **{"proxy.passthrough": "true", "proxy.stream": stream,
+                                                  "filter": (fc,)})
+            self.assertEqual(response.content_encoding, None)
+            self.assertTrue(response.body.startswith(b"<html><body>Updated!gzip"))
+
+    def test_passthrough_headers_filter(self):
+        fc = filtermanager.FilterConf.fromDict(dict(
+            callable="outpost.filterinc.add_header",
+            apply_to="proxy",
+            settings={"name": "X-Test", "value": "1"}))
+        response = self.call("/gzip.html", **{"proxy.passthrough": "true", "filter": (fc,)})
+        self.assertEqual(response.content_encoding, "gzip")
+        self.assertEqual(response.headers["X-Test"], "1")
+
+
+    def test_forwarded_headers(self):
+        from outpost import compress
+        settings = self.settings()
+        request = self.request("/gzip.html", settings)
+        request.headers.update({"Accept-Encoding": "gzip, deflate, br, unknown", "Connection": "keep-alive, X-Hop",
+                                "Keep-Alive": "300", "TE": "trailers", "Upgrade": "h2c", "X-Hop": "1",
+                                "Proxy-Authorization": "Basic xyz", "Trailer": "Expires", "X-Other": "1"})
+        url = ProxyUrlHandler(request, settings)
+        method, parameter = Proxy(url, request, debug=False).prepare(url, request)
+        headers = parameter["headers"]
+        self.assertEqual(headers["accept-encoding"], compress.acceptDecodable("gzip, deflate, br"))
+        self.assertNotIn("unknown", headers["accept-encoding"])
+        for name in ("connection", "keep-alive", "te", "upgrade", "x-hop", "proxy-authorization", "trailer"):
+            self.assertNotIn(name, headers)
+        self.assertEqual(headers["x-other"], "1")
+        request.headers["Accept-Encoding"] = "unknown"
+        self.assertEqual(Proxy(url, request, debug=False).prepare(url, request)[1]["headers"]["accept-encoding"],
+                         "identity")
+
+class PoolTest(ProxyTestBase):
+
+    def test_pool(self):
+        from outpost import pool
+        from outpost.session import SessionManager
+        settings = self.settings(**{"proxy.pool.maxsize": "5"})
+        settings["proxy.sessions"] = sessions = SessionManager(settings)
+        for i in range(3):
+            request = self.request("/data.json", settings)
+            url = ProxyUrlHandler(request, settings)
+            response = Proxy(url, request, debug=False).response()
+            self.assertEqual(response.status_int, 200)
+        stats = pool.statistics()["http://127.0.0.1:%d" % self.server.server_port]
+        self.assertEqual(stats["in_use"], 0)
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["maxsize"], 5)
+        self.assertTrue(stats["created"] >= 1)
+        self.assertEqual(stats["idle"], 1)
+        session = sessions.session()
+        self.assertTrue(session.get_adapter("https://localhost") is session.get_adapter("http://localhost"))
+        sessions.close()
+
+
+class SessionTest(unittest.TestCase):
+
+    def test_threads(self):
+        from outpost.session import SessionManager
+        sessions = SessionManager({})
+        result = []
+        def run():
+            result.append(sessions.session())
+        threads = [threading.Thread(target=run) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(id(s) for s in result)), 3)
+        self.assertTrue(sessions.session() is sessions.session())
+        self.assertTrue(result[0].get_adapter("http://a") is result[1].get_adapter("http://a"))
+        sessions.close()
+
+    def test_fork(self):
+        from outpost.session import SessionManager
+        sessions = SessionManager({})
+        session = sessions.session()
+        sessions.pid = -1
+        self.assertFalse(sessions.session() is session)
+        sessions.close()
+
+    def test_fork_locked(self):
+        from outpost import session
+        sessions = session.SessionManager({})
+        sessions.session()
+        # a parent thread holds the lock while forking
+        sessions.lock.acquire()
+        session._afterFork()
+        self.assertFalse(sessions.lock.locked())
+        self.assertEqual(sessions.sessions, [])
+        sessions.session()
+        sessions.close()
+
+
+class CacheTest(ProxyTestBase):
+
+    def filters(self):
+        return filtermanager.FilterTable((
+            filtermanager.FilterConf.fromDict(dict(callable="outpost.filterinc.cache_read", hook="pre",
+                                                   apply_to="proxy", settings={})),
+            filtermanager.FilterConf.fromDict(dict(callable="outpost.filterinc.cache_write", hook="post",
+                                                   apply_to="proxy", settings={}))))
+
+    def test_revalidate(self):
+        settings = self.settings(filter=self.filters())
+        del backend_requests[:]
+        for i in range(3):
+            request = self.request("/etag.json", settings)
+            url = ProxyUrlHandler(request, settings)
+            response = Proxy(url, request, debug=False).response()
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(response.body, b"{\"etag\": 1}")
+        self.assertEqual(backend_requests, [("/etag.json", None), ("/etag.json", '"v1"'), ("/etag.json", '"v1"')])
+        stats = settings["cache.instance"].statistics()
+        self.assertEqual(stats["revalidated"], 2)
+
+    def test_revalidate_failed(self):
+        import requests
+        from outpost.tests.test_upstream import freePort
+        from outpost import cache
+        settings = self.settings(filter=self.filters(), **{"proxy.host": "127.0.0.1:%d" % freePort()})
+        request = self.request("/etag.json", settings)
+        cache.getCache(settings).store(request, ProxyUrlHandler(request, settings), b"{}", 200,
+                                       [("ETag", '"v1"'), ("Cache-Control", "max-age=0")], "proxy")
+        with self.assertLogs("outpost.proxy", "WARNING") as logs:
+            self.assertRaises(requests.exceptions.ConnectionError,
+                              Proxy(ProxyUrlHandler(request, settings), request, debug=False).response)
+        self.assertTrue([l for l in logs.output if l.startswith("WARNING:outpost.proxy:cache revalidation failed")])
+
+    def test_client_304(self):
+        settings = self.settings(filter=self.filters())
+        request = self.request("/etag.json", settings)
+        Proxy(ProxyUrlHandler(request, settings), request, debug=False).response()
+        request = self.request("/etag.json", settings)
+        request.headers["If-None-Match"] = 'W/"v1"'
+        response = Proxy(ProxyUrlHandler(request, settings), request, debug=False).response()
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(response.body, b"")
+        self.assertEqual(response.headers["ETag"], '"v1"')
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def test_coalesce(self):
+        import time
+        from outpost.proxy import SingleFlight
+        flight = SingleFlight(timeout=5)
+        calls = []
+        results = []
+        def call():
+            calls.append(1)
+            time.sleep(0.2)
+            return "response"
+        def run():
+            results.append(flight.do("key", call))
+        threads = [threading.Thread(target=run) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(r[1] for r in results), [False, True, True, True, True])
+        self.assertEqual(flight.calls, {})
+
+    def test_error(self):
+        from outpost.proxy import SingleFlight
+        flight = SingleFlight()
+        def call():
+            raise ValueError()
+        self.assertRaises(ValueError, flight.do, "key", call)
+        self.assertEqual(flight.calls, {})
+
+    def test_key(self):
+        from outpost.proxy import SingleFlight
+        class Url(object):
+            fullPath = "http://host/a"
+        flight = SingleFlight(headers=["cookie"])
+        self.assertEqual(flight.key("get", Url(), {"cookie": "a=1", "accept": "x"}),
+                         flight.key("GET", Url(), {"cookie": "a=1", "accept": "y"}))
+        self.assertNotEqual(flight.key("GET", Url(), {"cookie": "a=1"}),
+                            flight.key("GET", Url(), {"cookie": "a=2"}))
@@ -0,0 +1,223 @@
+import unittest
+import asyncio
+import threading
+import time
+from wsgiref.simple_server import make_server, WSGIServer
+from socketserver import ThreadingMixIn
+
+from pyramid import testing
+from pyramid.request import Request
+
+from outpost import retry, upstream
+from outpost.proxy import Proxy, ProxyUrlHandler
+from outpost.tests.test_proxy import QuietHandler
+from outpost.tests.test_upstream import freePort
+
+try:
+    import httpx
+    from outpost import asgi
+except ImportError:
+    httpx = None
+
+
+class ThreadingServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def test_settings(self):
+        self.assertEqual(retry.RetryPolicy.fromSettings({}), None)
+        policy = retry.RetryPolicy.fromSettings({"proxy.retry.attempts": "2", "proxy.retry.methods": "get, head",
+                                                 "proxy.retry.status": "503", "proxy.retry.budget": "0.5"})
+        self.assertEqual(policy.attempts, 2)
+        self.assertTrue(policy.retryable("get"))
+        self.assertFalse(policy.retryable("POST"))
+        self.assertEqual(policy.status, (503,))
+        self.assertEqual(policy.budget.ratio, 0.5)
+        self.assertFalse(policy.hedge)
+        budget = retry.RetryBudget()
+        policy = retry.RetryPolicy.fromSettings({"proxy.hedge": "true", "proxy.hedge.delay": "0.1"}, budget)
+        self.assertEqual(policy.attempts, 0)
+        self.assertTrue(policy.budget is budget)
+        self.assertEqual(policy.hedgeDelay(), 0.1)
+
+    def test_backoff(self):
+        policy = retry.RetryPolicy(attempts=5, backoff=0.1, maxbackoff=0.3)
+        for attempt in range(5):
+            delay = policy.backoffDelay(attempt)
+            self.assertTrue(0 <= delay <= min(0.3, 0.1 * 2 ** attempt))
+
+    def test_budget(self):
+        budget = retry.RetryBudget(ratio=0.2, minimum=0)
+        for i in range(10):
+            budget.deposit()
+        self.assertTrue(budget.withdraw())
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+        self.assertEqual(budget.rejected, 1)
+        budget = retry.RetryBudget(ratio=0, minimum=0.5, window=4)
+        self.assertEqual([budget.withdraw() for i in range(3)], [True, True, False])
+
+    def test_latency(self):
+        latency = retry.Latency(size=100, interval=10, minsamples=20)
+        for i in range(19):
+            latency.record(i / 1000.0)
+        self.assertEqual(latency.percentile(95), None)
+        for i in range(19, 200):
+            latency.record((i % 100) / 1000.0)
+        self.assertAlmostEqual(latency.percentile(95), 0.095)
+        self.assertAlmostEqual(latency.percentile(50), 0.05)
+
+    def test_alternate(self):
+        group = upstream.UpstreamGroup(["a", "b", "c"])
+        a, b, c = group.upstreams
+        self.assertTrue(group.alternate(a) is b)
+        self.assertTrue(group.alternate(c) is a)
+        b.healthy = c.healthy = False
+        self.assertTrue(group.alternate(a) is a)
+
+
+class RetryProxyTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.servers = []
+        cls.calls = {}
+        cls.failures = {}
+        cls.delay = {}
+        for name in ("one", "two"):
+            def app(environ, start_response, name=name):
+                cls.calls[name] = cls.calls.get(name, 0) + 1
+                time.sleep(cls.delay.get(name, 0))
+                if cls.failures.get(name, 0) > 0:
+                    cls.failures[name] -= 1
+                    start_response("503 Service Unavailable", [("Content-Type", "text/plain")])
+                    return [b"failed"]
+                start_response("200 OK", [("Content-Type", "text/plain")])
+                return [name.encode("ascii")]
+            server = make_server("127.0.0.1", 0, app, server_class=ThreadingServer, handler_class=QuietHandler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            cls.servers.append(server)
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.shutdown()
+            server.server_close()
+
+    def setUp(self):
+        self.config = testing.setUp()
+        self.calls.clear()
+        self.failures.clear()
+        self.delay.clear()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def hosts(self):
+        return ["127.0.0.1:%d" % s.server_port for s in self.servers]
+
+    def settings(self, hosts, **values):
+        settings = {"proxy.host": " ".join(hosts), "proxy.timeout": "5", "filter": (),
+                    "proxy.retry.attempts": "2", "proxy.retry.backoff": "0.001"}
+        settings.update(values)
+        settings["proxy.upstreams"] = upstream.UpstreamGroup.fromSettings(settings)
+        settings["proxy.retrypolicy"] = retry.RetryPolicy.fromSettings(settings)
+        return settings
+
+    def call(self, settings, method="GET"):
+        request = Request.blank("/index.txt", method=method)
+        request.registry = self.config.registry
+        request.registry.settings = settings
+        url = ProxyUrlHandler(request, settings)
+        return Proxy(url, request, debug=False).response()
+
+    def test_retry_status(self):
+        settings = self.settings(self.hosts()[:1])
+        self.failures["one"] = 2
+        response = self.call(settings)
+        self.assertEqual(response.body, b"one")
+        self.assertEqual(self.calls["one"], 3)
+        self.failures["one"] = 3
+        self.assertEqual(self.call(settings).status_code, 503)
+
+    def test_retry_connection(self):
+        hosts = [self.hosts()[0], "127.0.0.1:%d" % freePort()]
+        settings = self.settings(hosts)
+        bodies = [self.call(settings).body for i in range(4)]
+        self.assertEqual(bodies, [b"one"] * 4)
+
+    def test_methods(self):
+        settings = self.settings(self.hosts()[:1])
+        self.failures["one"] = 1
+        self.assertEqual(self.call(settings, method="POST").status_code, 503)
+        self.assertEqual(self.calls["one"], 1)
+
+    def test_budget(self):
+        settings = self.settings(self.hosts()[:1], **{"proxy.retry.budget": "0", "proxy.retry.budget.min": "0.1"})
+        self.failures["one"] = 10
+        # one retry in the 10 second window
+        self.assertEqual(self.call(settings).status_code, 503)
+        self.assertEqual(self.calls["one"], 2)
+        self.assertEqual(self.call(settings).status_code, 503)
+        self.assertEqual(self.calls["one"], 3)
+
+    def test_hedge(self):
+        settings = self.settings(self.hosts(), **{"proxy.hedge": "true", "proxy.hedge.delay": "0.05",
+                                                  "proxy.retry.attempts": "0"})
+        self.delay["one"] = 1.0
+        t = time.perf_counter()
+        response = self.call(settings)
+        self.assertEqual(response.body, b"two")
+        self.assertLess(time.perf_counter() - t, 0.9)
+        # fast responses are not hedged
+        self.delay["one"] = 0
+        self.assertEqual(self.call(settings).body, b"two")
+        self.assertEqual(self.call(settings).body, b"one")
+        self.assertEqual(self.calls, {"one": 2, "two": 2})
+
+    def test_hedge_passthrough(self):
+        settings = self.settings(self.hosts(), **{"proxy.hedge": "true", "proxy.hedge.delay": "0.05",
+                                                  "proxy.retry.attempts": "0", "proxy.passthrough": "true"})
+        self.delay["one"] = 1.0
+        t = time.perf_counter()
+        response = self.call(settings)
+        self.assertEqual(response.body, b"two")
+        self.assertLess(time.perf_counter() - t, 0.9)
+
+    def test_hedge_percentile(self):
+        settings = self.settings(self.hosts(), **{"proxy.hedge": "true", "proxy.retry.attempts": "0"})
+        policy = settings["proxy.retrypolicy"]
+        self.assertEqual(policy.hedgeDelay(), None)
+        for i in range(20):
+            self.call(settings)
+        self.assertLess(policy.hedgeDelay(), 0.5)
+
+
+@unittest.skipIf(httpx is None, "httpx not installed")
+class AsyncRetryTest(RetryProxyTest):
+
+    def call(self, settings, method="GET"):
+        request = Request.blank("/index.txt", method=method)
+        request.registry = self.config.registry
+        request.registry.settings = settings
+        url = ProxyUrlHandler(request, settings)
+
+        async def run():
+            async with httpx.AsyncClient() as client:
+                proxy = asgi.AsyncProxy(url, request, False, client, None)
+                response, body = await proxy.proxy(url, request)
+            return response, body
+
+        response, body = asyncio.run(run())
+        result = Proxy(url, request, debug=False).wrap(response, body)
+        return result
+
+    def test_retry_connection(self):
+        hosts = [self.hosts()[0], "127.0.0.1:%d" % freePort()]
+        settings = self.settings(hosts)
+        for i in range(4):
+            self.assertEqual(self.call(settings).body, b"one")
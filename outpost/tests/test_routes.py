@@ -0,0 +1,131 @@
+import unittest
+import json
+import threading
+from wsgiref.simple_server import make_server
+
+from pyramid import testing
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.request import Request
+
+from outpost import routes
+from outpost.filtermanager import ConfigurationError
+from outpost.proxy import Proxy, ProxyUrlHandler
+from outpost.tests.test_proxy import QuietHandler
+
+
+class RouteTableTest(unittest.TestCase):
+
+    def table(self, conf, **settings):
+        settings["proxy.routes"] = json.dumps(conf)
+        return routes.RouteTable.fromSettings(settings)
+
+    def test_settings(self):
+        self.assertEqual(routes.RouteTable.fromSettings({}), None)
+        self.assertEqual(routes.RouteTable.fromSettings({"proxy.routes": " "}), None)
+        self.assertRaises(ConfigurationError, routes.RouteTable.fromSettings, {"proxy.routes": "[{"})
+        self.assertRaises(ConfigurationError, self.table, [{"host": "a"}])
+        self.assertRaises(ConfigurationError, self.table, [{"prefix": "/a"}])
+        table = self.table({"prefix": "/a", "host": "a:80", "timeout": 5, "pool": {"maxsize": 20}},
+                           **{"proxy.timeout": "60", "proxy.protocol": "https"})
+        route = table.routes[0]
+        self.assertEqual(route.settings["proxy.host"], "a:80")
+        self.assertEqual(route.settings["proxy.timeout"], "5")
+        self.assertEqual(route.settings["proxy.protocol"], "https")
+        self.assertEqual(route.settings["proxy.pool.maxsize"], "20")
+        self.assertIsNotNone(route.sessions)
+        self.assertIsNone(route.upstreams)
+
+    def test_prefix(self):
+        table = self.table([{"prefix": "/api", "host": "api"},
+                            {"prefix": "/api/users/", "host": "users"},
+                            {"prefix": "/static", "host": "static"}])
+        self.assertEqual(table.match("/api").name, "/api")
+        self.assertEqual(table.match("/api/orders/1").name, "/api")
+        self.assertEqual(table.match("/api/users").name, "/api/users/")
+        self.assertEqual(table.match("/api/users/1").name, "/api/users/")
+        self.assertEqual(table.match("/api/usersearch").name, "/api")
+        self.assertEqual(table.match("/apis"), None)
+        self.assertEqual(table.match("/"), None)
+
+    def test_root(self):
+        table = self.table([{"prefix": "/", "host": "default"}, {"prefix": "/a", "host": "a"}])
+        self.assertEqual(table.match("/b/c").name, "/")
+        self.assertEqual(table.match("/a/c").name, "/a")
+
+    def test_regex(self):
+        table = self.table([{"regex": "^/api/v[0-9]+/orders", "host": "orders"},
+                            {"regex": r".*\.json$", "host": "json"},
+                            {"prefix": "/api/v1", "host": "v1"}])
+        self.assertEqual(table.match("/api/v2/orders/1").name, "^/api/v[0-9]+/orders")
+        self.assertEqual(table.match("/api/v2/orders.json").name, "^/api/v[0-9]+/orders")
+        self.assertEqual(table.match("/data/list.json").name, r".*\.json$")
+        # prefixes are matched first
+        self.assertEqual(table.match("/api/v1/orders").name, "/api/v1")
+        self.assertEqual(table.match("/api/v2/users"), None)
+
+    def test_upstreams(self):
+        table = self.table([{"prefix": "/a", "host": "a:80 b:80", "balance": "leastconn"}],
+                           **{"proxy.balance": "hash"})
+        group = table.routes[0].upstreams
+        self.assertEqual([u.host for u in group.upstreams], ["a:80", "b:80"])
+        self.assertEqual(group.policy, "leastconn")
+
+
+class RoutedProxyTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.servers = []
+        for name in ("default", "api"):
+            def app(environ, start_response, name=name):
+                start_response("200 OK", [("Content-Type", "text/plain")])
+                return [("%s %s" % (name, environ["PATH_INFO"])).encode("ascii")]
+            server = make_server("127.0.0.1", 0, app, handler_class=QuietHandler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            cls.servers.append(server)
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.shutdown()
+            server.server_close()
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def settings(self, host=None):
+        api = "127.0.0.1:%d" % self.servers[1].server_port
+        settings = {"proxy.host": host, "proxy.timeout": "5", "filter": (),
+                    "proxy.routes": json.dumps([{"prefix": "/api", "host": api, "timeout": 2,
+                                                 "rewrite": "/api /v1"}])}
+        settings["proxy.routetable"] = routes.RouteTable.fromSettings(settings)
+        return settings
+
+    def call(self, path, settings):
+        request = Request.blank(path)
+        request.registry = self.config.registry
+        request.registry.settings = settings
+        url = ProxyUrlHandler(request, settings)
+        return url, Proxy(url, request, debug=False).response()
+
+    def test_route(self):
+        default = "127.0.0.1:%d" % self.servers[0].server_port
+        settings = self.settings(default)
+        url, response = self.call("/api/users", settings)
+        self.assertEqual(url.timeout, 2.0)
+        self.assertEqual(url.route.name, "/api")
+        self.assertEqual(response.body, b"api /v1/users")
+        url, response = self.call("/index.html", settings)
+        self.assertEqual(url.timeout, 5.0)
+        self.assertEqual(url.route, None)
+        self.assertEqual(response.body, b"default /index.html")
+
+    def test_not_found(self):
+        settings = self.settings()
+        self.assertEqual(self.call("/api/users", settings)[1].body, b"api /v1/users")
+        self.assertRaises(HTTPNotFound, self.call, "/index.html", settings)
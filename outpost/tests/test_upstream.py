@@ -0,0 +1,214 @@
+import unittest
+import os
+import socket
+import threading
+import time
+from wsgiref.simple_server import make_server
+
+import requests
+from pyramid import testing
+from pyramid.request import Request
+
+from outpost import cache
+from outpost import upstream
+from outpost.proxy import Proxy, ProxyUrlHandler, SingleFlight
+from outpost.tests.test_proxy import QuietHandler
+
+
+def freePort():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class UpstreamGroupTest(unittest.TestCase):
+
+    def request(self, path="/", cookies=None):
+        request = Request.blank(path)
+        for name, value in (cookies or {}).items():
+            request.cookies[name] = value
+        return request
+
+    def test_settings(self):
+        self.assertEqual(upstream.UpstreamGroup.fromSettings({"proxy.host": "a:80"}), None)
+        group = upstream.UpstreamGroup.fromSettings({"proxy.host": "a:80, b:80", "proxy.balance": "leastconn"})
+        self.assertEqual([u.host for u in group.upstreams], ["a:80", "b:80"])
+        self.assertEqual(group.policy, "leastconn")
+        self.assertRaises(ValueError, upstream.UpstreamGroup, ["a", "b"], "random")
+
+    def test_roundrobin(self):
+        group = upstream.UpstreamGroup(["a", "b", "c"])
+        hosts = [group.select(self.request()).host for i in range(6)]
+        self.assertEqual(hosts, ["a", "b", "c", "a", "b", "c"])
+
+    def test_leastconn(self):
+        group = upstream.UpstreamGroup(["a", "b"], policy="leastconn")
+        a, b = group.upstreams
+        group.acquire(a)
+        group.acquire(a)
+        group.acquire(b)
+        for i in range(4):
+            self.assertEqual(group.select(self.request()).host, "b")
+        group.release(a)
+        group.release(a)
+        self.assertEqual(group.select(self.request()).host, "a")
+
+    def test_hash(self):
+        group = upstream.UpstreamGroup(["a", "b", "c"], policy="hash")
+        paths = ["/page%d.html" % i for i in range(300)]
+        selected = dict((p, group.select(self.request(p)).host) for p in paths)
+        self.assertEqual(selected, dict((p, group.select(self.request(p)).host) for p in paths))
+        self.assertEqual(set(selected.values()), set(["a", "b", "c"]))
+        # only the keys of the ejected host move
+        group.upstreams[0].healthy = False
+        for p in paths:
+            host = group.select(self.request(p)).host
+            self.assertNotEqual(host, "a")
+            if selected[p] != "a":
+                self.assertEqual(host, selected[p])
+
+    def test_hash_cookie(self):
+        group = upstream.UpstreamGroup(["a", "b", "c"], policy="hash", hashkey="cookie:session")
+        hosts = set(group.select(self.request("/%d" % i, {"session": "s1"})).host for i in range(20))
+        self.assertEqual(len(hosts), 1)
+        hosts = set(group.select(self.request("/")).host for i in range(6))
+        self.assertEqual(len(hosts), 3)
+
+    def test_eject(self):
+        group = upstream.UpstreamGroup(["a", "b"], failures=2, eject=30)
+        a = group.upstreams[0]
+        for ok in (False, True, False):
+            group.acquire(a)
+            group.release(a, ok)
+        self.assertTrue(a.available(0))
+        group.acquire(a)
+        group.release(a, False)
+        self.assertEqual(a.errors, 3)
+        hosts = set(group.select(self.request()).host for i in range(4))
+        self.assertEqual(hosts, set(["b"]))
+        # all hosts down
+        group.upstreams[1].healthy = False
+        self.assertEqual(group.select(self.request()).host, "a")
+        self.assertFalse(group.statistics()["a"]["available"])
+
+
+class BalancedProxyTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.servers = []
+        for name in ("one", "two"):
+            def app(environ, start_response, name=name.encode("ascii")):
+                if environ["PATH_INFO"] == "/health" and name == b"two" and cls.down:
+                    start_response("503 Service Unavailable", [("Content-Type", "text/plain")])
+                    return [b""]
+                start_response("200 OK", [("Content-Type", "text/plain")])
+                return [name]
+            server = make_server("127.0.0.1", 0, app, handler_class=QuietHandler)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            cls.servers.append(server)
+        cls.down = False
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.shutdown()
+            server.server_close()
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def call(self, settings):
+        request = Request.blank("/index.txt")
+        request.registry = self.config.registry
+        request.registry.settings = settings
+        url = ProxyUrlHandler(request, settings)
+        return Proxy(url, request, debug=False).response()
+
+    def settings(self, hosts, **values):
+        settings = {"proxy.host": " ".join(hosts), "proxy.timeout": "5", "filter": ()}
+        settings.update(values)
+        settings["proxy.upstreams"] = upstream.UpstreamGroup.fromSettings(settings)
+        return settings
+
+    def test_balance(self):
+        hosts = ["127.0.0.1:%d" % s.server_port for s in self.servers]
+        settings = self.settings(hosts)
+        bodies = [self.call(settings).body for i in range(4)]
+        self.assertEqual(bodies, [b"one", b"two", b"one", b"two"])
+        stats = settings["proxy.upstreams"].statistics()
+        self.assertEqual(stats[hosts[0]]["requests"], 2)
+        self.assertEqual(stats[hosts[0]]["active"], 0)
+
+    def test_cache_key(self):
+        hosts = ["127.0.0.1:%d" % s.server_port for s in self.servers]
+        settings = self.settings(hosts)
+        store = cache.ResponseCache()
+        urls = []
+        for i in range(2):
+            request = Request.blank("/index.txt?a=1")
+            url = ProxyUrlHandler(request, settings)
+            urls.append(url)
+            if store.lookup(request, url) is None:
+                store.store(request, url, b"one", 200, [("Content-Type", "text/plain")], "proxy")
+        self.assertNotEqual(urls[0].host, urls[1].host)
+        self.assertEqual(len(store.entries), 1)
+        self.assertEqual(store.statistics()["hits"], 1)
+        flight = SingleFlight()
+        self.assertEqual(flight.key("GET", urls[0], {}), flight.key("GET", urls[1], {}))
+
+    def test_passive_eject(self):
+        hosts = ["127.0.0.1:%d" % self.servers[0].server_port, "127.0.0.1:%d" % freePort()]
+        settings = self.settings(hosts, **{"proxy.upstream.failures": "1"})
+        results = []
+        for i in range(4):
+            try:
+                results.append(self.call(settings).body)
+            except requests.exceptions.ConnectionError:
+                results.append(None)
+        self.assertEqual(results, [b"one", None, b"one", b"one"])
+        self.assertFalse(settings["proxy.upstreams"].statistics()[hosts[1]]["available"])
+
+    def test_health_check(self):
+        hosts = ["127.0.0.1:%d" % s.server_port for s in self.servers]
+        settings = self.settings(hosts, **{"proxy.health.path": "health"})
+        group = settings["proxy.upstreams"]
+        checker = group.checker
+        # checks are run by the test instead of the background thread
+        checker.pid = os.getpid()
+        try:
+            BalancedProxyTest.down = True
+            checker.checkAll()
+            self.assertEqual([u.healthy for u in group.upstreams], [True, False])
+            self.assertEqual(set(self.call(settings).body for i in range(3)), set([b"one"]))
+            BalancedProxyTest.down = False
+            checker.checkAll()
+            self.assertEqual([u.healthy for u in group.upstreams], [True, True])
+        finally:
+            BalancedProxyTest.down = False
+            checker.stop()
+
+    def test_health_thread(self):
+        hosts = ["127.0.0.1:%d" % s.server_port for s in self.servers]
+        settings = self.settings(hosts, **{"proxy.health.path": "/health", "proxy.health.interval": "0.05"})
+        group = settings["proxy.upstreams"]
+        try:
+            BalancedProxyTest.down = True
+            self.call(settings)
+            self.assertTrue(group.checker.thread.is_alive())
+            for i in range(100):
+                if not group.upstreams[1].healthy:
+                    break
+                time.sleep(0.02)
+            self.assertFalse(group.upstreams[1].healthy)
+        finally:
+            BalancedProxyTest.down = False
+            group.checker.stop()
+            group.checker.thread.join()
@@ -0,0 +1,318 @@
+# Copyright 2015 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under BSD-license. See license.txt
+#
+"""
+Upstream load balancing
+-----------------------
+Distributes proxied requests over several identical backend servers. Enabled by listing
+multiple hosts in `proxy.host` ::
+
+    proxy.host = 10.0.0.1:8080 10.0.0.2:8080 10.0.0.3:8080
+
+Balancing policies (`proxy.balance`):
+
+- roundrobin: hosts are selected in turn (default)
+- leastconn: the host with the fewest requests in progress
+- hash: consistent hashing of the request path or a cookie value
+  (`proxy.balance.hash = path` or `cookie:<name>`). Requests without the cookie are
+  distributed round robin. If a host fails only its share of keys moves to other hosts.
+
+Passive failure detection: connection errors, timeouts and 502, 503 and 504 responses
+count as failure. A host is ejected for `proxy.upstream.eject` seconds after
+`proxy.upstream.failures` consecutive failures. If all hosts are ejected, the host
+with the earliest end of ejection is used.
+
+Active health checks are enabled by setting `proxy.health.path`. A background thread
+requests the path on each host every `proxy.health.interval` seconds. Hosts not
+responding with status 2xx or 3xx are marked down until the next successful check.
+
+Settings ::
+
+    proxy.balance = roundrobin          roundrobin, leastconn or hash
+    proxy.balance.hash = path           hash key: path or cookie:<name>
+    proxy.upstream.failures = 3         consecutive failures before ejecting a host
+    proxy.upstream.eject = 30           seconds an ejected host is skipped
+    proxy.health.path =                 health check path. empty disables active checks
+    proxy.health.interval = 10          seconds between health checks
+    proxy.health.timeout = 2            health check timeout in seconds
+
+The `UpstreamGroup` is stored as `proxy.upstreams` in the settings.
+"""
+import bisect
+import hashlib
+import itertools
+import logging
+import os
+import threading
+import time
+
+import requests
+
+POLICIES = ("roundrobin", "leastconn", "hash")
+
+# backend response status codes counted as failure
+FAILURE_STATUS = (502, 503, 504)
+
+# virtual nodes per host on the hash ring
+REPLICAS = 100
+
+
+def parseHosts(value):
+    """
+    Returns the list of hosts in `proxy.host`. Hosts are separated by spaces or commas.
+    """
+    if not value:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return value.replace(",", " ").split()
+
+
+class Upstream(object):
+    """
+    Backend host state. Counters are updated by `UpstreamGroup`.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.active = 0
+        self.failures = 0
+        self.ejected = 0.0
+        self.healthy = True
+        self.requests = 0
+        self.errors = 0
+
+    def available(self, now):
+        return self.healthy and self.ejected <= now
+
+    def __str__(self):
+        return self.host
+
+
+class UpstreamGroup(object):
+    """
+    Selects the backend host for a request and tracks host failures.
+    """
+
+    def __init__(self, hosts, policy="roundrobin", hashkey="path", failures=3, eject=30.0):
+        if policy not in POLICIES:
+            raise ValueError("Invalid balancing policy %s" % policy)
+        self.upstreams = [Upstream(h) for h in hosts]
+        self.policy = policy
+        self.hashkey = hashkey
+        self.failures = failures
+        self.eject = eject
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.checker = None
+        self.ring = []
+        self.ringhosts = []
+        if policy == "hash":
+            self._buildRing()
+
+    @staticmethod
+    def fromSettings(settings):
+        """
+        Returns the group if `proxy.host` lists more than one host, otherwise None.
+        """
+        hosts = parseHosts(settings.get("proxy.host"))
+        if len(hosts) < 2:
+            return None
+        group = UpstreamGroup(hosts,
+                              policy=settings.get("proxy.balance") or "roundrobin",
+                              hashkey=settings.get("proxy.balance.hash") or "path",
+                              failures=int(settings.get("proxy.upstream.failures") or 3),
+                              eject=float(settings.get("proxy.upstream.eject") or 30))
+        path = settings.get("proxy.health.path")
+        if path:
+            group.checker = HealthChecker(group, path,
+                                          protocol=settings.get("proxy.protocol") or "http",
+                                          interval=float(settings.get("proxy.health.interval") or 10),
+                                          timeout=float(settings.get("proxy.health.timeout") or 2))
+        return group
+
+    def _buildRing(self):
+        ring = []
+        for i, upstream in enumerate(self.upstreams):
+            for r in range(REPLICAS):
+                ring.append((_hash("%s#%d" % (upstream.host, r)), i))
+        ring.sort()
+        self.ring = [h for h, i in ring]
+        self.ringhosts = [i for h, i in ring]
+
+    def select(self, request):
+        """
+        Returns the upstream for the request.
+        """
+        if self.checker is not None:
+            self.checker.ensure()
+        now = time.monotonic()
+        if self.policy == "hash":
+            key = self.key(request)
+            if key is not None:
+                return self._hashed(key, now)
+        elif self.policy == "leastconn":
+            candidates = [u for u in self.upstreams if u.available(now)]
+            if candidates:
+                # round robin between hosts with equal load
+                offset = next(self.counter)
+                candidates = candidates[offset % len(candidates):] + candidates[:offset % len(candidates)]
+                return min(candidates, key=lambda u: u.active)
+            return self._fallback()
+        return self._roundrobin(now)
+
+    def key(self, request):
+        """
+        Returns the hash key of the request or None.
+        """
+        if self.hashkey.startswith("cookie:"):
+            return request.cookies.get(self.hashkey[7:])
+        return request.path_info
+
+    def _roundrobin(self, now):
+        count = len(self.upstreams)
+        start = next(self.counter)
+        for i in range(count):
+            upstream = self.upstreams[(start + i) % count]
+            if upstream.available(now):
+                return upstream
+        return self._fallback()
+
+    def _hashed(self, key, now):
+        pos = bisect.bisect(self.ring, _hash(key))
+        seen = set()
+        for i in range(len(self.ring)):
+            index = self.ringhosts[(pos + i) % len(self.ring)]
+            if index in seen:
+                continue
+            upstream = self.upstreams[index]
+            if upstream.available(now):
+                return upstream
+            seen.add(index)
+            if len(seen) == len(self.upstreams):
+                break
+        return self._fallback()
+
+    def alternate(self, upstream):
+        """
+        Returns the next available upstream after `upstream` for retries and hedged
+        requests or `upstream` if no other host is available.
+        """
+        now = time.monotonic()
+        count = len(self.upstreams)
+        start = self.upstreams.index(upstream)
+        for i in range(1, count):
+            other = self.upstreams[(start + i) % count]
+            if other.available(now):
+                return other
+        return upstream
+
+    def _fallback(self):
+        # all hosts are down. use the healthy host with the earliest end of ejection.
+        return min(self.upstreams, key=lambda u: (not u.healthy, u.ejected))
+
+    def acquire(self, upstream):
+        """
+        Marks the start of a request to the upstream.
+        """
+        with self.lock:
+            upstream.active += 1
+            upstream.requests += 1
+
+    def release(self, upstream, ok=True):
+        """
+        Marks the end of a request and records the result. `ok` is false for connection
+        errors, timeouts and gateway errors.
+        """
+        log = logging.getLogger("outpost.proxy")
+        with self.lock:
+            upstream.active -= 1
+            if ok:
+                upstream.failures = 0
+                return
+            upstream.errors += 1
+            upstream.failures += 1
+            if upstream.failures < self.failures:
+                return
+            upstream.failures = 0
+            upstream.ejected = time.monotonic() + self.eject
+        log.warning("Upstream %s ejected for %d seconds" % (upstream.host, self.eject))
+
+    def statistics(self):
+        """
+        Returns the state of all upstreams by host.
+        """
+        now = time.monotonic()
+        with self.lock:
+            return dict((u.host, dict(active=u.active, requests=u.requests, errors=u.errors,
+                                      healthy=u.healthy, available=u.available(now)))
+                        for u in self.upstreams)
+
+
+class HealthChecker(object):
+    """
+    Background thread checking the health path of all upstreams. The thread is started
+    on first use and restarted in forked worker processes.
+    """
+
+    def __init__(self, group, path, protocol="http", interval=10.0, timeout=2.0):
+        self.group = group
+        self.path = path if path.startswith("/") else "/" + path
+        self.protocol = protocol
+        self.interval = interval
+        self.timeout = timeout
+        self.pid = None
+        self.thread = None
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+
+    def ensure(self):
+        """
+        Starts the check thread if not running in the current process.
+        """
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self.run, name="outpost-health")
+            self.thread.daemon = True
+            self.pid = os.getpid()
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        session = requests.Session()
+        stopped = self.stopped
+        while not stopped.is_set():
+            self.checkAll(session)
+            stopped.wait(self.interval)
+        session.close()
+
+    def checkAll(self, session=requests):
+        for upstream in self.group.upstreams:
+            healthy = self.check(upstream, session)
+            if healthy != upstream.healthy:
+                log = logging.getLogger("outpost.proxy")
+                log.warning("Upstream %s is %s" % (upstream.host, "up" if healthy else "down"))
+                if healthy:
+                    # a recovered host is not ejected
+                    upstream.ejected = 0.0
+                    upstream.failures = 0
+                upstream.healthy = healthy
+
+    def check(self, upstream, session=requests):
+        url = "%s://%s%s" % (self.protocol, upstream.host, self.path)
+        try:
+            response = session.get(url, timeout=self.timeout, allow_redirects=False)
+            response.close()
+            return 200 <= response.status_code < 400
+        except requests.exceptions.RequestException:
+            return False
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
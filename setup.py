@@ -41,6 +41,7 @@ setup(name='outpost',
       license='BSD 3',
       zip_safe=False,
       install_requires=requires,
+      extras_require={"asgi": ["httpx"], "compress": ["brotli", "zstandard"]},
       tests_require=requires,
       test_suite="outpost",
       entry_points = """\